@@ -0,0 +1,148 @@
+#########
+# Copyright (c) 2015 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""Profiles the start up of the ctx client.
+
+Serves a mock ctx through a ctx proxy and makes a single ctx call in a
+new python process, the way scripts invoke ``ctx``. Prints the modules
+imported by the call with their cumulative import time, slowest first,
+and exits with status 1 if the call (imports of ``cloudify.proxy.client``
+and everything ``main`` imports included) takes longer than
+``--budget-ms``.
+
+    python benchmarks/ctx_client_startup.py --proxy unix --budget-ms 50
+"""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# allow running the script from a checkout without installing it
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+
+# runs in the new process, only imports what the import hook needs so
+# that everything the ctx call imports is measured
+PROFILE_CALL = """
+import __builtin__
+import sys
+import time
+
+timings = {}
+original_import = __builtin__.__import__
+
+
+def timed_import(name, *args, **kwargs):
+    already_imported = name in sys.modules
+    start = time.time()
+    try:
+        return original_import(name, *args, **kwargs)
+    finally:
+        if not already_imported and name in sys.modules:
+            timings[name] = time.time() - start
+
+report_path = sys.argv[1]
+__builtin__.__import__ = timed_import
+start = time.time()
+try:
+    from cloudify.proxy.client import main
+    main(sys.argv[2:])
+finally:
+    __builtin__.__import__ = original_import
+total = time.time() - start
+import json
+with open(report_path, 'w') as f:
+    json.dump({'total': total, 'timings': timings}, f)
+"""
+
+
+def _start_proxy(proxy_type):
+    from cloudify.mocks import MockCloudifyContext
+    from cloudify.proxy import server
+    ctx = MockCloudifyContext(node_id='node_id', properties={'prop': 'value'})
+    if proxy_type == 'http':
+        return server.HTTPCtxProxy(ctx), None
+    if proxy_type == 'unix':
+        proxy = server.UnixCtxProxy(ctx)
+    else:
+        proxy = server.TCPCtxProxy(ctx)
+    stopped = threading.Event()
+
+    def serve():
+        while not stopped.is_set():
+            proxy.poll_and_process(timeout=0.1)
+        proxy.close()
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+    return proxy, stopped
+
+
+def run(proxy_type, call_args):
+    """Makes the ctx call in a new process and returns the time it took
+    in that process, the wall time of the process and the import
+    timings."""
+    proxy, stopped = _start_proxy(proxy_type)
+    fd, report_path = tempfile.mkstemp(prefix='ctx-client-startup-')
+    os.close(fd)
+    try:
+        start = time.time()
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(
+                [sys.executable, '-c', PROFILE_CALL, report_path,
+                 '--socket-url', proxy.socket_url] + call_args,
+                cwd=REPO_ROOT, stdout=devnull)
+        process_time = time.time() - start
+        with open(report_path) as f:
+            report = json.load(f)
+    finally:
+        os.remove(report_path)
+        if stopped is None:
+            proxy.close()
+        else:
+            stopped.set()
+    return report['total'], process_time, report['timings']
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--proxy', choices=['unix', 'tcp', 'http'],
+                        default='unix')
+    parser.add_argument('--budget-ms', type=float, default=50)
+    parser.add_argument('--top', type=int, default=15)
+    parser.add_argument('args', nargs='*',
+                        default=['node', 'properties', 'prop'])
+    args = parser.parse_args()
+    total, process_time, timings = run(args.proxy, args.args)
+    for name, duration in sorted(timings.items(),
+                                 key=lambda item: item[1],
+                                 reverse=True)[:args.top]:
+        print '{0:8.2f}ms  {1}'.format(duration * 1000, name)
+    print '{0:8.2f}ms  ctx {1} (budget {2}ms)'.format(
+        total * 1000, ' '.join(args.args), args.budget_ms)
+    print '{0:8.2f}ms  whole process, interpreter start up included'.format(
+        process_time * 1000)
+    if total * 1000 > args.budget_ms:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+#########
+# Copyright (c) 2015 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""Measures ctx calls per second through the HTTP ctx proxy.
+
+    python benchmarks/ctx_proxy.py --requests 2000 --concurrency 4
+
+With ``--batch-size``, calls are sent in batches of that size.
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+# allow running the script from a checkout without installing it
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def _ctx():
+    from cloudify.mocks import MockCloudifyContext
+    return MockCloudifyContext(node_id='node_id', properties={
+        'prop': {'nested': [{'value': 'value'}]}
+    })
+
+
+def run(requests, concurrency, args, batch_size=1):
+    from cloudify.proxy import client
+    from cloudify.proxy.server import HTTPCtxProxy
+    proxy = HTTPCtxProxy(_ctx(), max_concurrent_requests=concurrency)
+    if batch_size > 1:
+        request = {'batch': [args] * batch_size}
+    else:
+        request = {'args': args}
+    per_thread = requests // concurrency // batch_size * batch_size
+
+    def calls():
+        for _ in range(per_thread // batch_size):
+            client.http_client_req(proxy.socket_url, request, timeout=5)
+
+    threads = [threading.Thread(target=calls) for _ in range(concurrency)]
+    try:
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+    finally:
+        proxy.close()
+    return per_thread * concurrency / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('args', nargs='*',
+                        default=['node', 'properties', 'prop.nested[0].value'])
+    args = parser.parse_args()
+    calls_per_second = run(args.requests, args.concurrency, args.args,
+                           args.batch_size)
+    print '{0:.1f} ctx calls/s ({1} requests, concurrency {2})'.format(
+        calls_per_second, args.requests, args.concurrency)
+
+
+if __name__ == '__main__':
+    main()
@@ -20,6 +20,10 @@ import pika
 
 from cloudify.utils import get_manager_ip
 
+# control messages (e.g. cancel requests) of executions are published to
+# this exchange with the execution id as the routing key
+EXECUTION_CONTROL_EXCHANGE = 'cloudify-execution-control'
+
 
 class AMQPClient(object):
 
@@ -47,6 +51,9 @@ class AMQPClient(object):
     def publish_event(self, event):
         self._publish(event, self.events_queue_name)
 
+    def publish_task_reply(self, reply, reply_queue):
+        self._publish(reply, reply_queue)
+
     def close(self):
         self.connection.close()
 
@@ -56,5 +63,109 @@ class AMQPClient(object):
                                         body=json.dumps(item))
 
 
+class AMQPReplyQueueConsumer(object):
+    """
+    Consumes the completion records remote operations publish to an
+    execution reply queue. The queue is declared on construction so that
+    records of tasks sent afterwards are never lost.
+
+    :param reply_queue: The reply queue name
+    :param callback: Called with each decoded record
+    """
+
+    def __init__(self, reply_queue, callback):
+        self.reply_queue = reply_queue
+        self.callback = callback
+        self.connection = pika.BlockingConnection(
+            pika.ConnectionParameters(host=get_manager_ip()))
+        self.channel = self.connection.channel()
+        self.channel.queue_declare(queue=reply_queue,
+                                   auto_delete=True,
+                                   durable=False,
+                                   exclusive=False)
+        self.channel.basic_consume(self._on_message,
+                                   queue=reply_queue,
+                                   no_ack=True)
+
+    def _on_message(self, channel, method, properties, body):
+        self.callback(json.loads(body))
+
+    def consume(self, should_stop):
+        """
+        Consume records until ``should_stop`` returns True
+
+        :param should_stop: A callable checked between socket reads
+        """
+        while not should_stop():
+            self.connection.process_data_events()
+
+    def close(self):
+        self.connection.close()
+
+
+class AMQPExecutionControlConsumer(object):
+    """
+    Consumes the control messages published for an execution, such as
+    ``{"action": "cancel"}``, through an exclusive queue bound to the
+    execution control exchange.
+
+    :param execution_id: The execution id
+    :param callback: Called with each decoded message
+    """
+
+    def __init__(self, execution_id, callback):
+        self.callback = callback
+        self.connection = pika.BlockingConnection(
+            pika.ConnectionParameters(host=get_manager_ip()))
+        self.channel = self.connection.channel()
+        self.channel.exchange_declare(exchange=EXECUTION_CONTROL_EXCHANGE,
+                                      exchange_type='direct',
+                                      durable=True)
+        queue = self.channel.queue_declare(exclusive=True,
+                                           auto_delete=True).method.queue
+        self.channel.queue_bind(queue=queue,
+                                exchange=EXECUTION_CONTROL_EXCHANGE,
+                                routing_key=execution_id)
+        self.channel.basic_consume(self._on_message,
+                                   queue=queue,
+                                   no_ack=True)
+
+    def _on_message(self, channel, method, properties, body):
+        self.callback(json.loads(body))
+
+    def consume(self, should_stop):
+        """
+        Consume messages until ``should_stop`` returns True
+
+        :param should_stop: A callable checked between socket reads
+        """
+        while not should_stop():
+            self.connection.process_data_events()
+
+    def close(self):
+        self.connection.close()
+
+
+def publish_execution_control(execution_id, action):
+    """
+    Publish a control message for an execution.
+
+    :param execution_id: The execution id
+    :param action: The action, e.g. 'cancel' or 'force-cancel'
+    """
+    connection = pika.BlockingConnection(
+        pika.ConnectionParameters(host=get_manager_ip()))
+    try:
+        channel = connection.channel()
+        channel.exchange_declare(exchange=EXECUTION_CONTROL_EXCHANGE,
+                                 exchange_type='direct',
+                                 durable=True)
+        channel.basic_publish(exchange=EXECUTION_CONTROL_EXCHANGE,
+                              routing_key=execution_id,
+                              body=json.dumps({'action': action}))
+    finally:
+        connection.close()
+
+
 def create_client():
     return AMQPClient()
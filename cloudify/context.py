@@ -13,10 +13,11 @@
 #    * See the License for the specific language governing permissions and
 #    * limitations under the License.
 
+import threading
 import warnings
 
 from cloudify.endpoint import ManagerEndpoint, LocalEndpoint
-from cloudify.logs import init_cloudify_logger
+from cloudify.logs import init_cloudify_logger, LOGGING_CONFIG_KEY
 from cloudify import exceptions
 
 
@@ -89,7 +90,8 @@ class CommonContext(object):
             # there are times when this instance is instantiated merely for
             # accessing the attributes so we can tolerate no storage (such is
             # the case in logging)
-            self._endpoint = LocalEndpoint(self, ctx.get('storage'))
+            self._endpoint = LocalEndpoint(self, ctx.get('storage'),
+                                           ctx.get('event_sink'))
         else:
             self._endpoint = ManagerEndpoint(self)
 
@@ -220,12 +222,19 @@ class NodeContext(EntityContext):
         super(NodeContext, self).__init__(*args, **kwargs)
         self._endpoint = kwargs['endpoint']
         self._node = None
+        # ctx proxy requests of a script are served concurrently, the node
+        # is loaded by one of them only
+        self._lock = threading.Lock()
 
     def _get_node_if_needed(self):
-        if self._node is None:
-            self._node = self._endpoint.get_node(self.id)
-            props = self._node.get('properties', {})
-            self._node['properties'] = ImmutableProperties(props)
+        if self._node is not None:
+            return
+        with self._lock:
+            if self._node is None:
+                node = self._endpoint.get_node(self.id)
+                props = node.get('properties', {})
+                node['properties'] = ImmutableProperties(props)
+                self._node = node
 
     @property
     def id(self):
@@ -256,12 +265,22 @@ class NodeInstanceContext(EntityContext):
         self._node_instance = None
         self._host_ip = None
         self._relationships = None
+        # ctx proxy requests of a script are served concurrently, the node
+        # instance is loaded (and updated) by one of them at a time, so that
+        # none of their runtime properties changes are lost
+        self._lock = threading.Lock()
 
     def _get_node_instance_if_needed(self):
-        if self._node_instance is None:
-            self._node_instance = self._endpoint.get_node_instance(self.id)
-            self._node_instance.runtime_properties.modifiable = \
-                self._modifiable
+        node_instance = self._node_instance
+        if node_instance is not None:
+            return node_instance
+        with self._lock:
+            if self._node_instance is None:
+                node_instance = self._endpoint.get_node_instance(self.id)
+                node_instance.runtime_properties.modifiable = \
+                    self._modifiable
+                self._node_instance = node_instance
+            return self._node_instance
 
     @property
     def id(self):
@@ -276,8 +295,7 @@ class NodeInstanceContext(EntityContext):
         lifecycle.
         Retrieving runtime properties involves a call to Cloudify's storage.
         """
-        self._get_node_instance_if_needed()
-        return self._node_instance.runtime_properties
+        return self._get_node_instance_if_needed().runtime_properties
 
     def update(self):
         """
@@ -288,9 +306,11 @@ class NodeInstanceContext(EntityContext):
         update Cloudify's storage with changes. Otherwise, the method is
         automatically invoked as soon as the task execution is over.
         """
-        if self._node_instance is not None and self._node_instance.dirty:
-            self._endpoint.update_node_instance(self._node_instance)
-            self._node_instance = None
+        with self._lock:
+            if self._node_instance is not None and \
+                    self._node_instance.dirty:
+                self._endpoint.update_node_instance(self._node_instance)
+                self._node_instance = None
 
     def _get_node_instance_ip_if_needed(self):
         self._get_node_instance_if_needed()
@@ -666,7 +686,9 @@ class CloudifyContext(CommonContext):
         logger_name = self.task_id if self.task_id is not None \
             else 'cloudify_plugin'
         handler = self._endpoint.get_logging_handler()
-        return init_cloudify_logger(handler, logger_name)
+        return init_cloudify_logger(
+            handler, logger_name,
+            logging_config=self._context.get(LOGGING_CONFIG_KEY))
 
 
 class OperationContext(object):
@@ -17,8 +17,9 @@
 import traceback
 import copy
 import sys
+import time
 import Queue
-from threading import Thread
+from threading import Thread, Event
 from StringIO import StringIO
 from functools import wraps
 
@@ -26,6 +27,8 @@ from cloudify import context
 from cloudify.workflows.workflow_context import CloudifyWorkflowContext
 from cloudify.manager import update_execution_status, get_rest_client
 from cloudify.workflows import api
+from cloudify.workflows.tasks import build_task_reply, TASK_REPLY_QUEUE_KEY
+from cloudify.logs import amqp_task_reply_out
 from cloudify_rest_client.executions import Execution
 from cloudify import exceptions
 from cloudify.state import current_ctx, current_workflow_ctx
@@ -102,8 +105,15 @@ def operation(func=None, **arguments):
         @operations
         def start(**kwargs):
             pass
+
+    Operations executed locally receive copies of their kwargs, so that
+    changes made to them do not leak to the caller. Operations that never
+    modify their kwargs, or copy them on their own, may skip this with
+    ``@operation(copy_kwargs=False)``.
     """
     if func is not None:
+        copy_kwargs = arguments.get('copy_kwargs', True)
+
         @wraps(func)
         def wrapper(*args, **kwargs):
             ctx = _find_context_arg(args, kwargs, _is_cloudify_context)
@@ -113,10 +123,10 @@ def operation(func=None, **arguments):
                 ctx = context.CloudifyContext(ctx)
                 # remove __cloudify_context
                 raw_context = kwargs.pop(CLOUDIFY_CONTEXT_PROPERTY_KEY, {})
-                if ctx.task_target is None:
-                    # task is local (not through celery) so we need to
-                    # clone kwarg
-                    kwargs = copy.deepcopy(kwargs)
+                if ctx.task_target is None and copy_kwargs:
+                    # task is local (not through celery) so kwargs must not
+                    # be shared with the caller
+                    kwargs = _copy_kwarg(kwargs)
                 if raw_context.get('has_intrinsic_functions') is True:
                     kwargs = ctx._endpoint.evaluate_functions(payload=kwargs)
                 kwargs['ctx'] = ctx
@@ -181,13 +191,85 @@ def operation(func=None, **arguments):
             if ctx.operation._operation_retry:
                 raise ctx.operation._operation_retry
             return result
-        return _process_wrapper(wrapper, arguments)
+        return _process_wrapper(_task_reply_wrapper(wrapper), arguments)
     else:
         def partial_wrapper(fn):
             return operation(fn, **arguments)
         return partial_wrapper
 
 
+def _task_reply_wrapper(func):
+    """
+    When the executing workflow asked for it (remote operations only),
+    publish a completion record of the operation to the execution reply
+    queue, after the node instances have been updated.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        ctx = _find_context_arg(args, kwargs, _is_cloudify_context)
+        if _is_cloudify_context(ctx):
+            ctx = ctx._context
+        reply_queue = (ctx or {}).get(TASK_REPLY_QUEUE_KEY)
+        if not reply_queue:
+            return func(*args, **kwargs)
+        task_id = ctx.get('task_id')
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            amqp_task_reply_out(build_task_reply(task_id, error=e),
+                                reply_queue)
+            raise
+        amqp_task_reply_out(build_task_reply(task_id, result=result),
+                            reply_queue)
+        return result
+    return wrapper
+
+
+_SCALAR_TYPES = (type(None), str, unicode, bool, int, long, float)
+
+
+def _copy_kwarg(value):
+    """
+    Copy an operation kwarg. Plain dicts, lists and tuples, the usual shape
+    of operation inputs, are copied by a recursive copy that is much
+    cheaper than copy.deepcopy, and so are read-only storage snapshots
+    (types with a ``_mutable_type``). Scalars are shared and other objects
+    are deep copied.
+    """
+    value_type = type(value)
+    if value_type in _SCALAR_TYPES:
+        return value
+    if value_type is dict:
+        return _copy_dict(value)
+    if value_type is list:
+        return _copy_list(value)
+    if value_type is tuple:
+        return tuple(_copy_kwarg(item) for item in value)
+    # read-only storage snapshots of local workflows are copied into their
+    # mutable types
+    mutable_type = getattr(value_type, '_mutable_type', None)
+    if mutable_type is not None:
+        if isinstance(value, dict):
+            return mutable_type(_copy_dict(value))
+        return mutable_type(_copy_list(value))
+    return copy.deepcopy(value)
+
+
+def _copy_dict(value):
+    copied = {}
+    for key, item in value.iteritems():
+        if type(item) in _SCALAR_TYPES:
+            copied[key] = item
+        else:
+            copied[key] = _copy_kwarg(item)
+    return copied
+
+
+def _copy_list(value):
+    return [item if type(item) in _SCALAR_TYPES else _copy_kwarg(item)
+            for item in value]
+
+
 def workflow(func=None, **arguments):
     """
     Decorate workflow functions with this decorator.
@@ -231,6 +313,14 @@ def workflow(func=None, **arguments):
         return partial_wrapper
 
 
+# seconds between checks of the execution status for 'cancel' requests;
+# while subscribed to the execution control messages (only when the
+# manager publishes them, see CloudifyWorkflowContext.execution_control),
+# these checks are only a fallback and the interval doubles up to the max
+CANCEL_POLL_INTERVAL = 5
+CANCEL_POLL_MAX_INTERVAL = 10
+
+
 class RequestSystemExit(SystemExit):
     pass
 
@@ -241,7 +331,7 @@ def _remote_workflow(ctx, func, args, kwargs):
         _send_workflow_cancelled_event(ctx)
 
     rest = get_rest_client()
-    parent_queue, child_queue = (Queue.Queue(), Queue.Queue())
+    child_queue = Queue.Queue()
     try:
         if rest.executions.get(ctx.execution_id).status in \
                 (Execution.CANCELLING, Execution.FORCE_CANCELLING):
@@ -264,6 +354,10 @@ def _remote_workflow(ctx, func, args, kwargs):
                     ctx, func, args, kwargs)
                 child_queue.put({'result': workflow_result})
             except api.ExecutionCancelled:
+                # tasks still queued by the cancelled execution are
+                # dropped, running tasks are left to finish gracefully
+                # and are not waited for
+                ctx.internal.revoke_remote_tasks(timeout=0)
                 child_queue.put({
                     'result': api.EXECUTION_CANCELLED_RESULT})
             except BaseException as workflow_ex:
@@ -278,59 +372,42 @@ def _remote_workflow(ctx, func, args, kwargs):
             finally:
                 ctx.internal.stop_event_monitor()
 
-        api.queue = parent_queue
+        api.cancellation_token.reset()
 
         # starting workflow execution on child thread
         t = Thread(target=child_wrapper)
         t.start()
 
-        # while the child thread is executing the workflow,
-        # the parent thread is polling for 'cancel' requests while
-        # also waiting for messages from the child thread
-        has_sent_cancelling_action = False
-        result = None
-        execution = None
-        while True:
-            # check if child thread sent a message
-            try:
-                data = child_queue.get(timeout=5)
-                if 'result' in data:
-                    # child thread has terminated
-                    result = data['result']
-                    break
-                else:
-                    # error occurred in child thread
-                    error = data['error']
-                    raise exceptions.ProcessExecutionError(error['message'],
-                                                           error['type'],
-                                                           error['traceback'])
-            except Queue.Empty:
-                pass
-            # check for 'cancel' requests
-            execution = rest.executions.get(ctx.execution_id)
-            if execution.status == Execution.FORCE_CANCELLING:
-                result = api.EXECUTION_CANCELLED_RESULT
-                break
-            elif not has_sent_cancelling_action and \
-                    execution.status == Execution.CANCELLING:
-                # send a 'cancel' message to the child thread. It
-                # is up to the workflow implementation to check for
-                # this message and act accordingly (by stopping and
-                # raising an api.ExecutionCancelled error, or by returning
-                # the deprecated api.EXECUTION_CANCELLED_RESULT as result).
-                # parent thread then goes back to polling for
-                # messages from child process or possibly
-                # 'force-cancelling' requests
-                parent_queue.put({'action': 'cancel'})
-                has_sent_cancelling_action = True
+        # control messages of the execution are put on the child queue as
+        # well, as a hint to check for 'cancel' requests right away
+        subscribed = Event()
+        stop_control_consumer = None
+        if ctx.execution_control:
+            stop_control_consumer = _consume_execution_control(
+                ctx.execution_id, child_queue, subscribed)
+        try:
+            result, execution = _wait_for_workflow_thread(
+                ctx, rest, child_queue, subscribed)
+        finally:
+            if stop_control_consumer is not None:
+                stop_control_consumer()
 
         # updating execution status and sending events according to
         # how the execution ended
         if result == api.EXECUTION_CANCELLED_RESULT:
-            update_execution_cancelled()
             if execution and execution.status == Execution.FORCE_CANCELLING:
+                # the workflow thread may still be sending tasks, so only
+                # the tasks in-flight by now are revoked (and terminated).
+                # this is done before the execution is marked cancelled,
+                # and terminated tasks are not waited for
+                try:
+                    ctx.internal.revoke_remote_tasks(terminate=True,
+                                                     timeout=0)
+                finally:
+                    update_execution_cancelled()
                 # TODO: kill worker externally
                 raise RequestSystemExit()
+            update_execution_cancelled()
         else:
             update_execution_status(ctx.execution_id, Execution.TERMINATED)
             _send_workflow_succeeded_event(ctx)
@@ -350,7 +427,100 @@ def _remote_workflow(ctx, func, args, kwargs):
         raise
 
 
+def _wait_for_workflow_thread(ctx, rest, child_queue, subscribed):
+    # while the child thread is executing the workflow,
+    # the parent thread is polling for 'cancel' requests while
+    # also waiting for messages from the child thread. while subscribed
+    # to the execution control messages (``subscribed`` is set), polling
+    # is only a fallback
+    poll_interval = CANCEL_POLL_INTERVAL
+    next_poll = time.time() + poll_interval
+    has_sent_cancelling_action = False
+    result = None
+    execution = None
+    while True:
+        # check if child thread sent a message
+        try:
+            data = child_queue.get(timeout=max(next_poll - time.time(), 0))
+            if 'result' in data:
+                # child thread has terminated
+                result = data['result']
+                break
+            elif 'error' in data:
+                # error occurred in child thread
+                error = data['error']
+                raise exceptions.ProcessExecutionError(error['message'],
+                                                       error['type'],
+                                                       error['traceback'])
+        except Queue.Empty:
+            if subscribed.is_set():
+                poll_interval = min(poll_interval * 2,
+                                    CANCEL_POLL_MAX_INTERVAL)
+        if not subscribed.is_set():
+            # the control messages consumer is gone, only polling
+            # notices 'cancel' requests now
+            poll_interval = CANCEL_POLL_INTERVAL
+        next_poll = time.time() + poll_interval
+        # check for 'cancel' requests
+        execution = rest.executions.get(ctx.execution_id)
+        if execution.status == Execution.FORCE_CANCELLING:
+            result = api.EXECUTION_CANCELLED_RESULT
+            break
+        elif not has_sent_cancelling_action and \
+                execution.status == Execution.CANCELLING:
+            # cancel the token shared with the child thread. It
+            # is up to the workflow implementation to check for
+            # this and act accordingly (by stopping and
+            # raising an api.ExecutionCancelled error, or by returning
+            # the deprecated api.EXECUTION_CANCELLED_RESULT as result).
+            # parent thread then goes back to polling for
+            # messages from child process or possibly
+            # 'force-cancelling' requests
+            api.cancellation_token.cancel()
+            has_sent_cancelling_action = True
+    return result, execution
+
+
+def _consume_execution_control(execution_id, messages, subscribed):
+    """
+    Consume the control messages of an execution in a daemon thread,
+    putting them on ``messages``.
+
+    ``subscribed`` is set while the consumer runs. If the consumer dies,
+    it is cleared and a message is put on ``messages`` so that the
+    waiting thread goes back to polling right away.
+
+    :return: a function stopping the consumer, or None if the broker
+             could not be reached
+    """
+    from cloudify.amqp_client import AMQPExecutionControlConsumer
+    try:
+        consumer = AMQPExecutionControlConsumer(
+            execution_id,
+            lambda message: messages.put({'control': message}))
+    except Exception:
+        return None
+    stopped = Event()
+
+    def consume():
+        try:
+            consumer.consume(stopped.is_set)
+        except Exception:
+            pass
+        finally:
+            subscribed.clear()
+            if not stopped.is_set():
+                messages.put({'control': None})
+            consumer.close()
+    subscribed.set()
+    thread = Thread(target=consume)
+    thread.daemon = True
+    thread.start()
+    return stopped.set
+
+
 def _local_workflow(ctx, func, args, kwargs):
+    api.cancellation_token.reset()
     try:
         _send_workflow_started_event(ctx)
         result = _execute_workflow_function(ctx, func, args, kwargs)
@@ -168,23 +168,28 @@ class ManagerEndpoint(Endpoint):
 
 class LocalEndpoint(Endpoint):
 
-    def __init__(self, ctx, storage):
+    def __init__(self, ctx, storage, event_sink=None):
         super(LocalEndpoint, self).__init__(ctx)
         self.storage = storage
+        self.event_sink = event_sink or logs.StdoutEventSink()
 
+    # storage nodes and node instances are read-only snapshots, operations
+    # get mutable copies of them, as they do when fetched from the manager
     def get_node(self, node_id):
-        return self.storage.get_node(node_id)
+        from cloudify.workflows.local import _thaw
+        return _thaw(self.storage.get_node(node_id))
 
     def get_node_instance(self, node_instance_id):
+        from cloudify.workflows.local import _thaw
         instance = self.storage.get_node_instance(node_instance_id)
         return manager.NodeInstance(
             node_instance_id,
             instance.node_id,
-            runtime_properties=instance.runtime_properties,
+            runtime_properties=_thaw(instance.runtime_properties),
             state=instance.state,
             version=instance.version,
             host_id=instance.host_id,
-            relationships=instance.relationships)
+            relationships=_thaw(instance.relationships))
 
     def update_node_instance(self, node_instance):
         return self.storage.update_node_instance(
@@ -214,7 +219,7 @@ class LocalEndpoint(Endpoint):
 
     def get_logging_handler(self):
         return CloudifyPluginLoggingHandler(self.ctx,
-                                            out_func=logs.stdout_log_out)
+                                            out_func=self.event_sink.log_out)
 
     def send_plugin_event(self,
                           message=None,
@@ -224,7 +229,7 @@ class LocalEndpoint(Endpoint):
                                message,
                                args,
                                additional_context,
-                               out_func=logs.stdout_event_out)
+                               out_func=self.event_sink.event_out)
 
     def evaluate_functions(self, payload):
         def evaluate_functions_method(deployment_id, context, payload):
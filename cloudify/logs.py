@@ -14,7 +14,9 @@
 #    * limitations under the License.
 
 
+import os
 import sys
+import collections
 import time
 import threading
 import logging
@@ -26,6 +28,25 @@ from cloudify.amqp_client import create_client
 # A thread local for storing a separate amqp client for each thread
 clients = threading.local()
 
+DEFAULT_LOGGING_LEVEL = logging.INFO
+
+# Environment variable for the default logging level of cloudify loggers.
+# A logger type specific level may be set by appending the upper cased logger
+# type, e.g. CLOUDIFY_LOGGING_LEVEL_PLUGIN=debug
+LOGGING_LEVEL_ENV = 'CLOUDIFY_LOGGING_LEVEL'
+# Environment variable for the maximum number of sub-warning log messages per
+# second a single cloudify logger handler will publish
+LOGGING_RATE_LIMIT_ENV = 'CLOUDIFY_LOGGING_RATE_LIMIT'
+
+# The key under which logging configuration is stored in the cloudify
+# context and bootstrap context
+LOGGING_CONFIG_KEY = 'logging'
+
+PLUGIN_LOGGER = 'plugin'
+WORKFLOW_LOGGER = 'workflow'
+WORKFLOW_NODE_LOGGER = 'workflow_node'
+LOGGER_TYPES = [PLUGIN_LOGGER, WORKFLOW_LOGGER, WORKFLOW_NODE_LOGGER]
+
 
 def message_context_from_cloudify_context(ctx):
     """Build a message context from a CloudifyContext instance"""
@@ -74,9 +95,50 @@ def message_context_from_workflow_node_instance_context(ctx):
     return message_context
 
 
+class RateLimitFilter(logging.Filter):
+    """
+    A token bucket based filter limiting the amount of log records that
+    pass through a handler.
+
+    Records of level WARNING and above are never dropped.
+
+    :param rate: The number of records allowed per second (on average)
+    :param burst: The maximum number of records allowed in a single burst
+                  (defaults to ``rate``)
+    """
+
+    def __init__(self, rate, burst=None):
+        logging.Filter.__init__(self)
+        if rate <= 0:
+            raise ValueError('rate must be positive: {0}'.format(rate))
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.dropped = 0
+        self._tokens = self.burst
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.burst,
+                               self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            if self._tokens < 1:
+                self.dropped += 1
+                return False
+            self._tokens -= 1
+            return True
+
+
 class CloudifyBaseLoggingHandler(logging.Handler):
     """A base handler class for writing log messages to RabbitMQ"""
 
+    # Used to look up logger type specific configuration
+    logger_type = None
+
     def __init__(self, ctx, out_func, message_context_builder):
         logging.Handler.__init__(self)
         self.context = message_context_builder(ctx)
@@ -102,6 +164,9 @@ class CloudifyBaseLoggingHandler(logging.Handler):
 
 class CloudifyPluginLoggingHandler(CloudifyBaseLoggingHandler):
     """A handler class for writing plugin log messages to RabbitMQ"""
+
+    logger_type = PLUGIN_LOGGER
+
     def __init__(self, ctx, out_func=None):
         CloudifyBaseLoggingHandler.__init__(
             self, ctx, out_func, message_context_from_cloudify_context)
@@ -109,6 +174,9 @@ class CloudifyPluginLoggingHandler(CloudifyBaseLoggingHandler):
 
 class CloudifyWorkflowLoggingHandler(CloudifyBaseLoggingHandler):
     """A Handler class for writing workflow log messages to RabbitMQ"""
+
+    logger_type = WORKFLOW_LOGGER
+
     def __init__(self, ctx, out_func=None):
         CloudifyBaseLoggingHandler.__init__(
             self, ctx, out_func, message_context_from_workflow_context)
@@ -116,31 +184,138 @@ class CloudifyWorkflowLoggingHandler(CloudifyBaseLoggingHandler):
 
 class CloudifyWorkflowNodeLoggingHandler(CloudifyBaseLoggingHandler):
     """A Handler class for writing workflow nodes log messages to RabbitMQ"""
+
+    logger_type = WORKFLOW_NODE_LOGGER
+
     def __init__(self, ctx, out_func=None):
         CloudifyBaseLoggingHandler.__init__(
             self, ctx, out_func,
             message_context_from_workflow_node_instance_context)
 
 
+def parse_logging_level(level):
+    """
+    Convert a logging level name (e.g. 'debug') or number (e.g. 10 or '10')
+    to a logging level number.
+
+    :param level: A level name or number, or None
+    :return: The level number or None if ``level`` is None
+    """
+    if level is None:
+        return None
+    if isinstance(level, (int, long)):
+        return level
+    level = str(level).strip()
+    if level.isdigit():
+        return int(level)
+    result = logging.getLevelName(str(level).upper())
+    if not isinstance(result, int):
+        raise ValueError('Invalid logging level: {0}'.format(level))
+    return result
+
+
+def merge_logging_configs(*configs):
+    """
+    Merge several logging configuration dicts. Later configurations override
+    earlier ones. ``None`` configurations are ignored.
+
+    A logging configuration dict has the following (optional) keys:
+
+    * ``level``: the default level for all cloudify loggers
+    * ``loggers``: a dict from logger type (``plugin``, ``workflow``,
+      ``workflow_node``) or logger name to level
+    * ``rate_limit``: maximum number of sub-warning records per second
+      each logger handler will publish
+    * ``rate_limit_burst``: maximum burst size allowed by the rate limit
+
+    :return: The merged configuration dict
+    """
+    result = {}
+    loggers = {}
+    for config in configs:
+        if not config:
+            continue
+        for key, value in config.items():
+            if key == 'loggers':
+                loggers.update(value or {})
+            elif value is not None:
+                result[key] = value
+    if loggers:
+        result['loggers'] = loggers
+    return result
+
+
+def logging_config_from_env(environ=None):
+    """
+    Build a logging configuration dict from the
+    ``CLOUDIFY_LOGGING_LEVEL[_<LOGGER_TYPE>]`` and
+    ``CLOUDIFY_LOGGING_RATE_LIMIT`` environment variables.
+    """
+    environ = os.environ if environ is None else environ
+    config = {}
+    if environ.get(LOGGING_LEVEL_ENV):
+        config['level'] = environ[LOGGING_LEVEL_ENV]
+    loggers = {}
+    for logger_type in LOGGER_TYPES:
+        level = environ.get('{0}_{1}'.format(LOGGING_LEVEL_ENV,
+                                             logger_type.upper()))
+        if level:
+            loggers[logger_type] = level
+    if loggers:
+        config['loggers'] = loggers
+    if environ.get(LOGGING_RATE_LIMIT_ENV):
+        config['rate_limit'] = float(environ[LOGGING_RATE_LIMIT_ENV])
+    return config
+
+
+def get_logging_level(logging_config, logger_name=None, logger_type=None):
+    """
+    Resolve the logging level for a logger from a logging configuration dict.
+    A logger name specific level takes precedence over a logger type
+    specific level, which takes precedence over the default level.
+    """
+    logging_config = logging_config or {}
+    loggers = logging_config.get('loggers') or {}
+    for key in (logger_name, logger_type):
+        if key is not None and key in loggers:
+            return parse_logging_level(loggers[key])
+    level = parse_logging_level(logging_config.get('level'))
+    return DEFAULT_LOGGING_LEVEL if level is None else level
+
+
 def init_cloudify_logger(handler, logger_name,
-                         logging_level=logging.INFO):
+                         logging_level=None,
+                         logging_config=None):
     """
     Instantiate an amqp backed logger based on the provided handler
     for sending log messages to RabbitMQ
 
     :param handler: A logger handler based on the context
     :param logger_name: The logger name
-    :param logging_level: The logging level
+    :param logging_level: The logging level. If not provided, it is resolved
+                          from ``logging_config`` and the environment
+                          (``logging_config`` takes precedence).
+    :param logging_config: A logging configuration dict
+                           (see ``merge_logging_configs``)
     :return: An amqp backed logger
     """
 
-    # TODO: somehow inject logging level (no one currently passes
-    # logging_level)
+    logging_config = merge_logging_configs(logging_config_from_env(),
+                                           logging_config)
+    if logging_level is None:
+        logging_level = get_logging_level(
+            logging_config,
+            logger_name=logger_name,
+            logger_type=getattr(handler, 'logger_type', None))
     logger = logging.getLogger(logger_name)
     logger.setLevel(logging_level)
     for h in logger.handlers:
         logger.removeHandler(h)
     handler.setFormatter(logging.Formatter("%(message)s"))
+    rate_limit = logging_config.get('rate_limit')
+    if rate_limit:
+        handler.addFilter(RateLimitFilter(
+            rate_limit, logging_config.get('rate_limit_burst')))
     logger.propagate = True
     logger.addHandler(handler)
     return logger
@@ -280,6 +455,16 @@ def amqp_log_out(log):
                              .format(e.message, json.dumps(log)))
 
 
+def amqp_task_reply_out(reply, reply_queue):
+    try:
+        _amqp_client().publish_task_reply(reply, reply_queue)
+    except BaseException as e:
+        error_logger = logging.getLogger('cloudify_celery')
+        error_logger.warning('Error publishing task reply to RabbitMQ ['
+                             'message={0}, reply={1}]'
+                             .format(e.message, reply))
+
+
 def stdout_event_out(event):
     populate_base_item(event, 'cloudify_event')
     sys.stdout.write('{0}\n'.format(create_event_message_prefix(event)))
@@ -290,6 +475,159 @@ def stdout_log_out(log):
     sys.stdout.write('{0}\n'.format(create_event_message_prefix(log)))
 
 
+class EventSink(object):
+    """
+    A base class for sinks of events and logs produced by local workflow
+    executions. ``event_out`` and ``log_out`` can be used wherever an
+    ``out_func`` is expected.
+    """
+
+    def event_out(self, event):
+        populate_base_item(event, 'cloudify_event')
+        self.write(event)
+
+    def log_out(self, log):
+        populate_base_item(log, 'cloudify_log')
+        self.write(log)
+
+    def write(self, item):
+        """Write an event or log which already has its base fields set"""
+        raise NotImplementedError('Implemented by subclasses')
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+
+class StdoutEventSink(EventSink):
+    """Writes events and logs to stdout (the default for local workflows)"""
+
+    def event_out(self, event):
+        stdout_event_out(event)
+
+    def log_out(self, log):
+        stdout_log_out(log)
+
+    def write(self, item):
+        sys.stdout.write('{0}\n'.format(create_event_message_prefix(item)))
+
+    def flush(self):
+        sys.stdout.flush()
+
+
+class NullEventSink(EventSink):
+    """Discards all events and logs"""
+
+    def event_out(self, event):
+        pass
+
+    def log_out(self, log):
+        pass
+
+    def write(self, item):
+        pass
+
+
+class MemoryEventSink(EventSink):
+    """
+    Keeps the last ``capacity`` events and logs in memory.
+
+    :param capacity: Maximum number of items to keep (unbounded if None)
+    """
+
+    def __init__(self, capacity=None):
+        self._items = collections.deque(maxlen=capacity)
+
+    def write(self, item):
+        self._items.append(item)
+
+    @property
+    def items(self):
+        """All kept events and logs, oldest first"""
+        return list(self._items)
+
+    @property
+    def events(self):
+        return [item for item in self._items
+                if item['type'] == 'cloudify_event']
+
+    @property
+    def logs(self):
+        return [item for item in self._items
+                if item['type'] == 'cloudify_log']
+
+    def clear(self):
+        self._items.clear()
+
+
+class JsonLinesFileEventSink(EventSink):
+    """
+    Appends events and logs to a file, one JSON document per line.
+    Writes are buffered in memory and flushed every ``buffer_size`` items
+    and on ``flush``/``close``.
+
+    :param path: The file path
+    :param buffer_size: Number of items to buffer before writing to the file
+    """
+
+    def __init__(self, path, buffer_size=100):
+        self.path = path
+        self.buffer_size = buffer_size
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._file = open(path, 'a')
+
+    def write(self, item):
+        line = json.dumps(item)
+        with self._lock:
+            self._buffer.append(line)
+            if len(self._buffer) >= self.buffer_size:
+                self._flush_buffer()
+
+    def flush(self):
+        with self._lock:
+            self._flush_buffer()
+
+    def close(self):
+        with self._lock:
+            if self._file.closed:
+                return
+            self._flush_buffer()
+            self._file.close()
+
+    def _flush_buffer(self):
+        if self._buffer:
+            self._file.write('\n'.join(self._buffer))
+            self._file.write('\n')
+            self._buffer = []
+        self._file.flush()
+
+
+class FanOutEventSink(EventSink):
+    """
+    Writes each event and log to all of the provided sinks.
+
+    :param sinks: EventSink instances
+    """
+
+    def __init__(self, *sinks):
+        self.sinks = sinks
+
+    def write(self, item):
+        for sink in self.sinks:
+            sink.write(item)
+
+    def flush(self):
+        for sink in self.sinks:
+            sink.flush()
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+
 def create_event_message_prefix(event):
     context = event['context']
     deployment_id = context['deployment_id']
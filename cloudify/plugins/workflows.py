@@ -19,11 +19,7 @@ from cloudify.workflows import tasks as workflow_tasks
 
 
 def _get_all_nodes_instances(ctx):
-    node_instances = set()
-    for node in ctx.nodes:
-        for instance in node.instances:
-            node_instances.add(instance)
-    return node_instances
+    return set(ctx.node_instances)
 
 
 class InstallationTasksReferences(object):
@@ -366,7 +362,7 @@ def _relationship_operations_with_target(relationship, operation):
 
 
 def _is_host_node(node_instance):
-    return 'cloudify.nodes.Compute' in node_instance.node.type_hierarchy
+    return node_instance.node.is_derived_from('cloudify.nodes.Compute')
 
 
 def _wait_for_host_to_start(host_node_instance):
@@ -461,11 +457,11 @@ def execute_operation(ctx, operation, operation_kwargs, allow_kwargs_override,
 
     # filtering node instances
     filtered_node_instances = []
+    typed_nodes = ctx.get_nodes_by_type(type_names) if type_names else None
     for node in ctx.nodes:
         if node_ids and node.id not in node_ids:
             continue
-        if type_names and not next((type_name for type_name in type_names if
-                                    type_name in node.type_hierarchy), None):
+        if typed_nodes is not None and node not in typed_nodes:
             continue
 
         for instance in node.instances:
@@ -585,11 +581,8 @@ def auto_heal_reinstall_node_subgraph(
 
     ctx.logger.info("Starting 'heal' workflow on {0}, Diagnosis: {1}"
                     .format(node_instance_id, diagnose_value))
-    failing_node = ctx.get_node_instance(node_instance_id)
-    failing_node_host = ctx.get_node_instance(
-        failing_node._node_instance.host_id
-    )
-    subgraph_node_instances = failing_node_host.get_contained_subgraph()
+    failing_node_host = ctx.get_host_node_instance(node_instance_id)
+    subgraph_node_instances = ctx.get_contained_subgraph(failing_node_host.id)
     intact_nodes = _get_all_nodes_instances(ctx) - subgraph_node_instances
     _uninstall_node_instances(
         ctx,
@@ -14,11 +14,14 @@
 #  * See the License for the specific language governing permissions and
 #  * limitations under the License.
 
+# ctx is invoked in a new process for every call made by a script, so
+# modules that are only needed by some of the calls are imported where
+# they are used. benchmarks/ctx_client_startup.py profiles the imports.
 import os
-import urllib2
+import atexit
 import json
-import argparse
 import sys
+import threading
 
 
 # Environment variable for the socket url
@@ -37,45 +40,97 @@ class RequestError(RuntimeError):
         self.ex_traceback = ex_traceback
 
 
+# connections are reused by later requests of the same thread
+_connections = threading.local()
+
+
+def _cached_connections():
+    connections = getattr(_connections, 'connections', None)
+    if connections is None:
+        connections = _connections.connections = {}
+    return connections
+
+
+@atexit.register
+def _close_connections():
+    for socket_url in _cached_connections().keys():
+        _close_connection(socket_url)
+
+
+def _close_connection(socket_url):
+    connection = _cached_connections().pop(socket_url, None)
+    if connection is not None:
+        connection.close()
+
+
 def zmq_client_req(socket_url, request, timeout):
     import zmq
-    context = zmq.Context()
-    sock = context.socket(zmq.REQ)
-    try:
+    connections = _cached_connections()
+    sock = connections.get(socket_url)
+    if sock is None:
+        sock = zmq.Context.instance().socket(zmq.REQ)
+        sock.setsockopt(zmq.LINGER, 0)
         sock.connect(socket_url)
+        connections[socket_url] = sock
+    try:
         sock.send_json(request)
         if sock.poll(1000*timeout):
             return sock.recv_json()
         else:
             raise RuntimeError('Timed out while waiting for response')
-    finally:
-        sock.close()
-        context.term()
+    except Exception:
+        # a REQ socket cannot send again before it received a reply
+        _close_connection(socket_url)
+        raise
 
 
 def http_client_req(socket_url, request, timeout):
-    response = urllib2.urlopen(socket_url,
-                               data=json.dumps(request),
-                               timeout=timeout)
-    if response.code != 200:
-        raise RuntimeError('Requeste failed: {0}'.format(response))
-    return json.loads(response.read())
+    import httplib
+    import socket
+    import urlparse
+    connections = _cached_connections()
+    body = json.dumps(request)
+    while True:
+        connection = connections.get(socket_url)
+        reused = connection is not None
+        if not reused:
+            url = urlparse.urlparse(socket_url)
+            connection = httplib.HTTPConnection(url.hostname, url.port,
+                                                timeout=timeout)
+            connections[socket_url] = connection
+        elif connection.sock is not None:
+            connection.sock.settimeout(timeout)
+        connection.timeout = timeout
+        try:
+            connection.request('POST', '/', body,
+                               {'content-type': 'application/json'})
+            response = connection.getresponse()
+            data = response.read()
+        except (httplib.HTTPException, socket.error), e:
+            _close_connection(socket_url)
+            # the server may have closed an idle kept alive connection
+            if reused and not isinstance(e, socket.timeout):
+                continue
+            raise
+        if response.will_close:
+            _close_connection(socket_url)
+        if response.status != 200:
+            raise RuntimeError('Request failed: {0} {1}'
+                               .format(response.status, response.reason))
+        return json.loads(data)
 
 
-def client_req(socket_url, args, timeout=5):
-    request = {
-        'args': args
-    }
-
+def _request_method(socket_url):
     schema, _ = socket_url.split('://')
     if schema in ['ipc', 'tcp']:
-        request_method = zmq_client_req
+        return zmq_client_req
     elif schema in ['http']:
-        request_method = http_client_req
+        return http_client_req
     else:
         raise RuntimeError('Unsupported protocol: {0}'.format(schema))
 
-    response = request_method(socket_url, request, timeout)
+
+def _response_payload(response):
     payload = response['payload']
     if response.get('type') == 'error':
         ex_type = payload['type']
@@ -88,12 +143,46 @@ def client_req(socket_url, args, timeout=5):
         return payload
 
 
+def client_req(socket_url, args, timeout=5):
+    request = {
+        'args': args
+    }
+    request_method = _request_method(socket_url)
+    response = request_method(socket_url, request, timeout)
+    return _response_payload(response)
+
+
+def client_batch_req(socket_url, args_list, timeout=5):
+    """Sends several requests in a single round trip.
+
+    Returns a list with the payload of each request, or the
+    ``RequestError`` of requests that failed.
+    """
+    request = {
+        'batch': args_list
+    }
+    request_method = _request_method(socket_url)
+    response = request_method(socket_url, request, timeout)
+    results = []
+    for item in _response_payload(response):
+        try:
+            results.append(_response_payload(item))
+        except RequestError, e:
+            results.append(e)
+    return results
+
+
 def parse_args(args=None):
+    import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument('-t', '--timeout', type=int, default=5)
     parser.add_argument('--socket-url', default=os.environ.get(CTX_SOCKET_URL))
     parser.add_argument('--json-arg-prefix', default='@')
     parser.add_argument('-j', '--json-output', action='store_true')
+    parser.add_argument('--stdin', action='store_true',
+                        help='read requests from stdin, one per line, and '
+                             'write their results to stdout, one per line')
+    parser.add_argument('--batch-size', type=int, default=100)
     parser.add_argument('args', nargs='*')
     args = parser.parse_args(args)
     if not args.socket_url:
@@ -111,19 +200,84 @@ def process_args(json_prefix, args):
     return processed_args
 
 
+def format_response(response, json_output):
+    if json_output:
+        return json.dumps(response)
+    if not response:
+        return ''
+    return str(response)
+
+
+def _input_ready(stream):
+    """Returns whether reading from ``stream`` will not wait for its
+    writer. Callers that write a request and wait for its result before
+    writing the next one never fill a batch, so the pending batch is
+    sent whenever no more input is ready.
+    """
+    try:
+        fd = stream.fileno()
+    except (AttributeError, IOError, ValueError):
+        # in-memory streams never wait
+        return True
+    if os.name == 'nt':
+        # select only supports sockets on windows, send every request
+        return False
+    import select
+    return bool(select.select([fd], [], [], 0)[0])
+
+
+def process_stdin(args, stdin=None, stdout=None, stderr=None):
+    """Sends the requests read from ``stdin`` in batches of
+    ``args.batch_size`` and writes one result line per request. Failed
+    requests produce an empty result line and an error on ``stderr``.
+    A batch is sent early when no more input is ready, so interactive
+    callers get the result of each request before writing the next.
+
+    :return: True if all requests succeeded
+    """
+    import shlex
+    stdin = stdin or sys.stdin
+    stdout = stdout or sys.stdout
+    stderr = stderr or sys.stderr
+    succeeded = [True]
+
+    def flush(batch):
+        results = client_batch_req(args.socket_url, batch, args.timeout)
+        for result in results:
+            if isinstance(result, RequestError):
+                succeeded[0] = False
+                stderr.write('{0}: {1}\n'.format(result.ex_type,
+                                                 result.ex_message))
+                result = None
+            stdout.write(format_response(result, args.json_output))
+            stdout.write('\n')
+        stdout.flush()
+
+    batch = []
+    for line in iter(stdin.readline, ''):
+        line = line.strip()
+        if not line:
+            continue
+        batch.append(process_args(args.json_arg_prefix, shlex.split(line)))
+        if len(batch) >= args.batch_size or not _input_ready(stdin):
+            flush(batch)
+            batch = []
+    if batch:
+        flush(batch)
+    return succeeded[0]
+
+
 def main(args=None):
     args = parse_args(args)
+    if args.stdin:
+        if not process_stdin(args):
+            sys.exit(1)
+        return
     response = client_req(args.socket_url,
                           process_args(args.json_arg_prefix,
                                        args.args),
                           args.timeout)
-    if args.json_output:
-        response = json.dumps(response)
-    else:
-        if not response:
-            response = ''
-        response = str(response)
-    sys.stdout.write(response)
+    sys.stdout.write(format_response(response, args.json_output))
 
 
 if __name__ == '__main__':
@@ -22,7 +22,9 @@ import threading
 import socket
 from Queue import Queue
 from StringIO import StringIO
+from SocketServer import ThreadingMixIn
 from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+from wsgiref.simple_server import ServerHandler
 from wsgiref.simple_server import make_server as make_wsgi_server
 
 import bottle
@@ -33,41 +35,72 @@ class CtxProxy(object):
     def __init__(self, ctx, socket_url):
         self.ctx = ctx
         self.socket_url = socket_url
+        self._attributes_cache = {}
 
     def process(self, request):
         try:
             typed_request = json.loads(request)
-            args = typed_request['args']
-            payload = process_ctx_request(self.ctx, args)
+            if not isinstance(typed_request, dict):
+                raise ValueError('Invalid request: {0}'.format(request))
+            batch = typed_request.get('batch')
+            if batch is not None and not isinstance(batch, list):
+                raise ValueError('Invalid batch: {0}'.format(batch))
+        except Exception, e:
+            return self._error(e)
+        if batch is not None:
+            # every request of a batch succeeds or fails on its own
+            return '{{"type": "result", "payload": [{0}]}}'.format(
+                ', '.join(self._process_args(args) for args in batch))
+        return self._process_args(typed_request.get('args'))
+
+    def _process_args(self, args):
+        try:
+            payload = process_ctx_request(self.ctx, args,
+                                          self._attributes_cache)
             result = json.dumps({
                 'type': 'result',
                 'payload': payload
             })
         except Exception, e:
-            tb = StringIO()
-            traceback.print_exc(file=tb)
-            payload = {
-                'type': type(e).__name__,
-                'message': str(e),
-                'traceback': tb.getvalue()
-            }
-            result = json.dumps({
-                'type': 'error',
-                'payload': payload
-            })
+            result = self._error(e)
         return result
 
+    @staticmethod
+    def _error(e):
+        tb = StringIO()
+        traceback.print_exc(file=tb)
+        payload = {
+            'type': type(e).__name__,
+            'message': str(e),
+            'traceback': tb.getvalue()
+        }
+        return json.dumps({
+            'type': 'error',
+            'payload': payload
+        })
+
     def close(self):
         pass
 
 
 class HTTPCtxProxy(CtxProxy):
+    """Serves ctx requests over HTTP.
+
+    Every connection is served by a thread of its own and kept alive
+    between requests (HTTP/1.1). At most ``max_concurrent_requests``
+    requests are processed at the same time, further requests wait for
+    a slot. ``keep_alive_timeout`` is the number of seconds an idle
+    connection is kept open.
+    """
 
-    def __init__(self, ctx, port=None):
+    def __init__(self, ctx, port=None, max_concurrent_requests=10,
+                 keep_alive_timeout=30):
         port = port or get_unused_port()
         socket_url = 'http://localhost:{0}'.format(port)
         super(HTTPCtxProxy, self).__init__(ctx, socket_url)
         self.port = port
+        self.keep_alive_timeout = keep_alive_timeout
+        self._processing = threading.BoundedSemaphore(max_concurrent_requests)
         self._started = Queue(1)
         self.thread = self._start_server()
         self._started.get(timeout=5)
@@ -80,13 +113,73 @@ class HTTPCtxProxy(CtxProxy):
 
             def run(self, app):
 
-                class Server(WSGIServer):
+                class Server(ThreadingMixIn, WSGIServer):
                     allow_reuse_address = True
+                    daemon_threads = True
+
+                    def __init__(self, *args, **kwargs):
+                        WSGIServer.__init__(self, *args, **kwargs)
+                        # kept alive connections, closed with the server
+                        self.connections = set()
+                        self.connections_lock = threading.Lock()
+
+                    def process_request_thread(self, request,
+                                               client_address):
+                        with self.connections_lock:
+                            self.connections.add(request)
+                        try:
+                            ThreadingMixIn.process_request_thread(
+                                self, request, client_address)
+                        finally:
+                            with self.connections_lock:
+                                self.connections.discard(request)
+
+                    def close_connections(self):
+                        with self.connections_lock:
+                            connections = list(self.connections)
+                        for connection in connections:
+                            try:
+                                connection.shutdown(socket.SHUT_RDWR)
+                            except socket.error:
+                                pass
 
                     def handle_error(self, request, client_address):
                         pass
 
+                class KeepAliveServerHandler(ServerHandler):
+                    http_version = '1.1'
+
                 class Handler(WSGIRequestHandler):
+                    protocol_version = 'HTTP/1.1'
+                    timeout = proxy.keep_alive_timeout
+
+                    def setup(self):
+                        WSGIRequestHandler.setup(self)
+                        # responses are written in several small chunks,
+                        # which would otherwise be delayed on kept alive
+                        # connections
+                        self.connection.setsockopt(socket.IPPROTO_TCP,
+                                                   socket.TCP_NODELAY, 1)
+
+                    def handle(self):
+                        self.close_connection = 1
+                        self.handle_one_request()
+                        while not self.close_connection:
+                            self.handle_one_request()
+
+                    def handle_one_request(self):
+                        self.raw_requestline = self.rfile.readline(65537)
+                        if not self.raw_requestline:
+                            self.close_connection = 1
+                            return
+                        if not self.parse_request():
+                            return
+                        handler = KeepAliveServerHandler(
+                            self.rfile, self.wfile, self.get_stderr(),
+                            self.get_environ())
+                        handler.request_handler = self
+                        handler.run(self.server.get_app())
+
                     def address_string(self):
                         return self.client_address[0]
 
@@ -106,10 +199,12 @@ class HTTPCtxProxy(CtxProxy):
                 proxy._started.put(True)
                 self.srv.serve_forever(poll_interval=0.1)
 
-        bottle.post('/', callback=self._request_handler)
+        app = bottle.Bottle()
+        app.post('/', callback=self._request_handler)
 
         def serve():
             bottle.run(
+                app=app,
                 host='localhost',
                 port=self.port,
                 quiet=True,
@@ -122,38 +217,94 @@ class HTTPCtxProxy(CtxProxy):
     def close(self):
         self.server.shutdown()
         self.server.server_close()
+        self.server.close_connections()
 
     def _request_handler(self):
         request = bottle.request.body.read()
-        response = self.process(request)
+        with self._processing:
+            response = self.process(request)
         return bottle.LocalResponse(
             body=response,
             status=200,
-            headers={'content-type': 'application/json'})
+            headers={'content-type': 'application/json',
+                     'content-length': str(len(response))})
 
 
 class ZMQCtxProxy(CtxProxy):
+    """Serves ctx requests over a zmq ROUTER socket.
 
-    def __init__(self, ctx, socket_url):
+    ``poll_and_process`` receives requests and sends replies on the
+    calling thread, while the requests themselves are processed by a
+    pool of ``workers`` threads, so a slow request does not hold back
+    requests of other clients.
+    """
+
+    def __init__(self, ctx, socket_url, workers=5):
         super(ZMQCtxProxy, self).__init__(ctx, socket_url)
         import zmq
         self.z_context = zmq.Context(io_threads=1)
-        self.sock = self.z_context.socket(zmq.REP)
+        self.sock = self.z_context.socket(zmq.ROUTER)
         self.sock.bind(self.socket_url)
+        # workers push their replies to the polling thread, the only one
+        # allowed to use the router socket
+        self._replies_url = 'inproc://ctx-proxy-replies-{0}'.format(id(self))
+        self._replies = self.z_context.socket(zmq.PULL)
+        self._replies.bind(self._replies_url)
         self.poller = zmq.Poller()
         self.poller.register(self.sock, zmq.POLLIN)
+        self.poller.register(self._replies, zmq.POLLIN)
+        self._requests = Queue()
+        self._workers = []
+        for _ in range(workers):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def _work(self):
+        import zmq
+        replies = self.z_context.socket(zmq.PUSH)
+        replies.setsockopt(zmq.LINGER, 0)
+        replies.connect(self._replies_url)
+        try:
+            while True:
+                request = self._requests.get()
+                if request is None:
+                    return
+                envelope, body = request
+                replies.send_multipart(envelope + [self.process(body)])
+        finally:
+            replies.close()
 
     def poll_and_process(self, timeout=1):
         import zmq
-        state = dict(self.poller.poll(1000*timeout)).get(self.sock)
-        if not state == zmq.POLLIN:
-            return False
-        request = self.sock.recv()
-        response = self.process(request)
-        self.sock.send(response)
-        return True
+        events = dict(self.poller.poll(1000*timeout))
+        processed = False
+        if events.get(self._replies) == zmq.POLLIN:
+            while True:
+                try:
+                    reply = self._replies.recv_multipart(zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+                self.sock.send_multipart(reply)
+                processed = True
+        if events.get(self.sock) == zmq.POLLIN:
+            while True:
+                try:
+                    message = self.sock.recv_multipart(zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+                # [client identity, empty delimiter, request]
+                self._requests.put((message[:-1], message[-1]))
+                processed = True
+        return processed
 
     def close(self):
+        for _ in self._workers:
+            self._requests.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._replies.close()
         self.sock.close()
         self.z_context.term()
 
@@ -183,13 +334,23 @@ class StubCtxProxy(object):
         pass
 
 
-def process_ctx_request(ctx, args):
+_NOT_AN_ATTRIBUTE = object()
+
+
+def process_ctx_request(ctx, args, attributes_cache=None):
+    """Processes a ctx request.
+
+    :param attributes_cache: a dict, kept between requests to the same
+                             ctx, in which the attributes the leading
+                             args resolve to are cached by args prefix
+    """
     current = ctx
     num_args = len(args)
     index = 0
     while index < num_args:
         arg = args[index]
-        desugared_attr = _desugar_attr(current, arg)
+        desugared_attr = _desugar_cached_attr(current, args, index,
+                                              attributes_cache)
         if desugared_attr:
             current = getattr(current, desugared_attr)
         elif isinstance(current, collections.MutableMapping):
@@ -225,6 +386,21 @@ def process_ctx_request(ctx, args):
     return current
 
 
+def _desugar_cached_attr(obj, args, index, attributes_cache):
+    arg = args[index]
+    if attributes_cache is None or not isinstance(arg, basestring):
+        return _desugar_attr(obj, arg)
+    # all previous args were resolved as attributes, hence strings
+    key = tuple(args[:index + 1])
+    desugared_attr = attributes_cache.get(key)
+    if desugared_attr is _NOT_AN_ATTRIBUTE:
+        return None
+    if desugared_attr is None or not hasattr(obj, desugared_attr):
+        desugared_attr = _desugar_attr(obj, arg)
+        attributes_cache[key] = desugared_attr or _NOT_AN_ATTRIBUTE
+    return desugared_attr
+
+
 def _desugar_attr(obj, attr):
     if not isinstance(attr, basestring):
         return None
@@ -240,9 +416,32 @@ class PathDictAccess(object):
 
     pattern = re.compile("(.+)\[(\d+)\]")
 
+    # compiled paths by path, shared by all instances
+    _compiled_paths = {}
+    _compiled_paths_limit = 1000
+
     def __init__(self, obj):
         self.obj = obj
 
+    @classmethod
+    def _compile(cls, prop_path):
+        """Returns the (property name, list index or None) segments of
+        ``prop_path``."""
+        compiled = cls._compiled_paths.get(prop_path)
+        if compiled is None:
+            compiled = []
+            for prop_segment in prop_path.split('.'):
+                match = cls.pattern.match(prop_segment)
+                if match:
+                    compiled.append((match.group(1), int(match.group(2))))
+                else:
+                    compiled.append((prop_segment, None))
+            compiled = tuple(compiled)
+            if len(cls._compiled_paths) >= cls._compiled_paths_limit:
+                cls._compiled_paths.clear()
+            cls._compiled_paths[prop_path] = compiled
+        return compiled
+
     def set(self, prop_path, value):
         obj, prop_name = self._get_parent_obj_prop_name_by_path(prop_path)
         obj[prop_name] = value
@@ -253,29 +452,24 @@ class PathDictAccess(object):
 
     def _get_object_by_path(self, prop_path):
         current = self.obj
-        for prop_segment in prop_path.split('.'):
-            match = self.pattern.match(prop_segment)
-            if match:
-                index = int(match.group(2))
-                property_name = match.group(1)
+        for property_name, index in self._compile(prop_path):
+            if index is not None:
                 if property_name not in current:
                     self._raise_illegal(prop_path)
                 if type(current[property_name]) != list:
                     self._raise_illegal(prop_path)
                 current = current[property_name][index]
             else:
-                if prop_segment not in current:
-                    current[prop_segment] = {}
-                current = current[prop_segment]
+                if property_name not in current:
+                    current[property_name] = {}
+                current = current[property_name]
         return current
 
     def _get_parent_obj_prop_name_by_path(self, prop_path):
-        split = prop_path.split('.')
-        if len(split) == 1:
+        if '.' not in prop_path:
             return self.obj, prop_path
-        parent_path = '.'.join(split[:-1])
+        parent_path, _, prop_name = prop_path.rpartition('.')
         parent_obj = self._get_object_by_path(parent_path)
-        prop_name = split[-1]
         return parent_obj, prop_name
 
     @staticmethod
@@ -0,0 +1,106 @@
+########
+# Copyright (c) 2015 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+
+import time
+import threading
+
+import testtools
+from mock import MagicMock
+
+from cloudify.workflows import api
+from cloudify.workflows import tasks
+
+
+class CancellationTokenTest(testtools.TestCase):
+
+    def setUp(self):
+        super(CancellationTokenTest, self).setUp()
+        api.cancellation_token.reset()
+        self.addCleanup(api.cancellation_token.reset)
+
+    def _cancel_later(self, delay=0.2):
+        timer = threading.Timer(delay, api.cancellation_token.cancel)
+        timer.start()
+        self.addCleanup(timer.cancel)
+
+    def test_check_does_not_consume(self):
+        self.assertFalse(api.has_cancel_request())
+        api.cancellation_token.cancel()
+        self.assertTrue(api.has_cancel_request())
+        self.assertTrue(api.has_cancel_request())
+        api.cancellation_token.reset()
+        self.assertFalse(api.has_cancel_request())
+
+    def test_callbacks(self):
+        calls = []
+        token = api.CancellationToken()
+        token.add_callback(lambda: calls.append('first'))
+
+        def removed():
+            calls.append('removed')
+        token.add_callback(removed)
+        token.remove_callback(removed)
+        token.cancel()
+        token.cancel()
+        self.assertEqual(['first'], calls)
+        # registering after the fact calls back right away
+        token.add_callback(lambda: calls.append('late'))
+        self.assertEqual(['first', 'late'], calls)
+
+    def test_wait_for_terminated_is_woken_up(self):
+        task = tasks.WorkflowTask(MagicMock())
+        self._cancel_later()
+        started = time.time()
+        self.assertRaises(tasks.Queue.Empty, task.wait_for_terminated, 30)
+        self.assertLess(time.time() - started, 10)
+        self.assertEqual([], api.cancellation_token._callbacks)
+
+    def test_task_result_get_is_woken_up(self):
+        task = tasks.WorkflowTask(MagicMock())
+        task.workflow_context.internal.graph_mode = False
+        self._cancel_later()
+        started = time.time()
+        self.assertRaises(api.ExecutionCancelled,
+                          tasks.WorkflowTaskResult(task).get)
+        self.assertLess(time.time() - started, 10)
+
+    def test_sleep_is_woken_up(self):
+        result = tasks.WorkflowTaskResult(MagicMock())
+        self._cancel_later()
+        started = time.time()
+        self.assertRaises(api.ExecutionCancelled, result._sleep, 30)
+        self.assertLess(time.time() - started, 10)
+
+    def test_terminated_task(self):
+        task = tasks.WorkflowTask(MagicMock())
+        threading.Timer(0.1, task.set_state, [tasks.TASK_SUCCEEDED]).start()
+        task.wait_for_terminated(timeout=30)
+        self.assertTrue(task.is_terminated)
+
+    def test_task_result_get_waits_with_timeout(self):
+        task = tasks.WorkflowTask(MagicMock())
+        task.workflow_context.internal.graph_mode = False
+        timeouts = []
+
+        def wait_for_terminated(timeout=None):
+            timeouts.append(timeout)
+            if len(timeouts) == 3:
+                api.cancellation_token.cancel()
+            raise tasks.Queue.Empty()
+        task.wait_for_terminated = wait_for_terminated
+        self.assertRaises(api.ExecutionCancelled,
+                          tasks.WorkflowTaskResult(task).get)
+        self.assertEqual([tasks.TASK_TERMINATED_POLL_INTERVAL] * 3, timeouts)
@@ -14,17 +14,25 @@
 #    * limitations under the License.
 
 
+import Queue
+import time
+from threading import Event
+
 import testtools
 
-from mock import patch
+from mock import patch, MagicMock
 
 from cloudify import ctx as ctx_proxy
 from cloudify import manager
 from cloudify import decorators
 from cloudify.decorators import operation, workflow
 from cloudify import context
-from cloudify.exceptions import NonRecoverableError, ProcessExecutionError
+from cloudify.exceptions import (NonRecoverableError,
+                                 ProcessExecutionError,
+                                 RecoverableError)
+from cloudify.workflows import local
 from cloudify.workflows import workflow_context
+from cloudify_rest_client.executions import Execution
 
 import cloudify.tests.mocks.mock_rest_client as rest_client_mock
 
@@ -55,6 +63,38 @@ def some_operation(**kwargs):
     return ctx
 
 
+@operation
+def reply_operation(fail=False, **kwargs):
+    if fail:
+        raise RuntimeError('operation failed')
+    return 'result'
+
+
+@operation
+def mutating_operation(inputs, **kwargs):
+    inputs['nested']['value'] = 'changed'
+    inputs['list'].append('item')
+    inputs['nested'].setdefault('new', {})['key'] = 'value'
+    return inputs
+
+
+@operation
+def dict_protocol_mutating_operation(inputs, **kwargs):
+    dict(inputs)['nested']['dict'] = 'changed'
+    updated = {}
+    updated.update(inputs)
+    updated['nested']['update'] = 'changed'
+
+    def unpack(nested, **_):
+        nested['unpacked'] = 'changed'
+    unpack(**inputs)
+
+
+@operation(copy_kwargs=False)
+def not_copying_operation(inputs, **kwargs):
+    inputs['nested']['value'] = 'changed'
+
+
 @workflow
 def error_workflow(ctx, picklable=False, **_):
     if picklable:
@@ -188,3 +228,243 @@ class OperationTest(testtools.TestCase):
             }}
             some_operation(**kwargs)
             self.assertEqual(2, mock_update.call_count)
+
+    def test_task_reply(self):
+        replies = []
+        kwargs = {'__cloudify_context': {
+            'task_id': 'task-id',
+            'task_target': 'queue',
+            'task_reply_queue': 'reply-queue'
+        }}
+        with patch('cloudify.logs.amqp_log_out'):
+            with patch('cloudify.decorators.amqp_task_reply_out',
+                       lambda *args: replies.append(args)):
+                reply_operation(**kwargs)
+                self.assertRaises(RecoverableError, reply_operation,
+                                  fail=True, **kwargs)
+        self.assertEqual(({'task_id': 'task-id', 'result': 'result'},
+                          'reply-queue'), replies[0])
+        error = replies[1][0]['error']
+        self.assertEqual('RecoverableError', error['type'])
+        self.assertEqual('RuntimeError: operation failed', error['message'])
+
+    def test_kwargs_copy(self):
+        inputs = {'nested': {'value': 'original'},
+                  'list': [{'a': 1}],
+                  'tuple': ({'b': 2},)}
+        result = mutating_operation(inputs=inputs,
+                                    __cloudify_context={})
+        self.assertEqual({'nested': {'value': 'original'},
+                          'list': [{'a': 1}],
+                          'tuple': ({'b': 2},)}, inputs)
+        self.assertEqual({'value': 'changed', 'new': {'key': 'value'}},
+                         result['nested'])
+        self.assertEqual([{'a': 1}, 'item'], result['list'])
+        self.assertIsNot(inputs['tuple'][0], result['tuple'][0])
+
+    def test_kwargs_copy_dict_protocol(self):
+        inputs = {'nested': {'value': 'original'}}
+        dict_protocol_mutating_operation(inputs=inputs,
+                                         __cloudify_context={})
+        self.assertEqual({'nested': {'value': 'original'}}, inputs)
+
+    def test_kwargs_copy_of_storage_snapshots(self):
+        inputs = local._freeze({'nested': {'value': 'original'},
+                                'list': [{'a': 1}]})
+        with patch('copy.deepcopy', side_effect=AssertionError):
+            result = mutating_operation(inputs=inputs,
+                                        __cloudify_context={})
+        self.assertIs(dict, type(result))
+        self.assertEqual({'value': 'changed', 'new': {'key': 'value'}},
+                         result['nested'])
+        self.assertEqual([{'a': 1}, 'item'], result['list'])
+        self.assertEqual({'value': 'original'}, inputs['nested'])
+
+    def test_kwargs_copy_opt_out(self):
+        inputs = {'nested': {'value': 'original'}}
+        not_copying_operation(inputs=inputs, __cloudify_context={})
+        self.assertEqual('changed', inputs['nested']['value'])
+
+
+class RemoteWorkflowCancelTest(testtools.TestCase):
+
+    def _wait(self, child_queue, statuses, subscribed=None):
+        ctx = MagicMock(execution_id='execution-id')
+        rest = MagicMock()
+        rest.executions.get.side_effect = \
+            lambda execution_id: MagicMock(status=statuses.pop(0))
+        if subscribed is None:
+            subscribed = Event()
+            subscribed.set()
+        self.addCleanup(decorators.api.cancellation_token.reset)
+        result, _ = decorators._wait_for_workflow_thread(
+            ctx, rest, child_queue, subscribed)
+        return result, rest
+
+    def _get_timeouts(self, child_queue, statuses, subscribed=None):
+        # a frozen clock makes the timeouts equal to the poll intervals
+        with patch.object(decorators, 'CANCEL_POLL_INTERVAL', 0.01), \
+                patch.object(decorators, 'time',
+                             MagicMock(**{'time.return_value': 0})):
+            result, _ = self._wait(child_queue, statuses, subscribed)
+        self.assertEqual('done', result)
+        return [call[1]['timeout'] for call in child_queue.get.call_args_list]
+
+    def test_control_message_checks_status_immediately(self):
+        child_queue = Queue.Queue()
+        child_queue.put({'control': {'action': 'cancel'}})
+        child_queue.put({'control': {'action': 'force-cancel'}})
+        with patch.object(decorators, 'CANCEL_POLL_INTERVAL', 3600):
+            result, rest = self._wait(
+                child_queue, [Execution.CANCELLING,
+                              Execution.FORCE_CANCELLING])
+        self.assertEqual(2, rest.executions.get.call_count)
+        self.assertTrue(decorators.api.has_cancel_request())
+        self.assertEqual(decorators.api.EXECUTION_CANCELLED_RESULT, result)
+
+    def test_poll_interval_backs_off_while_subscribed(self):
+        child_queue = MagicMock()
+        child_queue.get.side_effect = [Queue.Empty(), Queue.Empty(),
+                                       Queue.Empty(), {'result': 'done'}]
+        timeouts = self._get_timeouts(child_queue, [Execution.STARTED] * 3)
+        self.assertEqual([0.01, 0.02, 0.04, 0.08], timeouts)
+
+    def test_poll_interval_resets_when_consumer_dies(self):
+        subscribed = Event()
+        subscribed.set()
+        replies = [Queue.Empty(), Queue.Empty(), {'control': None},
+                   Queue.Empty(), {'result': 'done'}]
+
+        def get(timeout):
+            reply = replies.pop(0)
+            if reply == {'control': None}:
+                subscribed.clear()
+            if isinstance(reply, Exception):
+                raise reply
+            return reply
+        child_queue = MagicMock()
+        child_queue.get.side_effect = get
+        timeouts = self._get_timeouts(child_queue, [Execution.STARTED] * 4,
+                                      subscribed)
+        self.assertEqual([0.01, 0.02, 0.04, 0.01, 0.01], timeouts)
+
+    def test_force_cancel_revokes_before_marking_cancelled(self):
+        calls = MagicMock()
+        ctx = MagicMock(execution_id='execution-id')
+        ctx.internal.revoke_remote_tasks = calls.revoke_remote_tasks
+        rest = MagicMock()
+        rest.executions.get.return_value = MagicMock(
+            status=Execution.STARTED)
+        execution = MagicMock(status=Execution.FORCE_CANCELLING)
+        with patch.object(decorators, 'get_rest_client',
+                          return_value=rest), \
+                patch.object(decorators, 'update_execution_status',
+                             calls.update_execution_status), \
+                patch.object(decorators, 'Thread'), \
+                patch.object(decorators, '_send_workflow_started_event'), \
+                patch.object(decorators, '_send_workflow_cancelled_event'), \
+                patch.object(decorators, '_consume_execution_control',
+                             return_value=None), \
+                patch.object(decorators, '_wait_for_workflow_thread',
+                             return_value=(
+                                 decorators.api.EXECUTION_CANCELLED_RESULT,
+                                 execution)):
+            self.assertRaises(decorators.RequestSystemExit,
+                              decorators._remote_workflow,
+                              ctx, None, (), {})
+        self.assertEqual(
+            ['update_execution_status', 'revoke_remote_tasks',
+             'update_execution_status'],
+            [call[0] for call in calls.mock_calls])
+        self.assertEqual({'terminate': True, 'timeout': 0},
+                         calls.revoke_remote_tasks.call_args[1])
+        self.assertEqual(('execution-id', Execution.CANCELLED),
+                         calls.update_execution_status.call_args[0])
+
+    def test_cancel_revokes_without_waiting(self):
+        ctx = MagicMock(execution_id='execution-id')
+        rest = MagicMock()
+        rest.executions.get.return_value = MagicMock(
+            status=Execution.STARTED)
+        execution = MagicMock(status=Execution.CANCELLING)
+
+        def run_now(target):
+            target()
+            return MagicMock()
+
+        def wait_for_workflow_thread(ctx, rest, child_queue, subscribed):
+            return child_queue.get_nowait()['result'], execution
+        with patch.object(decorators, 'get_rest_client',
+                          return_value=rest), \
+                patch.object(decorators, 'update_execution_status'), \
+                patch.object(decorators, 'Thread', side_effect=run_now), \
+                patch.object(decorators, '_send_workflow_started_event'), \
+                patch.object(decorators, '_send_workflow_cancelled_event'), \
+                patch.object(decorators, '_consume_execution_control',
+                             return_value=None), \
+                patch.object(decorators, '_execute_workflow_function',
+                             side_effect=decorators.api.ExecutionCancelled), \
+                patch.object(decorators, '_wait_for_workflow_thread',
+                             side_effect=wait_for_workflow_thread):
+            self.assertEqual(decorators.api.EXECUTION_CANCELLED_RESULT,
+                             decorators._remote_workflow(ctx, None, (), {}))
+        ctx.internal.revoke_remote_tasks.assert_called_once_with(timeout=0)
+
+    def test_subscribes_only_to_published_control_messages(self):
+        for execution_control in [False, True]:
+            ctx = MagicMock(execution_id='execution-id',
+                            execution_control=execution_control)
+            rest = MagicMock()
+            rest.executions.get.return_value = MagicMock(
+                status=Execution.STARTED)
+            with patch.object(decorators, 'get_rest_client',
+                              return_value=rest), \
+                    patch.object(decorators, 'update_execution_status'), \
+                    patch.object(decorators, 'Thread'), \
+                    patch.object(decorators,
+                                 '_send_workflow_started_event'), \
+                    patch.object(decorators,
+                                 '_send_workflow_succeeded_event'), \
+                    patch.object(decorators, '_consume_execution_control',
+                                 return_value=None) as consume, \
+                    patch.object(decorators, '_wait_for_workflow_thread',
+                                 return_value=('done', None)):
+                self.assertEqual('done', decorators._remote_workflow(
+                    ctx, None, (), {}))
+            self.assertEqual(execution_control, consume.called)
+
+    def test_consumer_death_clears_subscribed(self):
+        closed = Event()
+        consumer = MagicMock()
+        consumer.consume.side_effect = RuntimeError('connection lost')
+        consumer.close.side_effect = closed.set
+        messages = Queue.Queue()
+        subscribed = Event()
+        with patch('cloudify.amqp_client.AMQPExecutionControlConsumer',
+                   return_value=consumer):
+            stop = decorators._consume_execution_control(
+                'execution-id', messages, subscribed)
+        self.assertIsNotNone(stop)
+        self.assertEqual({'control': None}, messages.get(timeout=5))
+        self.assertFalse(subscribed.is_set())
+        self.assertTrue(closed.wait(5))
+
+    def test_stopped_consumer_does_not_wake_waiter(self):
+        def consume(should_stop):
+            while not should_stop():
+                time.sleep(0.01)
+        closed = Event()
+        consumer = MagicMock()
+        consumer.consume.side_effect = consume
+        consumer.close.side_effect = closed.set
+        messages = Queue.Queue()
+        subscribed = Event()
+        with patch('cloudify.amqp_client.AMQPExecutionControlConsumer',
+                   return_value=consumer):
+            stop = decorators._consume_execution_control(
+                'execution-id', messages, subscribed)
+        self.assertTrue(subscribed.is_set())
+        stop()
+        self.assertTrue(closed.wait(5))
+        self.assertFalse(subscribed.is_set())
+        self.assertTrue(messages.empty())
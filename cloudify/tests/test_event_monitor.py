@@ -0,0 +1,234 @@
+########
+# Copyright (c) 2015 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+
+import threading
+
+import testtools
+from mock import patch, MagicMock
+
+from cloudify import exceptions
+from cloudify.workflows import events
+from cloudify.workflows import tasks
+from cloudify.workflows import workflow_context
+
+
+class _RemoteTask(tasks.WorkflowTask):
+
+    name = 'remote_task'
+    target = 'agent'
+    cloudify_context = None
+
+    def is_local(self):
+        return False
+
+
+class EventMonitorTest(testtools.TestCase):
+
+    def setUp(self):
+        super(EventMonitorTest, self).setUp()
+        self.sent = []
+        patcher = patch('cloudify.workflows.events.'
+                        'send_task_event_func_remote',
+                        lambda task, event_type, **_: self.sent.append(
+                            (task.id, event_type)))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.monitor = events.Monitor(MagicMock())
+        self.monitor._start_dispatcher()
+
+    def _stop(self):
+        self.monitor.stop()
+        self.monitor._dispatcher.join(10)
+
+    def test_dispatch(self):
+        task = _RemoteTask(MagicMock())
+        self.monitor.add_task(task)
+        self.monitor.task_started({'uuid': task.id})
+        self.monitor.task_succeeded({'uuid': task.id, 'result': None})
+        task.wait_for_terminated(timeout=10)
+        self._stop()
+        self.assertEqual(tasks.TASK_SUCCEEDED, task.get_state())
+        self.assertEqual([(task.id, 'task_started'),
+                          (task.id, 'task_succeeded')], self.sent)
+        self.assertEqual({}, self.monitor._tasks)
+
+    def test_unknown_tasks_are_ignored(self):
+        task = _RemoteTask(MagicMock())
+        self.monitor.task_started({'uuid': task.id})
+        self.monitor.task_failed({'uuid': task.id, 'exception': 'error'})
+        self._stop()
+        self.assertEqual(tasks.TASK_PENDING, task.get_state())
+        self.assertEqual([], self.sent)
+
+    def test_rescheduled(self):
+        task = _RemoteTask(MagicMock())
+        self.monitor.add_task(task)
+        self.monitor.task_failed({'uuid': task.id,
+                                  'exception': 'OperationRetry: later'})
+        self._stop()
+        self.assertEqual(tasks.TASK_RESCHEDULED, task.get_state())
+        self.assertEqual([(task.id, 'task_rescheduled')], self.sent)
+
+    def test_wait_for_drained(self):
+        started = _RemoteTask(MagicMock())
+        queued = _RemoteTask(MagicMock())
+        self.monitor.add_task(started)
+        self.monitor.add_task(queued)
+        self.assertEqual(set([started, queued]),
+                         set(self.monitor.in_flight_tasks()))
+        self.monitor.task_revoked({'uuid': queued.id})
+        self.assertEqual([started.id], self.monitor.wait_for_drained(
+            [started.id, queued.id], timeout=0.01))
+        threading.Timer(0.1, self.monitor.task_succeeded,
+                        [{'uuid': started.id}]).start()
+        self.assertEqual([], self.monitor.wait_for_drained(
+            [started.id, queued.id], timeout=30))
+        self._stop()
+
+    def test_revoke_remote_tasks(self):
+        internal_class = workflow_context.CloudifyWorkflowContextInternal
+        internal = internal_class.__new__(internal_class)
+        internal.workflow_context = MagicMock()
+        internal._event_monitor = self.monitor
+        task = _RemoteTask(MagicMock())
+        self.monitor.add_task(task)
+        revoke_calls = []
+
+        def revoke(task_ids, destination, terminate):
+            revoke_calls.append((task_ids, destination, terminate))
+            for task_id in task_ids:
+                self.monitor.task_revoked({'uuid': task_id})
+        with patch('cloudify.celery.celery.control.revoke', revoke):
+            remaining = internal.revoke_remote_tasks(terminate=True,
+                                                     timeout=30)
+        self._stop()
+        self.assertEqual([], remaining)
+        self.assertEqual([([task.id], ['celery@agent'], True)],
+                         revoke_calls)
+
+    def test_revoke_remote_tasks_without_waiting(self):
+        internal_class = workflow_context.CloudifyWorkflowContextInternal
+        internal = internal_class.__new__(internal_class)
+        internal.workflow_context = MagicMock()
+        internal._event_monitor = self.monitor
+        task = _RemoteTask(MagicMock())
+        self.monitor.add_task(task)
+        with patch('cloudify.celery.celery.control.revoke') as revoke, \
+                patch.object(self.monitor, 'wait_for_drained') as wait:
+            remaining = internal.revoke_remote_tasks(terminate=True,
+                                                     timeout=0)
+        self._stop()
+        self.assertEqual([task.id], remaining)
+        self.assertTrue(revoke.call_args[1]['terminate'])
+        self.assertFalse(wait.called)
+        self.assertFalse(internal.workflow_context.logger.warning.called)
+
+    def test_revoke_tasks_batches(self):
+        revoke = MagicMock()
+        agent_tasks = [_RemoteTask(MagicMock()) for _ in range(5)]
+        other_task = _RemoteTask(MagicMock())
+        other_task.target = 'other'
+        with patch('cloudify.celery.celery.control.revoke', revoke):
+            tasks.revoke_tasks(agent_tasks + [other_task], batch_size=2)
+        calls = sorted((c[0][0], c[1]['destination'])
+                       for c in revoke.call_args_list)
+        self.assertEqual(sorted([
+            ([t.id for t in agent_tasks[0:2]], ['celery@agent']),
+            ([t.id for t in agent_tasks[2:4]], ['celery@agent']),
+            ([agent_tasks[4].id], ['celery@agent']),
+            ([other_task.id], ['celery@other'])]), calls)
+        self._stop()
+
+
+class ReplyQueueMonitorTest(testtools.TestCase):
+
+    def test_task_replies(self):
+        sent = []
+        with patch('cloudify.workflows.events.send_task_event_func_remote',
+                   lambda task, event_type, **_: sent.append(event_type)):
+            monitor = events.ReplyQueueMonitor(MagicMock(), 'reply-queue')
+            monitor._start_dispatcher()
+            succeeded = _RemoteTask(MagicMock())
+            rescheduled = _RemoteTask(MagicMock())
+            monitor.add_task(succeeded)
+            monitor.add_task(rescheduled)
+            monitor.task_reply(tasks.build_task_reply(succeeded.id,
+                                                      result={'a': 1}))
+            monitor.task_reply(tasks.build_task_reply(
+                rescheduled.id,
+                error=exceptions.OperationRetry('later', retry_after=3)))
+            monitor.task_reply(tasks.build_task_reply('unknown'))
+            monitor.stop()
+            monitor._dispatcher.join(10)
+        self.assertEqual(['task_succeeded', 'task_rescheduled'], sent)
+        self.assertEqual(tasks.TASK_SUCCEEDED, succeeded.get_state())
+        self.assertEqual(tasks.TASK_RESCHEDULED, rescheduled.get_state())
+        self.assertEqual({'a': 1}, succeeded.reply['result'])
+        error = tasks.task_reply_error(rescheduled.reply)
+        self.assertIsInstance(error, exceptions.OperationRetry)
+        self.assertEqual(3, error.retry_after)
+        self.assertEqual('later [retry_after=3]', str(error))
+
+    def test_task_reply_error_types(self):
+        error = tasks.task_reply_error(tasks.build_task_reply(
+            'id', error=exceptions.HttpException('url', 404, 'missing')))
+        self.assertIsInstance(error, exceptions.NonRecoverableError)
+        self.assertIsNone(tasks.task_reply_error(
+            tasks.build_task_reply('id', result=object())))
+
+    def test_unicode_error_message(self):
+        reply = tasks.build_task_reply(
+            'id', error=exceptions.NonRecoverableError(u'caf\xe9'))
+        self.assertEqual(u'caf\xe9', reply['error']['message'])
+        reply = tasks.build_task_reply(
+            'id', error=exceptions.NonRecoverableError('caf\xc3\xa9'))
+        self.assertEqual(u'caf\xe9', reply['error']['message'])
+
+    def _missing_reply_monitor(self, async_result, reply_timeout=None):
+        monitor = events.ReplyQueueMonitor(MagicMock(), 'reply-queue',
+                                           reply_timeout=reply_timeout)
+        monitor._start_dispatcher()
+        task = _RemoteTask(MagicMock())
+        monitor.add_task(task)
+        with patch('cloudify.workflows.events.'
+                   'REPLY_FALLBACK_CHECK_INTERVAL', 0):
+            with patch('cloudify.celery.celery.AsyncResult',
+                       return_value=async_result):
+                with patch('cloudify.workflows.events.'
+                           'send_task_event_func_remote'):
+                    self.assertFalse(monitor._should_stop_consuming())
+                    monitor.stop()
+                    monitor._dispatcher.join(10)
+        return task
+
+    def test_missing_reply_result_backend_fallback(self):
+        async_result = MagicMock()
+        async_result.ready.return_value = True
+        async_result.successful.return_value = False
+        async_result.result = TypeError('unexpected keyword argument')
+        task = self._missing_reply_monitor(async_result)
+        self.assertEqual(tasks.TASK_FAILED, task.get_state())
+        self.assertEqual('TypeError', task.reply['error']['type'])
+
+    def test_missing_reply_timeout(self):
+        async_result = MagicMock()
+        async_result.ready.return_value = False
+        task = self._missing_reply_monitor(async_result)
+        self.assertEqual(tasks.TASK_PENDING, task.get_state())
+        task = self._missing_reply_monitor(async_result, reply_timeout=0)
+        self.assertEqual(tasks.TASK_FAILED, task.get_state())
+        self.assertIsInstance(tasks.task_reply_error(task.reply),
+                              exceptions.RecoverableError)
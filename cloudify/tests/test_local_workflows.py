@@ -14,6 +14,7 @@
 #    * limitations under the License.
 
 import contextlib
+import copy
 import time
 import yaml
 import sys
@@ -24,8 +25,11 @@ import threading
 import Queue
 
 import testtools
+from mock import patch
 from testtools.matchers import ContainsAll
 import nose.tools
+from cloudify_rest_client.node_instances import NodeInstance
+
 import cloudify.logs
 from cloudify.decorators import workflow, operation
 
@@ -60,7 +64,7 @@ class BaseWorkflowTest(testtools.TestCase):
 
         storage = self.storage_cls(**self.storage_kwargs)
 
-        if isinstance(storage, local.FileStorage) \
+        if isinstance(storage, (local.FileStorage, local.SQLiteStorage)) \
                 and (self.storage_dir != self.blueprint_dir):
             shutil.rmtree(self.storage_kwargs['storage_dir'])
 
@@ -499,6 +503,107 @@ class LocalWorkflowTest(BaseWorkflowTest):
             self.assertEqual('task_failed', events[1]['event_type'])
             self.assertEqual('workflow_failed', events[2]['event_type'])
 
+    def test_event_sink(self):
+
+        def the_workflow(ctx, **_):
+            instance = _instance(ctx, 'node')
+            ctx.logger.info('workflow_logging')
+            instance.logger.info('node_instance_logging')
+            instance.execute_operation('test.op0').get()
+
+        def the_operation(ctx, **_):
+            ctx.logger.info('op_logging')
+            ctx.send_event('op_event')
+
+        sink = cloudify.logs.MemoryEventSink()
+        with self._mock_stdout_event_and_log() as (events, logs):
+            self._execute_workflow(the_workflow,
+                                   operation_methods=[the_operation],
+                                   execute_kwargs={'event_sink': sink})
+            self.assertEqual(0, len(events))
+            self.assertEqual(0, len(logs))
+        self.assertEqual(['workflow_started', 'sending_task', 'task_started',
+                          'plugin_event', 'task_succeeded',
+                          'workflow_succeeded'],
+                         [e['event_type'] for e in sink.events])
+        self.assertEqual(['workflow_logging', 'node_instance_logging',
+                          'op_logging'],
+                         [l['message']['text'] for l in sink.logs])
+
+    def test_task_events_summary(self):
+
+        def the_workflow(ctx, **_):
+            instance = _instance(ctx, 'node')
+            instance.execute_operation('test.op0').get()
+            instance.execute_operation('test.op1').get()
+
+        def op_success(ctx, **_):
+            pass
+
+        def op_failure(ctx, **_):
+            raise RuntimeError('op failed')
+
+        sink = cloudify.logs.MemoryEventSink()
+        self.assertRaises(RuntimeError,
+                          self._execute_workflow,
+                          the_workflow,
+                          operation_methods=[op_success, op_failure],
+                          execute_kwargs={
+                              'event_sink': sink,
+                              'task_events_verbosity': 'summary'})
+        self.assertEqual(['workflow_started', 'task_succeeded',
+                          'task_failed', 'workflow_failed'],
+                         [e['event_type'] for e in sink.events])
+        context = sink.events[1]['context']
+        self.assertEqual(0, context['task_current_retries'])
+        self.assertIsNotNone(context['task_queue_time'])
+        self.assertIsNotNone(context['task_run_time'])
+        self.assertIsNotNone(context['task_total_time'])
+
+    def test_illegal_task_events_verbosity(self):
+        self.assertRaises(ValueError,
+                          self._execute_workflow,
+                          execute_kwargs={'task_events_verbosity': 'loud'})
+
+    def test_operation_templates(self):
+
+        def the_workflow(ctx, **_):
+            instance = _instance(ctx, 'node')
+            first = instance.execute_operation('test.op0')
+            second = instance.execute_operation('test.op0',
+                                                kwargs={'key': 'value'})
+            first.get()
+            second.get()
+            contexts = [task.cloudify_context for task in
+                        (first.task, second.task)]
+            assert len(ctx._operation_templates) == 1
+            assert contexts[0]['operation'] is not contexts[1]['operation']
+            assert contexts[0]['task_id'] != contexts[1]['task_id']
+
+        def op(ctx, key=None, **_):
+            keys = ctx.instance.runtime_properties.get('keys', [])
+            ctx.instance.runtime_properties['keys'] = keys + [key]
+
+        self._execute_workflow(the_workflow, operation_methods=[op])
+        instance = next(i for i in self.env.storage.get_node_instances()
+                        if i.node_id == 'node')
+        self.assertEqual([None, 'value'],
+                         instance.runtime_properties['keys'])
+
+    def test_task_callables_resolved_once(self):
+
+        def the_workflow(ctx, **_):
+            instance = _instance(ctx, 'node')
+            instance.execute_operation('test.op0').get()
+
+        def op(ctx, **_):
+            pass
+
+        self._execute_workflow(the_workflow, operation_methods=[op])
+        with patch('importlib.import_module',
+                   side_effect=AssertionError('unexpected import')):
+            self._execute_workflow(setup_env=False)
+
     def test_task_config_decorator(self):
         def flow(ctx, **_):
             task_config_kwargs = {'key': 'task_config'}
@@ -638,6 +743,25 @@ class LocalWorkflowTest(BaseWorkflowTest):
 
         self._execute_workflow(the_workflow, operation_methods=[op0, op1])
 
+    def test_operation_properties_are_mutable_copies(self):
+        def the_workflow(ctx, **_):
+            instance = _instance(ctx, 'node')
+            instance.execute_operation('test.op0').get()
+            instance.execute_operation('test.op1').get()
+
+        def op0(ctx, **_):
+            # plugins may modify nested properties, as they can when
+            # running against a manager
+            ctx.node.properties['from_input']['nested'].append('changed')
+            ctx.node.properties['from_input']['other'] = 'changed'
+
+        def op1(ctx, **_):
+            self.assertEqual({'nested': ['value']},
+                             ctx.node.properties['from_input'])
+
+        self._execute_workflow(the_workflow, operation_methods=[op0, op1],
+                               inputs={'from_input': {'nested': ['value']}})
+
     def test_operation_runtime_properties(self):
         def runtime_properties(ctx, **_):
             instance = _instance(ctx, 'node')
@@ -833,11 +957,12 @@ class LocalWorkflowTest(BaseWorkflowTest):
                 timeout = time.time() + 5
                 while time.time() < timeout and proceed():
                     p_instance = storage.get_node_instance(instance_id)
-                    p_instance.runtime_properties[key] = value
+                    runtime_properties = dict(p_instance.runtime_properties)
+                    runtime_properties[key] = value
                     try:
                         storage.update_node_instance(
                             p_instance.id,
-                            runtime_properties=p_instance.runtime_properties,
+                            runtime_properties=runtime_properties,
                             state=p_instance.state,
                             version=p_instance.version)
                     except local.StorageConflictError, e:
@@ -907,6 +1032,39 @@ class LocalWorkflowTestInMemoryStorage(LocalWorkflowTest):
         super(LocalWorkflowTestInMemoryStorage, self).setUp()
         self.storage_cls = local.InMemoryStorage
 
+    def test_storage_snapshots(self):
+        def flow(ctx, **_):
+            pass
+        # stub to get a properly initialized storage instance
+        self._execute_workflow(flow)
+        storage = self.env.storage
+        instance = storage.get_node_instances('node')[0]
+        self.assertIs(instance, storage.get_node_instance(instance.id))
+        self.assertIs(storage.get_node('node'), storage.get_node('node'))
+        self.assertRaises(TypeError, instance.runtime_properties.update,
+                          {'key': 'value'})
+        self.assertRaises(TypeError,
+                          storage.get_node('node').properties.pop,
+                          'property')
+
+        storage.update_node_instance(
+            instance.id,
+            runtime_properties={'key': {'nested': ['value']}},
+            version=instance.version)
+        updated = storage.get_node_instance(instance.id)
+        self.assertEqual({}, instance.runtime_properties)
+        self.assertEqual(instance.version + 1, updated.version)
+        self.assertRaises(TypeError,
+                          updated.runtime_properties['key']['nested'].append,
+                          'other')
+
+        thawed = copy.deepcopy(updated)
+        self.assertIs(type(thawed), NodeInstance)
+        thawed.runtime_properties['key']['nested'].append('other')
+        self.assertEqual({'key': {'nested': ['value']}},
+                         storage.get_node_instance(
+                             instance.id).runtime_properties)
+
 
 @nose.tools.istest
 class LocalWorkflowTestFileStorage(LocalWorkflowTest):
@@ -917,6 +1075,15 @@ class LocalWorkflowTestFileStorage(LocalWorkflowTest):
         self.storage_kwargs = {'storage_dir': self.storage_dir}
 
 
+@nose.tools.istest
+class LocalWorkflowTestSQLiteStorage(LocalWorkflowTest):
+
+    def setUp(self):
+        super(LocalWorkflowTestSQLiteStorage, self).setUp()
+        self.storage_cls = local.SQLiteStorage
+        self.storage_kwargs = {'storage_dir': self.storage_dir}
+
+
 @nose.tools.istest
 class FileStorageTest(BaseWorkflowTest):
 
@@ -976,6 +1143,95 @@ class FileStorageTest(BaseWorkflowTest):
         self._execute_workflow(workflow_name='workflow0',
                                setup_env=False, load_env=True)
 
+    def test_node_instances_index(self):
+        def flow(ctx, **_):
+            pass
+        self._setup_env(workflow_methods=[flow])
+        storage = self._load_env(self._testMethodName).storage
+        with patch.object(storage, '_load_instance',
+                          wraps=storage._load_instance) as load_instance:
+            instances = storage.get_node_instances('node3')
+            self.assertEqual(1, load_instance.call_count)
+        self.assertEqual(['node3'], [i.node_id for i in instances])
+        self.assertEqual([], storage.get_node_instances('missing'))
+        self.assertEqual(5, len(storage.get_node_instances()))
+
+    def test_atomic_writes(self):
+        path = os.path.join(self.storage_dir, 'file')
+        local._write_file(path, 'original')
+        with patch('os.fsync', side_effect=OSError('disk failure')):
+            self.assertRaises(OSError, local._write_file, path, 'new')
+        with open(path) as f:
+            self.assertEqual('original', f.read())
+        self.assertEqual(['file'], os.listdir(self.storage_dir))
+
+    def test_group_commit(self):
+        committer = local._GroupCommitter(self.storage_dir)
+        leader_writing = threading.Event()
+        release_leader = threading.Event()
+        write_files = local._write_files
+
+        def blocking_write_files(files, directory):
+            if 'leader' in files.values():
+                leader_writing.set()
+                release_leader.wait(10)
+            write_files(files, directory)
+
+        def writer(name, data):
+            return threading.Thread(target=committer.write, args=(
+                os.path.join(self.storage_dir, name), data))
+        with patch.object(local, '_write_files', blocking_write_files), \
+                patch.object(local, '_sync_directory') as sync_directory:
+            leader = writer('leader', 'leader')
+            leader.start()
+            leader_writing.wait(10)
+            followers = [writer(str(i), str(i)) for i in range(20)]
+            for follower in followers:
+                follower.start()
+            deadline = time.time() + 10
+            while len(committer._pending) < 20:
+                self.assertLess(time.time(), deadline)
+                time.sleep(0.01)
+            release_leader.set()
+            for thread in [leader] + followers:
+                thread.join()
+        # one batch for the leader and one for all the followers
+        self.assertEqual(2, sync_directory.call_count)
+        self.assertEqual(21, len(os.listdir(self.storage_dir)))
+
+    def test_batch_writes(self):
+        paths = [os.path.join(self.storage_dir, str(i)) for i in range(5)]
+        synced = []
+
+        def fsync(fd):
+            # every file of the batch is written before the first fsync
+            synced.append(len(os.listdir(self.storage_dir)))
+        with patch('os.fsync', fsync):
+            local._write_files(dict((path, os.path.basename(path))
+                                    for path in paths), self.storage_dir)
+        # 5 temporary files and a final directory fsync
+        self.assertEqual([5] * 6, synced)
+        for path in paths:
+            with open(path) as f:
+                self.assertEqual(os.path.basename(path), f.read())
+        self.assertEqual(sorted(os.path.basename(path) for path in paths),
+                         sorted(os.listdir(self.storage_dir)))
+        with patch('os.fsync', side_effect=OSError('disk failure')):
+            self.assertRaises(OSError, local._write_files,
+                              {paths[0]: 'new'}, self.storage_dir)
+        self.assertEqual(5, len(os.listdir(self.storage_dir)))
+
+    def test_group_commit_persistency(self):
+        self.storage_kwargs['group_commit'] = True
+
+        def flow(ctx, **_):
+            instance = _instance(ctx, 'node')
+            instance.set_state('started').get()
+        self._execute_workflow(flow)
+        storage = self._load_env(self._testMethodName).storage
+        self.assertEqual('started',
+                         storage.get_node_instances('node')[0].state)
+
     def test_local_init_in_blueprint_dir(self):
         self.blueprint_dir = self.storage_dir
 
@@ -984,6 +1240,66 @@ class FileStorageTest(BaseWorkflowTest):
         self._setup_env(workflow_methods=[flow])
 
 
+@nose.tools.istest
+class SQLiteStorageTest(BaseWorkflowTest):
+
+    def setUp(self):
+        super(SQLiteStorageTest, self).setUp()
+        self.storage_cls = local.SQLiteStorage
+        self.storage_kwargs = {'storage_dir': self.storage_dir}
+
+    def test_persistency(self):
+        def persistency_1(ctx, **_):
+            instance = _instance(ctx, 'node')
+            instance.set_state('persistency')
+            instance.execute_operation('test.op0').get()
+
+        def persistency_2(ctx, **_):
+            instance = _instance(ctx, 'node')
+            self.assertEqual('persistency', instance.get_state().get())
+            instance.execute_operation('test.op0').get()
+
+        def op(ctx, **_):
+            self.assertEqual('new_input', ctx.node.properties['from_input'])
+            self.assertEqual('content', ctx.get_resource('resource'))
+            ctx.instance.runtime_properties['invocations'] = \
+                ctx.instance.runtime_properties.get('invocations', 0) + 1
+
+        self._setup_env(workflow_methods=[persistency_1, persistency_2],
+                        operation_methods=[op],
+                        inputs={'from_input': 'new_input'})
+
+        self._execute_workflow(workflow_name='workflow0',
+                               setup_env=False, load_env=True)
+        self._execute_workflow(workflow_name='workflow1',
+                               setup_env=False, load_env=True)
+        storage = self._load_env(self._testMethodName).storage
+        instance = storage.get_node_instances('node')[0]
+        self.assertEqual(2, instance.runtime_properties['invocations'])
+        with storage.payload() as payload:
+            payload['key'] = 'value'
+        with self._load_env(self._testMethodName).storage.payload() as \
+                payload:
+            self.assertEqual({'key': 'value'}, payload)
+
+    def test_concurrent_writers(self):
+        def flow(ctx, **_):
+            pass
+        self._setup_env(workflow_methods=[flow])
+        storage1 = self._load_env(self._testMethodName).storage
+        storage2 = self._load_env(self._testMethodName).storage
+        instance = storage1.get_node_instances('node')[0]
+        storage1.update_node_instance(instance.id,
+                                      runtime_properties={'a': 1},
+                                      version=instance.version)
+        stale = NodeInstance(instance)
+        stale['version'] += 1
+        self.assertRaises(local.StorageConflictError,
+                          storage2._store_instance, stale)
+        self.assertEqual({'a': 1}, storage2.get_node_instance(
+            instance.id).runtime_properties)
+
+
 @nose.tools.istest
 class LocalWorkflowEnvironmentTest(BaseWorkflowTest):
 
@@ -1012,6 +1328,18 @@ class LocalWorkflowEnvironmentTest(BaseWorkflowTest):
         self.assertEqual(self.env.outputs(),
                          {'some_output': 'value', 'static': 'value'})
 
+        def op(ctx, **_):
+            ctx.instance.runtime_properties['some_output'] = {
+                'nested': ['value']}
+        self._execute_workflow(operation_methods=[op],
+                               use_existing_env=False)
+        # only values of the storage snapshots are copied
+        with patch('copy.deepcopy', side_effect=AssertionError):
+            outputs = self.env.outputs()
+        outputs['some_output']['nested'].append('changed')
+        self.assertEqual({'nested': ['value']},
+                         self.env.outputs()['some_output'])
+
     def test_workflow_return_value(self):
         def flow(ctx, **_):
             return 1
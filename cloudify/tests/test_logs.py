@@ -0,0 +1,183 @@
+########
+# Copyright (c) 2015 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+import os
+import json
+import shutil
+import logging
+import tempfile
+
+import testtools
+from mock import patch
+
+from cloudify import logs
+from cloudify.context import CloudifyContext
+
+
+class LoggingConfigTest(testtools.TestCase):
+
+    def test_parse_logging_level(self):
+        self.assertEqual(logging.DEBUG, logs.parse_logging_level('debug'))
+        self.assertEqual(logging.WARNING, logs.parse_logging_level('WARNING'))
+        self.assertEqual(5, logs.parse_logging_level(5))
+        self.assertEqual(logging.DEBUG, logs.parse_logging_level('10'))
+        self.assertEqual(15, logs.parse_logging_level(' 15 '))
+        self.assertIsNone(logs.parse_logging_level(None))
+        self.assertRaises(ValueError, logs.parse_logging_level, 'noisy')
+
+    def test_merge_logging_configs(self):
+        merged = logs.merge_logging_configs(
+            {'level': 'info', 'loggers': {'plugin': 'debug'}},
+            None,
+            {'level': 'warning', 'loggers': {'workflow': 'error'}})
+        self.assertEqual({'level': 'warning',
+                          'loggers': {'plugin': 'debug',
+                                      'workflow': 'error'}}, merged)
+
+    def test_logging_config_from_env(self):
+        config = logs.logging_config_from_env({
+            'CLOUDIFY_LOGGING_LEVEL': 'warning',
+            'CLOUDIFY_LOGGING_LEVEL_PLUGIN': 'debug',
+            'CLOUDIFY_LOGGING_RATE_LIMIT': '10'})
+        self.assertEqual({'level': 'warning',
+                          'loggers': {'plugin': 'debug'},
+                          'rate_limit': 10.0}, config)
+
+    def test_get_logging_level(self):
+        config = {'level': 'warning',
+                  'loggers': {'plugin': 'debug', 'some_logger': 'error'}}
+        self.assertEqual(logging.INFO, logs.get_logging_level(None))
+        self.assertEqual(logging.WARNING, logs.get_logging_level(config))
+        self.assertEqual(logging.DEBUG, logs.get_logging_level(
+            config, logger_type='plugin'))
+        self.assertEqual(logging.ERROR, logs.get_logging_level(
+            config, logger_name='some_logger', logger_type='plugin'))
+
+
+class LoggerLevelTest(testtools.TestCase):
+
+    def _logger(self, logging_config=None, environ=None):
+        self.out = []
+        context = {'task_id': 'logger-level-test'}
+        if logging_config is not None:
+            context[logs.LOGGING_CONFIG_KEY] = logging_config
+        ctx = CloudifyContext(context)
+        handler = logs.CloudifyPluginLoggingHandler(ctx,
+                                                    out_func=self.out.append)
+        with patch.dict('os.environ', environ or {}, clear=True):
+            return logs.init_cloudify_logger(
+                handler, ctx.task_id,
+                logging_config=ctx._context.get(logs.LOGGING_CONFIG_KEY))
+
+    def test_default_level(self):
+        logger = self._logger()
+        logger.debug('debug')
+        logger.info('info')
+        self.assertEqual(['info'], [l['message']['text'] for l in self.out])
+
+    def test_level_from_context(self):
+        logger = self._logger({'loggers': {'plugin': 'debug'}})
+        logger.debug('debug')
+        self.assertEqual(1, len(self.out))
+
+    def test_level_from_env(self):
+        logger = self._logger(environ={'CLOUDIFY_LOGGING_LEVEL': 'error'})
+        logger.warning('warning')
+        self.assertEqual(0, len(self.out))
+
+    def test_context_overrides_env(self):
+        logger = self._logger({'level': 'debug'},
+                              environ={'CLOUDIFY_LOGGING_LEVEL': 'error'})
+        logger.debug('debug')
+        self.assertEqual(1, len(self.out))
+
+    def test_rate_limit(self):
+        logger = self._logger({'rate_limit': 1, 'rate_limit_burst': 5})
+        for i in range(100):
+            logger.info('info {0}'.format(i))
+        logger.warning('warning')
+        self.assertEqual(6, len(self.out))
+        self.assertEqual('warning', self.out[-1]['message']['text'])
+        rate_filter = logger.handlers[0].filters[0]
+        self.assertEqual(101, len(self.out) + rate_filter.dropped)
+
+
+class RateLimitFilterTest(testtools.TestCase):
+
+    def test_invalid_rate(self):
+        self.assertRaises(ValueError, logs.RateLimitFilter, 0)
+
+    def test_refill(self):
+        record = logging.LogRecord('name', logging.INFO, '', 0, 'msg',
+                                   None, None)
+        rate_filter = logs.RateLimitFilter(rate=1, burst=1)
+        self.assertTrue(rate_filter.filter(record))
+        self.assertFalse(rate_filter.filter(record))
+        rate_filter._last -= 1
+        self.assertTrue(rate_filter.filter(record))
+
+
+class EventSinksTest(testtools.TestCase):
+
+    @staticmethod
+    def _event(text):
+        return {'event_type': 'test_event',
+                'context': {'deployment_id': 'd'},
+                'message': {'text': text, 'arguments': None}}
+
+    @staticmethod
+    def _log(text):
+        return {'level': 'info',
+                'context': {'deployment_id': 'd'},
+                'message': {'text': text}}
+
+    def test_memory_sink(self):
+        sink = logs.MemoryEventSink(capacity=2)
+        sink.event_out(self._event('1'))
+        sink.log_out(self._log('2'))
+        sink.event_out(self._event('3'))
+        self.assertEqual(['2', '3'],
+                         [i['message']['text'] for i in sink.items])
+        self.assertEqual(['3'], [e['message']['text'] for e in sink.events])
+        self.assertEqual(['2'], [l['message']['text'] for l in sink.logs])
+        self.assertEqual('cloudify_event', sink.events[0]['type'])
+        sink.clear()
+        self.assertEqual([], sink.items)
+
+    def test_json_lines_file_sink(self):
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir)
+        path = os.path.join(work_dir, 'events.jsonl')
+        sink = logs.JsonLinesFileEventSink(path, buffer_size=2)
+        sink.event_out(self._event('1'))
+        self.assertEqual('', open(path).read())
+        sink.log_out(self._log('2'))
+        sink.event_out(self._event('3'))
+        self.assertEqual(2, len(open(path).readlines()))
+        sink.close()
+        sink.close()
+        items = [json.loads(line) for line in open(path)]
+        self.assertEqual(['1', '2', '3'],
+                         [i['message']['text'] for i in items])
+        self.assertEqual('cloudify_log', items[1]['type'])
+
+    def test_fan_out_and_null_sinks(self):
+        first = logs.MemoryEventSink()
+        second = logs.MemoryEventSink()
+        sink = logs.FanOutEventSink(first, logs.NullEventSink(), second)
+        sink.event_out(self._event('1'))
+        sink.close()
+        self.assertEqual(1, len(first.events))
+        self.assertEqual(first.items, second.items)
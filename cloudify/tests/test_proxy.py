@@ -20,16 +20,24 @@ import threading
 import time
 import sys
 import subprocess
+import httplib
+import json
 from StringIO import StringIO
 
 import testtools
+from mock import patch
 from nose.tools import nottest, istest
 
+from cloudify import context
+from cloudify import manager
 from cloudify.mocks import MockCloudifyContext
 from cloudify.proxy import client
-from cloudify.proxy.server import (UnixCtxProxy,
+from cloudify.proxy.server import (CtxProxy,
+                                   UnixCtxProxy,
                                    TCPCtxProxy,
-                                   HTTPCtxProxy)
+                                   HTTPCtxProxy,
+                                   PathDictAccess,
+                                   process_ctx_request)
 
 IS_WINDOWS = os.name == 'nt'
 
@@ -80,6 +88,7 @@ class TestCtxProxy(testtools.TestCase):
         self.ctx.stub_attr = self.StubAttribute()
         self.server = self.proxy_server_class(self.ctx)
         self.start_server()
+        self.addCleanup(client._close_connections)
 
     def start_server(self):
         self.stop_server = False
@@ -194,6 +203,76 @@ class TestCtxProxy(testtools.TestCase):
         response = self.request(*args)
         self.assertEqual(args[1:], response)
 
+    def test_concurrent_requests(self):
+        threads = [threading.Thread(target=self.request,
+                                    args=('stub-sleep', '0.5'))
+                   for _ in range(4)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # a slow request does not hold back the others
+        self.assertLess(time.time() - start, 1.5)
+
+    def test_batch_request(self):
+        responses = client.client_batch_req(self.server.socket_url, [
+            ['stub_attr', 'some_property'],
+            ['property_that_does_not_exist'],
+            ['node', 'properties', 'prop1']])
+        self.assertEqual('some_value', responses[0])
+        self.assertIsInstance(responses[1], client.RequestError)
+        self.assertEqual('value1', responses[2])
+
+    def test_connection_reuse(self):
+        self.request('stub-method')
+        connection = client._cached_connections()[self.server.socket_url]
+        self.request('stub-method')
+        self.assertIs(connection,
+                      client._cached_connections()[self.server.socket_url])
+
+    def test_stdin_requests(self):
+        args = client.parse_args(['--socket-url', self.server.socket_url,
+                                  '--stdin', '-j', '--batch-size', '2'])
+        stdin = StringIO('stub_attr some_property\n'
+                         'node properties prop1\n'
+                         '\n'
+                         'property_that_does_not_exist\n'
+                         'stub_method @1 "two words"\n')
+        stdout = StringIO()
+        stderr = StringIO()
+        self.assertFalse(client.process_stdin(args, stdin, stdout, stderr))
+        self.assertEqual(['"some_value"', '"value1"', 'null',
+                          '[1, "two words"]'],
+                         stdout.getvalue().splitlines())
+        self.assertIn('property_that_does_not_exist', stderr.getvalue())
+
+    def test_interactive_stdin_requests(self):
+        args = client.parse_args(['--socket-url', self.server.socket_url,
+                                  '--stdin', '-j'])
+        read_fd, write_fd = os.pipe()
+        stdin = os.fdopen(read_fd, 'r')
+        stdout = StringIO()
+        processor = threading.Thread(target=client.process_stdin,
+                                     args=(args, stdin, stdout, StringIO()))
+        processor.daemon = True
+        processor.start()
+        try:
+            # each request is answered before the next one is written
+            for i, line in enumerate(['stub_attr some_property\n',
+                                      'node properties prop1\n']):
+                os.write(write_fd, line)
+                deadline = time.time() + 5
+                while len(stdout.getvalue().splitlines()) <= i:
+                    self.assertLess(time.time(), deadline)
+                    time.sleep(0.01)
+        finally:
+            os.close(write_fd)
+        processor.join(5)
+        self.assertFalse(processor.is_alive())
+        self.assertEqual(['"some_value"', '"value1"'],
+                         stdout.getvalue().splitlines())
+
 
 @istest
 class TestUnixCtxProxy(TestCtxProxy):
@@ -230,6 +309,92 @@ class TestHTTPCtxProxy(TestCtxProxy):
         self.expected_exception = IOError
         super(TestHTTPCtxProxy, self).test_client_request_timeout()
 
+    def test_keep_alive(self):
+        connection = httplib.HTTPConnection('localhost', self.server.port)
+        try:
+            for _ in range(3):
+                connection.request('POST', '/', json.dumps(
+                    {'args': ['stub_attr', 'some_property']}))
+                response = connection.getresponse()
+                self.assertFalse(response.will_close)
+                self.assertEqual('some_value',
+                                 json.loads(response.read())['payload'])
+        finally:
+            connection.close()
+
+
+class TestConcurrentCtxRequests(testtools.TestCase):
+
+    def test_concurrent_runtime_properties_writes(self):
+        updates = []
+
+        def get_node_instance(node_instance_id):
+            # slow enough for all the first requests to load it at once
+            time.sleep(0.2)
+            return manager.NodeInstance(node_instance_id, 'node', version=1)
+        ctx = context.CloudifyContext({'node_id': 'node_1',
+                                       'node_name': 'node'})
+        server = HTTPCtxProxy(ctx, max_concurrent_requests=10)
+        self.addCleanup(server.close)
+        self.addCleanup(client._close_connections)
+        with patch('cloudify.manager.get_node_instance', get_node_instance), \
+                patch('cloudify.manager.update_node_instance',
+                      lambda instance: updates.append(
+                          dict(instance.runtime_properties))):
+            threads = [threading.Thread(
+                target=client.client_req,
+                args=(server.socket_url,
+                      ['instance', 'runtime-properties', 'key{0}'.format(i),
+                       i]))
+                for i in range(10)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            ctx.instance.update()
+        self.assertEqual([dict(('key{0}'.format(i), i) for i in range(10))],
+                         updates)
+
+
+class TestProcessCtxRequest(testtools.TestCase):
+
+    class Stub(object):
+        def __init__(self):
+            self.runtime_properties = {'a': {'b': [0, 1, {'c': 'value'}]}}
+
+    def test_attributes_cache(self):
+        ctx = MockCloudifyContext()
+        ctx.some_instance = self.Stub()
+        cache = {}
+        args = ['some-instance', 'runtime-properties', 'a.b[2].c']
+        for _ in range(2):
+            self.assertEqual('value', process_ctx_request(ctx, args, cache))
+        self.assertEqual('some_instance', cache[('some-instance',)])
+        self.assertEqual('runtime_properties',
+                         cache[('some-instance', 'runtime-properties')])
+        # a cached attribute that went away is resolved again
+        ctx.some_instance = {'runtime-properties': {'a.b[2].c': 'other'}}
+        self.assertEqual({'a.b[2].c': 'other'}, process_ctx_request(
+            ctx, args[:2], cache))
+
+    def test_invalid_requests(self):
+        proxy = CtxProxy(MockCloudifyContext(), socket_url=None)
+        for request in ['[1, 2]', '"batch"', '3', 'null',
+                        '{"batch": "args"}', 'not json']:
+            response = json.loads(proxy.process(request))
+            self.assertEqual('error', response['type'])
+        response = json.loads(proxy.process('{"batch": [["node"]]}'))
+        self.assertEqual('result', response['type'])
+
+    def test_compiled_paths(self):
+        props = {'a': {'b': [0, 1, {'c': 'value'}]}}
+        self.assertEqual('value', PathDictAccess(props).get('a.b[2].c'))
+        self.assertEqual((('a', None), ('b', 2), ('c', None)),
+                         PathDictAccess._compiled_paths['a.b[2].c'])
+        PathDictAccess(props).set('a.b[2].c', 'new')
+        self.assertEqual('new', PathDictAccess(props).get('a.b[2].c'))
+        self.assertRaises(RuntimeError, PathDictAccess(props).get, 'x[0]')
+
 
 class TestArgumentParsing(testtools.TestCase):
 
@@ -350,5 +515,18 @@ class TestArgumentParsing(testtools.TestCase):
 
 class TestCtxEntryPoint(testtools.TestCase):
 
+    def test_client_imports(self):
+        # modules needed by some of the requests only are imported lazily
+        # to keep the start up time of every ctx call low
+        output, _ = subprocess.Popen([
+            sys.executable, '-c',
+            'import sys, json, cloudify.proxy.client; '
+            'print json.dumps(sys.modules.keys())'],
+            stdout=subprocess.PIPE).communicate()
+        imported = set(json.loads(output))
+        for module in ['httplib', 'urllib2', 'zmq', 'argparse', 'shlex',
+                       'bottle', 'cloudify.context']:
+            self.assertNotIn(module, imported)
+
     def test_ctx_in_path(self):
         subprocess.call(['ctx', '--help'])
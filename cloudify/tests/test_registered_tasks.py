@@ -0,0 +1,106 @@
+########
+# Copyright (c) 2015 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+
+import time
+import threading
+
+import testtools
+
+from cloudify import exceptions
+from cloudify.workflows import tasks
+
+
+class RegisteredTasksRegistryTest(testtools.TestCase):
+
+    def setUp(self):
+        super(RegisteredTasksRegistryTest, self).setUp()
+        self.queries = []
+        self.registered = {'host1': set(['t1']), 'host2': set(['t2'])}
+        self.lock = threading.Lock()
+
+    def _query(self, targets):
+        with self.lock:
+            self.queries.append(sorted(targets))
+        return dict((target, self.registered[target])
+                    for target in targets if target in self.registered)
+
+    def _registry(self, **kwargs):
+        return tasks.RegisteredTasksRegistry(query=self._query, **kwargs)
+
+    def test_verify(self):
+        registry = self._registry()
+        registry.verify('t1', 'host1')
+        registry.verify('t1', 'host1')
+        self.assertEqual([['host1']], self.queries)
+        self.assertRaises(exceptions.NonRecoverableError,
+                          registry.verify, 't2', 'host1')
+
+    def test_missing_task_is_queried_again(self):
+        registry = self._registry()
+        self.assertRaises(exceptions.NonRecoverableError,
+                          registry.verify, 't3', 'host1')
+        # e.g. the plugin of the task was installed right after
+        self.registered['host1'] = set(['t1', 't3'])
+        registry.verify('t3', 'host1')
+        self.assertEqual(2, len(self.queries))
+        registry.verify('t3', 'host1')
+        self.assertEqual(2, len(self.queries))
+
+    def test_workers_that_did_not_reply_are_not_cached(self):
+        registry = self._registry()
+        registry.warm_up(['host3'])
+        self.assertEqual({}, registry._entries)
+        self.registered['host3'] = set(['t3'])
+        registry.verify('t3', 'host3')
+        self.assertEqual([['host3'], ['host3']], self.queries)
+
+    def test_empty_entry_is_queried_again(self):
+        registry = self._registry()
+        self.registered['host3'] = set()
+        self.assertRaises(exceptions.NonRecoverableError,
+                          registry.verify, 't3', 'host3')
+        self.registered['host3'] = set(['t3'])
+        registry.verify('t3', 'host3')
+        self.assertEqual(2, len(self.queries))
+
+    def test_background_refresh(self):
+        registry = self._registry(ttl=0)
+        registry.verify('t1', 'host1')
+        self.registered['host1'] = set(['t1', 'new'])
+        time.sleep(0.01)
+        # stale entry is served while being refreshed
+        self.assertEqual(set(['t1']), registry.get('host1'))
+        deadline = time.time() + 10
+        while 'new' not in registry._entries['host1'][0]:
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.01)
+
+    def test_warm_up(self):
+        registry = self._registry(batch_size=2)
+        registry.verify('t1', 'host1')
+        registry.warm_up(['host1', 'host2', 'host3', 'host4', 'host5'])
+        self.assertEqual([['host1'], ['host2', 'host3'], ['host4', 'host5']],
+                         sorted(self.queries))
+        registry.verify('t2', 'host2')
+        self.assertEqual(3, len(self.queries))
+
+    def test_failed_query_is_not_cached(self):
+        def failing_query(targets):
+            raise RuntimeError('no broker')
+        registry = tasks.RegisteredTasksRegistry(query=failing_query)
+        registry.warm_up(['host1'])
+        self.assertEqual({}, registry._entries)
+        self.assertRaises(RuntimeError, registry.verify, 't1', 'host1')
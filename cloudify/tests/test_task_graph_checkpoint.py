@@ -0,0 +1,210 @@
+########
+# Copyright (c) 2015 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+
+import os
+import json
+import shutil
+import tempfile
+import threading
+
+import testtools
+from mock import patch, MagicMock
+
+from cloudify.workflows import tasks
+from cloudify.workflows import tasks_graph
+
+
+class _LocalTask(tasks.WorkflowTask):
+
+    def __init__(self, workflow_context, name, executed, fail=False):
+        super(_LocalTask, self).__init__(workflow_context)
+        self._name = name
+        self._executed = executed
+        self._fail = fail
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def cloudify_context(self):
+        return None
+
+    def is_local(self):
+        return True
+
+    def apply_async(self):
+        if self._fail:
+            raise RuntimeError('workflow worker died')
+        self._executed.append(self.name)
+        self.set_state(tasks.TASK_SUCCEEDED)
+
+
+class TaskDependencyGraphCheckpointTest(testtools.TestCase):
+
+    def setUp(self):
+        super(TaskDependencyGraphCheckpointTest, self).setUp()
+        self.ctx = MagicMock()
+        self.executed = []
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.checkpoint_path = os.path.join(tmp_dir, 'execution.json')
+
+    def _graph(self, fail=()):
+        graph = tasks_graph.TaskDependencyGraph(
+            self.ctx, checkpoint_path=self.checkpoint_path,
+            checkpoint_interval=0)
+        sequence = graph.sequence()
+        sequence.add(*[_LocalTask(self.ctx, name, self.executed,
+                                  fail=name in fail)
+                       for name in ['create', 'configure', 'start']])
+        return graph
+
+    def test_resume_skips_completed_tasks(self):
+        self.assertRaises(RuntimeError,
+                          self._graph(fail=['configure']).execute)
+        self.assertEqual(['create'], self.executed)
+        with open(self.checkpoint_path) as f:
+            checkpoint = json.load(f)
+        self.assertEqual(['create:None:None:None:None#0'],
+                         checkpoint['completed'])
+        self.assertEqual(2, len(checkpoint['tasks']))
+        self.assertEqual(1, len(checkpoint['edges']))
+
+        graph = self._graph()
+        graph.resume()
+        graph.execute()
+        self.assertEqual(['create', 'configure', 'start'], self.executed)
+        with open(self.checkpoint_path) as f:
+            checkpoint = json.load(f)
+        self.assertEqual(3, len(checkpoint['completed']))
+        self.assertEqual([], checkpoint['tasks'])
+
+    def test_checkpoint_is_durable(self):
+        synced = []
+
+        def fsync(fd):
+            synced.append(os.fstat(fd).st_ino)
+        with patch('os.fsync', fsync):
+            self._graph().execute()
+        # the file fsynced before each rename ends up as the checkpoint,
+        # the directory is fsynced after it
+        checkpoint_dir = os.path.dirname(self.checkpoint_path)
+        self.assertEqual(os.stat(self.checkpoint_path).st_ino,
+                         synced[-2])
+        self.assertEqual(os.stat(checkpoint_dir).st_ino, synced[-1])
+        self.assertEqual(['execution.json'], os.listdir(checkpoint_dir))
+
+    def test_checkpoint_is_written_off_the_executing_thread(self):
+        writers = []
+
+        def write_checkpoint(path, checkpoint):
+            writers.append(threading.current_thread())
+        with patch.object(tasks_graph, '_write_checkpoint',
+                          write_checkpoint):
+            self._graph().execute()
+        self.assertTrue(writers)
+        self.assertNotIn(threading.current_thread(), writers)
+
+    def test_unchanged_checkpoint_is_not_written(self):
+        graph = tasks_graph.TaskDependencyGraph(
+            self.ctx, checkpoint_path=self.checkpoint_path,
+            checkpoint_interval=0)
+        task = _LocalTask(self.ctx, 'create', self.executed)
+        graph.add_task(task)
+        with patch.object(tasks_graph, '_write_checkpoint') as write:
+            graph._checkpoint()
+            graph._checkpoint(force=True)
+            self.assertEqual(1, write.call_count)
+            task.set_state(tasks.TASK_SENT)
+            graph._checkpoint()
+            self.assertEqual(2, write.call_count)
+
+    def test_resume_refuses_changed_tasks(self):
+        self.assertRaises(RuntimeError,
+                          self._graph(fail=['configure']).execute)
+        graph = self._graph()
+        graph.add_task(_LocalTask(self.ctx, 'stop', self.executed))
+        graph.resume()
+        e = self.assertRaises(RuntimeError, graph.execute)
+        self.assertIn('missing from the checkpoint: '
+                      '[stop:None:None:None:None#0]', str(e))
+        self.assertEqual(['create'], self.executed)
+
+    def test_resume_refuses_changed_dependencies(self):
+        self.assertRaises(RuntimeError,
+                          self._graph(fail=['configure']).execute)
+        graph = tasks_graph.TaskDependencyGraph(self.ctx)
+        for name in ['create', 'configure', 'start']:
+            graph.add_task(_LocalTask(self.ctx, name, self.executed))
+        graph.resume(self.checkpoint_path)
+        e = self.assertRaises(RuntimeError, graph.execute)
+        self.assertIn('missing from the graph: [start:None:None:None:None#0 '
+                      '-> configure:None:None:None:None#0]', str(e))
+        self.assertEqual(['create'], self.executed)
+
+    def test_checkpoint_keys(self):
+        graph = tasks_graph.TaskDependencyGraph(self.ctx)
+        first = _LocalTask(self.ctx, 'op', self.executed)
+        second = _LocalTask(self.ctx, 'op', self.executed)
+        graph.add_task(first)
+        graph.add_task(second)
+        self.assertEqual('op:None:None:None:None#0', first.checkpoint_key)
+        self.assertEqual('op:None:None:None:None#1', second.checkpoint_key)
+        retried = _LocalTask(self.ctx, 'op', self.executed)
+        retried.checkpoint_key = first.checkpoint_key
+        graph.add_task(retried)
+        self.assertEqual(first.checkpoint_key, retried.checkpoint_key)
+
+    def _remote_task(self):
+        return tasks.RemoteWorkflowTask(
+            task=MagicMock(),
+            cloudify_context={'task_name': 'cloudify.plugins.start',
+                              'task_target': 'agent',
+                              'node_id': 'vm_1',
+                              'operation': {'name': 'start',
+                                            'retry_number': 0}},
+            workflow_context=self.ctx)
+
+    @patch('cloudify.workflows.tasks.registered_tasks.warm_up')
+    def test_resume_reattaches_in_flight_remote_tasks(self, _):
+        graph = tasks_graph.TaskDependencyGraph(
+            self.ctx, checkpoint_path=self.checkpoint_path)
+        sent = self._remote_task()
+        sent.current_retries = 2
+        graph.add_task(sent)
+        sent.set_state(tasks.TASK_SENT)
+        graph._checkpoint(force=True)
+
+        graph = tasks_graph.TaskDependencyGraph(
+            self.ctx, checkpoint_path=self.checkpoint_path)
+        resumed = self._remote_task()
+        graph.add_task(resumed)
+        graph.resume()
+        async_result = MagicMock()
+        async_result.ready.return_value = True
+        async_result.successful.return_value = True
+        with patch('cloudify.celery.celery.AsyncResult',
+                   return_value=async_result) as celery_async_result:
+            graph.execute()
+        celery_async_result.assert_called_once_with(sent.id)
+        self.assertEqual(sent.id, resumed.id)
+        self.assertEqual(sent.id, resumed.cloudify_context['task_id'])
+        self.assertEqual(2, resumed.cloudify_context['operation'][
+            'retry_number'])
+        self.assertEqual(tasks.TASK_SUCCEEDED, resumed.get_state())
+        self.ctx.internal.track_remote_task.assert_called_once_with(resumed)
+        self.assertFalse(resumed.task.apply_async.called)
@@ -0,0 +1,174 @@
+########
+# Copyright (c) 2015 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+
+import os
+import json
+import time
+import shutil
+import socket
+import tempfile
+import threading
+
+import testtools
+from mock import patch, MagicMock
+
+from cloudify.workflows import tasks
+from cloudify.workflows import tasks_graph
+
+
+class _BlockingTask(tasks.WorkflowTask):
+
+    name = 'blocking'
+    cloudify_context = None
+
+    def __init__(self, workflow_context, released):
+        super(_BlockingTask, self).__init__(workflow_context, info='vm_1')
+        self._released = released
+
+    def is_local(self):
+        return True
+
+    def apply_async(self):
+        def run():
+            self._released.wait(30)
+            self.set_state(tasks.TASK_SUCCEEDED)
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+
+class _InstantTask(tasks.WorkflowTask):
+
+    name = 'instant'
+    cloudify_context = None
+
+    def is_local(self):
+        return True
+
+    def apply_async(self):
+        self.set_state(tasks.TASK_SUCCEEDED)
+
+
+class TaskDependencyGraphInspectionTest(testtools.TestCase):
+
+    def _connect(self, path):
+        deadline = time.time() + 10
+        while not os.path.exists(path):
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.01)
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(path)
+        return client
+
+    def _socket_path(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        return os.path.join(tmp_dir, 'execution.sock')
+
+    def _wait_for_state(self, task, state):
+        deadline = time.time() + 10
+        while task.get_state() == state:
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.01)
+
+    def test_stream_state(self):
+        path = self._socket_path()
+        ctx = MagicMock()
+        released = threading.Event()
+        self.addCleanup(released.set)
+        graph = tasks_graph.TaskDependencyGraph(ctx,
+                                                inspect_socket_path=path)
+        running = _BlockingTask(ctx, released)
+        dependent = _BlockingTask(ctx, released)
+        graph.add_task(running)
+        graph.add_task(dependent)
+        graph.add_dependency(dependent, running)
+        executor = threading.Thread(target=graph.execute)
+        executor.start()
+        self._wait_for_state(running, tasks.TASK_PENDING)
+
+        client = self._connect(path)
+        lines = [json.loads(line) for line in client.makefile('r')]
+        client.close()
+        released.set()
+        executor.join(30)
+
+        self.assertEqual({'type': 'graph', 'tasks': 2, 'edges': 1,
+                          'completed': 0},
+                         dict((key, value) for key, value in
+                              lines[0].iteritems() if key != 'time'))
+        task_lines = dict((line['id'], line) for line in lines[1:])
+        self.assertEqual(2, len(task_lines))
+        self.assertEqual(tasks.TASK_SENDING, task_lines[running.id]['state'])
+        self.assertEqual(1, task_lines[running.id]['dependents'])
+        self.assertEqual(tasks.TASK_PENDING,
+                         task_lines[dependent.id]['state'])
+        self.assertEqual(1, task_lines[dependent.id]['dependencies'])
+        self.assertEqual('vm_1', task_lines[dependent.id]['info'])
+        self.assertEqual(0, task_lines[dependent.id]['retries'])
+        self.assertTrue(task_lines[dependent.id]['age'] >= 0)
+        # the socket is removed once the graph is done executing
+        self.assertFalse(executor.is_alive())
+        self.assertFalse(os.path.exists(path))
+
+    @patch.object(tasks_graph, 'INSPECTION_SEND_TIMEOUT', 0.5)
+    def test_client_not_reading_does_not_block_execution(self):
+        path = self._socket_path()
+        ctx = MagicMock()
+        released = threading.Event()
+        self.addCleanup(released.set)
+        graph = tasks_graph.TaskDependencyGraph(ctx,
+                                                inspect_socket_path=path)
+        running = _BlockingTask(ctx, released)
+        graph.add_task(running)
+        # enough task lines to fill the socket buffers
+        for _ in range(3000):
+            dependent = _InstantTask(ctx)
+            graph.add_task(dependent)
+            graph.add_dependency(dependent, running)
+        sending = threading.Event()
+        sent = threading.Event()
+        send_state = graph._send_state
+
+        def tracking_send_state(connection, state):
+            sending.set()
+            try:
+                send_state(connection, state)
+            finally:
+                sent.set()
+        graph._send_state = tracking_send_state
+        executor = threading.Thread(target=graph.execute)
+        executor.daemon = True
+        executor.start()
+        self._wait_for_state(running, tasks.TASK_PENDING)
+
+        client = self._connect(path)
+        self.addCleanup(client.close)
+        # the tasks are released while the client reads nothing
+        self.assertTrue(sending.wait(10))
+        released.set()
+        executor.join(10)
+        self.assertFalse(executor.is_alive())
+        # the client is dropped once the send times out
+        self.assertTrue(sent.wait(10))
+        client.settimeout(10)
+        data = ''
+        while True:
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+        self.assertLess(data.count('\n'), 3001)
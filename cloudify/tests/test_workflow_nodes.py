@@ -0,0 +1,131 @@
+########
+# Copyright (c) 2015 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+
+import testtools
+from mock import MagicMock
+
+from cloudify_rest_client.nodes import Node
+from cloudify_rest_client.node_instances import NodeInstance
+
+from cloudify.workflows import workflow_context
+
+CONTAINED_IN = 'cloudify.relationships.contained_in'
+CONNECTED_TO = 'cloudify.relationships.connected_to'
+
+
+def _node(node_id, number_of_instances=1, relationships=None):
+    return Node({
+        'id': node_id,
+        'type_hierarchy': ['base_type', '{0}_type'.format(node_id)],
+        'number_of_instances': number_of_instances,
+        'relationships': [{'target_id': target_id,
+                           'type_hierarchy': ['cloudify.relationships.'
+                                              'depends_on', rel_type]}
+                          for target_id, rel_type in relationships or []]
+    })
+
+
+def _instance(instance_id, node_id, host_id, relationships=None):
+    return NodeInstance({
+        'id': instance_id,
+        'node_id': node_id,
+        'host_id': host_id,
+        'runtime_properties': {'large': 'x' * 100},
+        'relationships': [{'target_id': target_id,
+                           'target_name': target_name}
+                          for target_id, target_name in relationships or []]
+    })
+
+
+class WorkflowNodesAndInstancesContainerTest(testtools.TestCase):
+
+    def setUp(self):
+        super(WorkflowNodesAndInstancesContainerTest, self).setUp()
+        nodes = [_node('host'),
+                 _node('db'),
+                 _node('app', relationships=[('host', CONTAINED_IN),
+                                             ('db', CONNECTED_TO)])]
+        instances = iter([
+            _instance('app_1', 'app', 'host_1', [('host_1', 'host'),
+                                                 ('db_1', 'db')]),
+            _instance('host_1', 'host', 'host_1'),
+            _instance('db_1', 'db', 'db_1')])
+        self.container = workflow_context.WorkflowNodesAndInstancesContainer(
+            MagicMock(), nodes, instances)
+
+    def test_containment(self):
+        host = self.container.get_node_instance('host_1')
+        app = self.container.get_node_instance('app_1')
+        self.assertEqual([app], host.contained_instances)
+        self.assertEqual(set([host, app]), host.get_contained_subgraph())
+        self.assertEqual([], self.container.get_node_instance(
+            'db_1').contained_instances)
+        self.assertEqual('host_1', app.host_id)
+        self.assertEqual('app', app.node_id)
+
+    def test_lazy_relationships(self):
+        app = self.container.get_node_instance('app_1')
+        self.assertIsNone(app._relationship_instances)
+        relationships = dict((rel.target_id, rel)
+                             for rel in app.relationships)
+        self.assertEqual(self.container.get_node_instance('db_1'),
+                         relationships['db_1'].target_node_instance)
+        self.assertTrue(relationships['host_1'].relationship.is_derived_from(
+            CONTAINED_IN))
+
+    def test_compact_model(self):
+        app = self.container.get_node_instance('app_1')
+        self.assertFalse(hasattr(app, '__dict__'))
+        self.assertFalse(hasattr(next(app.relationships), '__dict__'))
+        host = self.container.get_node_instance('host_1')
+        self.assertIs(host.id, app.host_id)
+
+    def test_indexes(self):
+        container = self.container
+        host = container.get_node_instance('host_1')
+        app = container.get_node_instance('app_1')
+        db = container.get_node_instance('db_1')
+        self.assertEqual(host, container.get_host_node_instance('app_1'))
+        self.assertEqual(set([host, app]),
+                         set(container.get_hosted_node_instances('host_1')))
+        self.assertEqual([app], container.get_dependent_node_instances(
+            'db_1'))
+        self.assertEqual([], container.get_dependent_node_instances(
+            'app_1'))
+        subgraph = container.get_contained_subgraph('host_1')
+        subgraph.add(db)
+        self.assertEqual(set([host, app]),
+                         container.get_contained_subgraph('host_1'))
+        self.assertEqual(set([container.get_node('app')]),
+                         container.get_nodes_by_type(['app_type', 'other']))
+        self.assertEqual(set(container.nodes),
+                         container.get_nodes_by_type(['base_type']))
+        self.assertTrue(app.node.is_derived_from('app_type'))
+        self.assertFalse(host.node.is_derived_from('app_type'))
+
+    def test_list_node_instances_paging(self):
+        rest = MagicMock()
+        nodes = [_node('host', 2), _node('app', 3)]
+        workflow_context._list_node_instances(rest, 'dep', nodes)
+        rest.node_instances.list.assert_called_once_with('dep')
+
+        rest = MagicMock()
+        rest.node_instances.list.side_effect = \
+            lambda deployment_id, node_name: [node_name]
+        nodes = [_node('host', 2000), _node('app', 3000)]
+        instances = workflow_context._list_node_instances(rest, 'dep', nodes)
+        self.assertEqual(0, rest.node_instances.list.call_count)
+        self.assertEqual(['host', 'app'], list(instances))
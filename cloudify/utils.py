@@ -118,6 +118,54 @@ def create_temp_folder():
     return path_join
 
 
+def write_file_atomically(path, data, sync_directory=True):
+    """
+    Replace the content of ``path`` with ``data`` atomically and durably:
+    ``data`` is written and fsynced to a temporary file which is then
+    renamed over ``path``.
+
+    :param sync_directory: Whether to also fsync the directory of ``path``,
+                           making the rename durable
+    """
+    directory = os.path.dirname(path)
+    fd, temp_path = tempfile.mkstemp(
+        dir=directory, prefix='.{0}.'.format(os.path.basename(path)))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temp_path, path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    if sync_directory:
+        fsync_directory(directory)
+
+
+def fsync_directory(directory):
+    """
+    Fsync ``directory``, making renames within it durable.
+    """
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def get_exception_message(error):
+    """
+    The message of an exception as unicode, whether it was raised with a
+    unicode or a (utf-8) byte string message.
+    """
+    try:
+        return unicode(error)
+    except UnicodeError:
+        return str(error).decode('utf-8', 'replace')
+
+
 def get_cosmo_properties():
     return {
         "management_ip": get_manager_ip(),
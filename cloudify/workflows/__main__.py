@@ -25,12 +25,17 @@ if __name__ == '__main__':
     arg_parser.add_argument('blueprint_path')
     arg_parser.add_argument('--name', default='local')
     arg_parser.add_argument('--storage_dir', default='/tmp/cloudify-workflows')
+    arg_parser.add_argument('--storage', choices=['file', 'sqlite'],
+                            default='file')
     arg_parser.add_argument('--init', action='store_true')
     arg_parser.add_argument('--bootstrap', action='store_true')
     arg_parser.add_argument('--pool-size', type=int, default=1)
     args = arg_parser.parse_args()
 
-    storage = local.FileStorage(args.storage_dir)
+    if args.storage == 'sqlite':
+        storage = local.SQLiteStorage(args.storage_dir)
+    else:
+        storage = local.FileStorage(args.storage_dir)
     name = args.name
     if args.init:
         env = local.init_env(args.blueprint_path, name=name, storage=storage)
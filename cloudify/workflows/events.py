@@ -14,28 +14,72 @@
 #    * limitations under the License.
 
 
+import time
+import Queue
+import threading
+
 from cloudify import logs
-from cloudify.exceptions import OperationRetry
+from cloudify.exceptions import OperationRetry, RecoverableError
 from cloudify.workflows import tasks as tasks_api
 
 
+# Send an event for each task lifecycle state (sending, started, succeeded,
+# rescheduled, failed)
+TASK_EVENTS_FULL = 'full'
+# Send a single event for each succeeded task (including its timings), and
+# full detail only for rescheduled and failed tasks
+TASK_EVENTS_SUMMARY = 'summary'
+TASK_EVENTS_VERBOSITY_MODES = [TASK_EVENTS_FULL, TASK_EVENTS_SUMMARY]
+DEFAULT_TASK_EVENTS_VERBOSITY = TASK_EVENTS_FULL
+
+# Remote task completions are captured from the celery events stream of
+# the whole cluster
+TASK_COMPLETION_EVENTS = 'events'
+# Remote operations publish a completion record to a reply queue dedicated
+# to the execution
+TASK_COMPLETION_REPLY_QUEUE = 'reply_queue'
+TASK_COMPLETION_MODES = [TASK_COMPLETION_EVENTS, TASK_COMPLETION_REPLY_QUEUE]
+DEFAULT_TASK_COMPLETION = TASK_COMPLETION_EVENTS
+
+# seconds a remote task may go without a completion record on the reply
+# queue before the celery result backend is checked for its result. no
+# record is published when a task fails before the operation runs (e.g. on
+# a kwargs error), the result backend still has it
+REPLY_FALLBACK_CHECK_INTERVAL = 30
+
+
 class Monitor(object):
     """Monitor with handlers for different celery events"""
 
-    def __init__(self, tasks_graph):
+    def __init__(self, tasks_graph,
+                 task_events_verbosity=DEFAULT_TASK_EVENTS_VERBOSITY):
         """
         :param tasks_graph: The task graph. Used to extract tasks based on the
                             events task id.
+        :param task_events_verbosity: The task events verbosity mode
+                                      (full/summary)
         """
         self.tasks_graph = tasks_graph
+        self.task_events_verbosity = task_events_verbosity
         self._receiver = None
         self._should_stop = False
+        # in-flight remote tasks by id. celery events of all tasks flow
+        # through the receiver, so anything not in here is dropped on arrival
+        self._tasks = {}
+        # notified whenever tasks stop being in-flight
+        self._drained = threading.Condition()
+        # task events are published and task states are set by the
+        # dispatcher thread so that the receiver thread is never blocked
+        # on outgoing amqp publishing
+        self._dispatch_queue = Queue.Queue()
+        self._dispatcher = None
 
-    def task_sent(self, event):
-        pass
+    def add_task(self, task):
+        """Start tracking events of a remote task that is about to be sent
 
-    def task_received(self, event):
-        pass
+        :param task: The RemoteWorkflowTask instance
+        """
+        self._tasks[task.id] = task
 
     def task_started(self, event):
         self._handle(tasks_api.TASK_STARTED, event)
@@ -50,26 +94,78 @@ class Monitor(object):
             self._handle(tasks_api.TASK_FAILED, event)
 
     def task_revoked(self, event):
-        pass
+        # revoked tasks will not be executed, so there is nothing more to
+        # wait for
+        with self._drained:
+            self._tasks.pop(event['uuid'], None)
+            self._drained.notify_all()
 
     def task_retried(self, event):
         pass
 
     def _handle(self, state, event):
         task_id = event['uuid']
-        task = self.tasks_graph.get_task(task_id)
+        if state in tasks_api.TERMINATED_STATES:
+            with self._drained:
+                task = self._tasks.pop(task_id, None)
+                self._drained.notify_all()
+        else:
+            task = self._tasks.get(task_id)
         if task is not None:
-            send_task_event(state, task, send_task_event_func_remote,
-                            event)
-            task.set_state(state)
+            self._dispatch_queue.put((state, task, event))
+
+    def in_flight_tasks(self):
+        """
+        :return: The tracked remote tasks that were sent and did not
+                 terminate yet
+        """
+        return self._tasks.values()
+
+    def wait_for_drained(self, task_ids, timeout):
+        """
+        Wait for the given tasks to stop being in-flight
+
+        :param task_ids: The ids of the tasks to wait for
+        :param timeout: The maximum number of seconds to wait
+        :return: The ids of the tasks still in-flight
+        """
+        deadline = time.time() + timeout
+        with self._drained:
+            while True:
+                remaining = [task_id for task_id in task_ids
+                             if task_id in self._tasks]
+                timeout = deadline - time.time()
+                if not remaining or timeout <= 0:
+                    return remaining
+                self._drained.wait(timeout)
+
+    def _dispatch(self):
+        while True:
+            item = self._dispatch_queue.get()
+            if item is None:
+                return
+            state, task, event = item
+            try:
+                send_task_event(state, task, send_task_event_func_remote,
+                                event, self.task_events_verbosity)
+            except Exception as e:
+                self.tasks_graph.ctx.logger.warning(
+                    'Failed sending task event for task {0}: {1}'
+                    .format(task.id, e))
+            finally:
+                task.set_state(state)
+
+    def _start_dispatcher(self):
+        self._dispatcher = threading.Thread(target=self._dispatch)
+        self._dispatcher.daemon = True
+        self._dispatcher.start()
 
     def capture(self):
+        self._start_dispatcher()
         # Only called when celery is used so we import it here
         from cloudify.celery import celery
         with celery.connection() as connection:
             self._receiver = celery.events.Receiver(connection, handlers={
-                'task-sent': self.task_sent,
-                'task-received': self.task_received,
                 'task-started': self.task_started,
                 'task-succeeded': self.task_succeeded,
                 'task-failed': self.task_failed,
@@ -84,7 +180,113 @@ class Monitor(object):
 
     def stop(self):
         self._should_stop = True
-        self._receiver.should_stop = True
+        if self._receiver is not None:
+            self._receiver.should_stop = True
+        # events already handed to the dispatcher are still published
+        self._dispatch_queue.put(None)
+
+
+class ReplyQueueMonitor(Monitor):
+    """
+    Monitor consuming the completion records remote operations publish to
+    the execution reply queue, instead of the celery events stream.
+    No 'started' events are received in this mode.
+    """
+
+    def __init__(self, tasks_graph, reply_queue,
+                 task_events_verbosity=DEFAULT_TASK_EVENTS_VERBOSITY,
+                 reply_timeout=None):
+        """
+        :param tasks_graph: The task graph
+        :param reply_queue: The execution reply queue name
+        :param task_events_verbosity: The task events verbosity mode
+                                      (full/summary)
+        :param reply_timeout: If set, tasks with neither a completion record
+                              nor a result in the result backend after this
+                              many seconds (e.g. when their worker crashed)
+                              fail with a RecoverableError
+        """
+        super(ReplyQueueMonitor, self).__init__(tasks_graph,
+                                                task_events_verbosity)
+        self.reply_queue = reply_queue
+        self.reply_timeout = reply_timeout
+        self._consumer = None
+        # when each in-flight task was sent
+        self._sent_at = {}
+        self._last_missing_replies_check = time.time()
+
+    def connect(self):
+        """
+        Declare the reply queue and start consuming it. Called before any
+        task is sent so that no completion record is lost.
+        """
+        from cloudify.amqp_client import AMQPReplyQueueConsumer
+        self._consumer = AMQPReplyQueueConsumer(self.reply_queue,
+                                                self.task_reply)
+
+    def add_task(self, task):
+        super(ReplyQueueMonitor, self).add_task(task)
+        self._sent_at[task.id] = time.time()
+
+    def task_reply(self, reply):
+        self._sent_at.pop(reply['task_id'], None)
+        task = self._tasks.get(reply['task_id'])
+        if task is None:
+            return
+        task.reply = reply
+        error = tasks_api.task_reply_error(reply)
+        if error is None:
+            self.task_succeeded({'uuid': task.id,
+                                 'result': reply.get('result')})
+        else:
+            self.task_failed({'uuid': task.id, 'exception': repr(error)})
+
+    def _check_missing_replies(self):
+        now = time.time()
+        if now - self._last_missing_replies_check < \
+                REPLY_FALLBACK_CHECK_INTERVAL:
+            return
+        self._last_missing_replies_check = now
+        # Only called when celery is used so we import it here
+        from cloudify.celery import celery
+        for task_id, sent_at in self._sent_at.items():
+            if task_id not in self._tasks:
+                self._sent_at.pop(task_id, None)
+                continue
+            if now - sent_at < REPLY_FALLBACK_CHECK_INTERVAL:
+                continue
+            try:
+                async_result = celery.AsyncResult(task_id)
+                if async_result.ready():
+                    if async_result.successful():
+                        reply = tasks_api.build_task_reply(
+                            task_id, result=async_result.result)
+                    else:
+                        reply = tasks_api.build_task_reply(
+                            task_id, error=async_result.result)
+                    self.task_reply(reply)
+                    continue
+            except Exception as e:
+                self.tasks_graph.ctx.logger.warning(
+                    'Failed checking the result backend for task {0}: {1}'
+                    .format(task_id, e))
+            if self.reply_timeout is not None and \
+                    now - sent_at > self.reply_timeout:
+                self.task_reply(tasks_api.build_task_reply(
+                    task_id, error=RecoverableError(
+                        'No completion record received within {0} seconds'
+                        .format(self.reply_timeout))))
+
+    def _should_stop_consuming(self):
+        self._check_missing_replies()
+        return self._should_stop
+
+    def capture(self):
+        self._start_dispatcher()
+        try:
+            self._consumer.consume(self._should_stop_consuming)
+        finally:
+            self._consumer.close()
 
 
 def send_task_event_func_remote(task, event_type, message,
@@ -95,9 +297,10 @@ def send_task_event_func_remote(task, event_type, message,
 
 
 def send_task_event_func_local(task, event_type, message,
-                               additional_context=None):
+                               additional_context=None,
+                               out_func=None):
     _send_task_event_func(task, event_type, message,
-                          out_func=logs.stdout_event_out,
+                          out_func=out_func or logs.stdout_event_out,
                           additional_context=additional_context)
 
 
@@ -121,7 +324,29 @@ def _filter_task(task, state):
     return state != tasks_api.TASK_FAILED and not task.send_task_events
 
 
-def send_task_event(state, task, send_event_func, event):
+def _record_task_timestamp(task, state):
+    if state == tasks_api.TASK_SENDING:
+        task.sent_at = time.time()
+    elif state == tasks_api.TASK_STARTED:
+        task.started_at = time.time()
+    elif state in tasks_api.TERMINATED_STATES:
+        task.terminated_at = time.time()
+
+
+def _task_timings(task):
+    def elapsed(start, end):
+        if start is None or end is None:
+            return None
+        return round(end - start, 3)
+    return {
+        'task_queue_time': elapsed(task.sent_at, task.started_at),
+        'task_run_time': elapsed(task.started_at, task.terminated_at),
+        'task_total_time': elapsed(task.sent_at, task.terminated_at)
+    }
+
+
+def send_task_event(state, task, send_event_func, event,
+                    verbosity=DEFAULT_TASK_EVENTS_VERBOSITY):
     """
     Send a task event delegating to 'send_event_func'
     which will send events to RabbitMQ or use the workflow context logger
@@ -134,10 +359,19 @@ def send_task_event(state, task, send_event_func, event):
     :param event: a dict with either a result field or an exception fields
                   follows celery event structure but used by local tasks as
                   well
+    :param verbosity: the task events verbosity mode. In 'summary' mode,
+                      'sending' and 'started' events are not sent and the
+                      terminal event of the task carries its timings.
     """
     if _filter_task(task, state):
         return
 
+    _record_task_timestamp(task, state)
+    summary = verbosity == TASK_EVENTS_SUMMARY
+    if summary and state in (tasks_api.TASK_SENDING,
+                             tasks_api.TASK_STARTED):
+        return
+
     if state in (tasks_api.TASK_FAILED, tasks_api.TASK_RESCHEDULED,
                  tasks_api.TASK_SUCCEEDED) and event is None:
         raise RuntimeError('Event for task {0} is None'.format(task.name))
@@ -180,6 +414,8 @@ def send_task_event(state, task, send_event_func, event):
         'task_current_retries': task.current_retries,
         'task_total_retries': task.total_retries
     }
+    if summary:
+        additional_context.update(_task_timings(task))
 
     send_event_func(task=task,
                     event_type=event_type,
@@ -21,11 +21,14 @@ import shutil
 import uuid
 import json
 import threading
+import sqlite3
 from contextlib import contextmanager
 
 from cloudify_rest_client.nodes import Node
 from cloudify_rest_client.node_instances import NodeInstance
 
+from cloudify.utils import (write_file_atomically as _write_file,
+                            fsync_directory as _sync_directory)
 from cloudify.workflows.workflow_context import (
     DEFAULT_LOCAL_TASK_THREAD_POOL_SIZE)
 
@@ -51,13 +54,17 @@ class _Environment(object):
                  ignored_modules=None):
         self.storage = storage
         self.storage.env = self
+        # operation and workflow callables by their dotted path, resolved
+        # when the plan is prepared and reused by every execution
+        self._task_callables = {}
 
         if load_existing:
             self.storage.load(name)
         else:
             plan, nodes, node_instances = _parse_plan(blueprint_path,
                                                       inputs,
-                                                      ignored_modules)
+                                                      ignored_modules,
+                                                      self._task_callables)
             storage.init(
                 name=name,
                 plan=plan,
@@ -73,20 +80,22 @@ class _Environment(object):
     def name(self):
         return self.storage.name
 
+    # evaluated values may reference storage snapshots and are handed to
+    # the caller, hence these are replaced by mutable copies
     def outputs(self):
-        return dsl_functions.evaluate_outputs(
+        return _thaw_nested(dsl_functions.evaluate_outputs(
             outputs_def=self.plan['outputs'],
             get_node_instances_method=self.storage.get_node_instances,
             get_node_instance_method=self.storage.get_node_instance,
-            get_node_method=self.storage.get_node)
+            get_node_method=self.storage.get_node))
 
     def evaluate_functions(self, payload, context):
-        return dsl_functions.evaluate_functions(
+        return _thaw_nested(dsl_functions.evaluate_functions(
             payload=payload,
             context=context,
             get_node_instances_method=self.storage.get_node_instances,
             get_node_instance_method=self.storage.get_node_instance,
-            get_node_method=self.storage.get_node)
+            get_node_method=self.storage.get_node))
 
     def execute(self,
                 workflow,
@@ -94,7 +103,9 @@ class _Environment(object):
                 allow_custom_parameters=False,
                 task_retries=-1,
                 task_retry_interval=30,
-                task_thread_pool_size=DEFAULT_LOCAL_TASK_THREAD_POOL_SIZE):
+                task_thread_pool_size=DEFAULT_LOCAL_TASK_THREAD_POOL_SIZE,
+                event_sink=None,
+                task_events_verbosity=None):
         workflows = self.plan['workflows']
         workflow_name = workflow
         if workflow_name not in workflows:
@@ -104,9 +115,11 @@ class _Environment(object):
                                      workflows.keys()))
 
         workflow = workflows[workflow_name]
-        workflow_method = _get_module_method(workflow['operation'],
-                                             node_name='',
-                                             tpe='workflow')
+        workflow_method = _get_module_method(
+            workflow['operation'],
+            node_name='',
+            tpe='workflow',
+            task_callables=self._task_callables)
         execution_id = str(uuid.uuid4())
         ctx = {
             'local': True,
@@ -115,15 +128,26 @@ class _Environment(object):
             'execution_id': execution_id,
             'workflow_id': workflow_name,
             'storage': self.storage,
+            'task_callables': self._task_callables,
             'task_retries': task_retries,
             'task_retry_interval': task_retry_interval,
             'local_task_thread_pool_size': task_thread_pool_size
         }
 
+        if event_sink is not None:
+            ctx['event_sink'] = event_sink
+        if task_events_verbosity is not None:
+            ctx['task_events_verbosity'] = task_events_verbosity
+
         merged_parameters = _merge_and_validate_execution_parameters(
             workflow, workflow_name, parameters, allow_custom_parameters)
 
-        return workflow_method(__cloudify_context=ctx, **merged_parameters)
+        try:
+            return workflow_method(__cloudify_context=ctx,
+                                   **merged_parameters)
+        finally:
+            if event_sink is not None:
+                event_sink.flush()
 
 
 def init_env(blueprint_path,
@@ -147,7 +171,7 @@ def load_env(name, storage):
                         load_existing=True)
 
 
-def _parse_plan(blueprint_path, inputs, ignored_modules):
+def _parse_plan(blueprint_path, inputs, ignored_modules, task_callables=None):
     if dsl_parser is None:
         raise ImportError('cloudify-dsl-parser must be installed to '
                           'execute local workflows. '
@@ -157,7 +181,8 @@ def _parse_plan(blueprint_path, inputs, ignored_modules):
     nodes = [Node(node) for node in plan['nodes']]
     node_instances = [NodeInstance(instance)
                       for instance in plan['node_instances']]
-    _prepare_nodes_and_instances(nodes, node_instances, ignored_modules)
+    _prepare_nodes_and_instances(nodes, node_instances, ignored_modules,
+                                 task_callables)
     return plan, nodes, node_instances
 
 
@@ -173,7 +198,8 @@ def _validate_node(node):
                              .format(HOST_TYPE))
 
 
-def _prepare_nodes_and_instances(nodes, node_instances, ignored_modules):
+def _prepare_nodes_and_instances(nodes, node_instances, ignored_modules,
+                                 task_callables=None):
 
     def scan(parent, name, node):
         for operation in parent.get(name, {}).values():
@@ -182,7 +208,8 @@ def _prepare_nodes_and_instances(nodes, node_instances, ignored_modules):
             _get_module_method(operation['operation'],
                                tpe=name,
                                node_name=node.id,
-                               ignored_modules=ignored_modules)
+                               ignored_modules=ignored_modules,
+                               task_callables=task_callables)
 
     for node in nodes:
         number_of_instances = node['instances']['deploy']
@@ -205,7 +232,11 @@ def _prepare_nodes_and_instances(nodes, node_instances, ignored_modules):
 
 
 def _get_module_method(module_method_path, tpe, node_name,
-                       ignored_modules=None):
+                       ignored_modules=None, task_callables=None):
+    if task_callables is not None:
+        method = task_callables.get(module_method_path)
+        if method is not None:
+            return method
     ignored_modules = ignored_modules or []
     split = module_method_path.split('.')
     module_name = '.'.join(split[:-1])
@@ -219,12 +250,15 @@ def _get_module_method(module_method_path, tpe, node_name,
                           '[node={1}, type={2}]'
                           .format(module_name, node_name, tpe))
     try:
-        return getattr(module, method_name)
+        method = getattr(module, method_name)
     except AttributeError:
         raise AttributeError("mapping error: {0} has no attribute '{1}' "
                              "[node={2}, type={3}]"
                              .format(module.__name__, method_name,
                                      node_name, tpe))
+    if task_callables is not None:
+        task_callables[module_method_path] = method
+    return method
 
 
 def _merge_and_validate_execution_parameters(
@@ -268,6 +302,111 @@ def _merge_and_validate_execution_parameters(
     return merged_parameters
 
 
+def _immutable(self, *args, **kwargs):
+    raise TypeError('{0} is a read-only storage snapshot, use '
+                    'update_node_instance to modify it'
+                    .format(type(self).__name__))
+
+
+class _ImmutableDict(dict):
+    """A read-only dict shared between storage snapshots.
+
+    Deep copying an immutable dict returns a mutable copy of it.
+    """
+
+    _mutable_type = dict
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = \
+        update = _immutable
+
+    def __deepcopy__(self, memo):
+        return self._mutable_type(dict(
+            (key, copy.deepcopy(value, memo))
+            for key, value in self.iteritems()))
+
+    def __reduce__(self):
+        return self._mutable_type, (dict(self),)
+
+
+class _ImmutableList(list):
+    """A read-only list shared between storage snapshots."""
+
+    _mutable_type = list
+
+    __setitem__ = __delitem__ = __setslice__ = __delslice__ = __iadd__ = \
+        __imul__ = append = extend = insert = pop = remove = reverse = \
+        sort = _immutable
+
+    def __deepcopy__(self, memo):
+        return [copy.deepcopy(item, memo) for item in self]
+
+    def __reduce__(self):
+        return list, (list(self),)
+
+
+class _NodeSnapshot(_ImmutableDict, Node):
+
+    _mutable_type = Node
+
+
+class _NodeInstanceSnapshot(_ImmutableDict, NodeInstance):
+
+    _mutable_type = NodeInstance
+
+
+def _freeze(value):
+    if isinstance(value, (_ImmutableDict, _ImmutableList)):
+        return value
+    if isinstance(value, dict):
+        return _ImmutableDict((key, _freeze(item))
+                              for key, item in value.iteritems())
+    if isinstance(value, list):
+        return _ImmutableList(_freeze(item) for item in value)
+    return value
+
+
+def _thaw(value):
+    """Returns a mutable copy of a (possibly nested) storage snapshot value.
+
+    Values that are not snapshots are shared, as snapshots only nest other
+    snapshots and plain values.
+    """
+    if isinstance(value, _ImmutableDict):
+        return value._mutable_type((key, _thaw(item))
+                                   for key, item in value.iteritems())
+    if isinstance(value, _ImmutableList):
+        return [_thaw(item) for item in value]
+    return value
+
+
+def _thaw_nested(value):
+    """Replaces the storage snapshot values nested in plain dicts and lists
+    by mutable copies, in place. Other values are neither copied nor
+    traversed.
+    """
+    if isinstance(value, (_ImmutableDict, _ImmutableList)):
+        return _thaw(value)
+    if isinstance(value, dict):
+        for key, item in value.items():
+            value[key] = _thaw_nested(item)
+    elif isinstance(value, list):
+        value[:] = [_thaw_nested(item) for item in value]
+    return value
+
+
+def _snapshot(value, snapshot_type):
+    """Returns an immutable snapshot of a node or a node instance.
+
+    Nested values that are already frozen are shared with the previous
+    versions of the snapshot rather than copied.
+    """
+    return snapshot_type((key, _freeze(item))
+                         for key, item in value.iteritems())
+
+
 class _Storage(object):
 
     def __init__(self):
@@ -276,6 +415,7 @@ class _Storage(object):
         self.plan = None
         self._nodes = None
         self._locks = None
+        self._node_instance_ids = None
         self.env = None
 
     def init(self, name, plan, nodes, node_instances, blueprint_path):
@@ -285,10 +425,19 @@ class _Storage(object):
         self._init_locks_and_nodes(nodes)
 
     def _init_locks_and_nodes(self, nodes):
-        self._nodes = dict((node.id, node) for node in nodes)
+        self._nodes = dict((node.id, _snapshot(node, _NodeSnapshot))
+                           for node in nodes)
         self._locks = dict((instance_id, threading.RLock()) for instance_id
                            in self._instance_ids())
 
+    def _index_node_instances(self, node_instances):
+        # instances never move between nodes, so the index is only built
+        # when the storage is initialized or loaded
+        index = {}
+        for instance in node_instances:
+            index.setdefault(instance.node_id, []).append(instance.id)
+        self._node_instance_ids = index
+
     def load(self, name):
         raise NotImplementedError()
 
@@ -319,13 +468,15 @@ class _Storage(object):
                                            .format(version,
                                                    node_instance_id,
                                                    instance['version']))
-            else:
-                instance['version'] += 1
+            # stored instances are snapshots shared with readers, so every
+            # update stores a new version instead of modifying the current
+            updated = NodeInstance(instance)
+            updated['version'] = instance['version'] + 1
             if runtime_properties is not None:
-                instance['runtime_properties'] = runtime_properties
+                updated['runtime_properties'] = runtime_properties
             if state is not None:
-                instance['state'] = state
-            self._store_instance(instance)
+                updated['state'] = state
+            self._store_instance(updated)
 
     def _get_node_instance(self, node_instance_id):
         instance = self._load_instance(node_instance_id)
@@ -339,13 +490,13 @@ class _Storage(object):
         if node is None:
             raise RuntimeError('Node {0} does not exist'
                                .format(node_id))
-        return copy.deepcopy(node)
+        return node
 
     def get_nodes(self):
-        return copy.deepcopy(self._nodes.values())
+        return self._nodes.values()
 
     def get_node_instance(self, node_instance_id):
-        return copy.deepcopy(self._get_node_instance(node_instance_id))
+        return self._get_node_instance(node_instance_id)
 
     def _load_instance(self, node_instance_id):
         raise NotImplementedError()
@@ -371,8 +522,10 @@ class InMemoryStorage(_Storage):
 
     def init(self, name, plan, nodes, node_instances, blueprint_path):
         self.plan = plan
-        self._node_instances = dict((instance.id, instance)
-                                    for instance in node_instances)
+        self._node_instances = dict(
+            (instance.id, _snapshot(instance, _NodeInstanceSnapshot))
+            for instance in node_instances)
+        self._index_node_instances(node_instances)
         super(InMemoryStorage, self).init(name, plan, nodes, node_instances,
                                           blueprint_path)
 
@@ -383,21 +536,32 @@ class InMemoryStorage(_Storage):
         return self._node_instances.get(node_instance_id)
 
     def _store_instance(self, node_instance):
-        pass
+        self._node_instances[node_instance.id] = _snapshot(
+            node_instance, _NodeInstanceSnapshot)
 
     def get_node_instances(self, node_id=None):
-        instances = self._node_instances.values()
         if node_id:
-            instances = [i for i in instances if i.node_id == node_id]
-        return copy.deepcopy(instances)
+            return [self._node_instances[instance_id] for instance_id
+                    in self._node_instance_ids.get(node_id, [])]
+        return self._node_instances.values()
 
     def _instance_ids(self):
         return self._node_instances.keys()
 
 
 class FileStorage(_Storage):
-
-    def __init__(self, storage_dir='/tmp/cloudify-workflows'):
+    """Keeps every node instance in a file of its own.
+
+    Files are replaced atomically: they are written to a temporary file
+    which is fsynced and then renamed over the previous version. With
+    ``group_commit``, node instance updates of concurrent local tasks
+    are written in batches: all files of a batch are written before they
+    are fsynced back to back, and the batch shares a single directory
+    fsync.
+    """
+
+    def __init__(self, storage_dir='/tmp/cloudify-workflows',
+                 group_commit=False):
         super(FileStorage, self).__init__()
         self._root_storage_dir = os.path.join(storage_dir)
         self._storage_dir = None
@@ -405,6 +569,8 @@ class FileStorage(_Storage):
         self._data_path = None
         self._payload_path = None
         self._blueprint_path = None
+        self._group_commit = group_commit
+        self._committer = None
 
     def init(self, name, plan, nodes, node_instances, blueprint_path):
         storage_dir = os.path.join(self._root_storage_dir, name)
@@ -413,23 +579,16 @@ class FileStorage(_Storage):
         payload_path = os.path.join(storage_dir, 'payload')
         os.makedirs(storage_dir)
         os.mkdir(instances_dir)
-        with open(payload_path, 'w') as f:
-            f.write(json.dumps({}))
+        _write_file(payload_path, json.dumps({}))
 
         blueprint_filename = os.path.basename(os.path.abspath(blueprint_path))
-        with open(data_path, 'w') as f:
-            f.write(json.dumps({
-                'plan': plan,
-                'blueprint_filename': blueprint_filename,
-                'nodes': nodes
-            }))
-        resources_root = os.path.dirname(os.path.abspath(blueprint_path))
+        _write_file(data_path, json.dumps({
+            'plan': plan,
+            'blueprint_filename': blueprint_filename,
+            'nodes': nodes
+        }))
         self.resources_root = os.path.join(storage_dir, 'resources')
-
-        def ignore(src, names):
-            return names if os.path.abspath(self.resources_root) == src \
-                else set()
-        shutil.copytree(resources_root, self.resources_root, ignore=ignore)
+        _copy_resources(blueprint_path, self.resources_root)
         self._instances_dir = instances_dir
         for instance in node_instances:
             self._store_instance(instance, lock=False)
@@ -441,6 +600,8 @@ class FileStorage(_Storage):
         self._instances_dir = os.path.join(self._storage_dir, 'node-instances')
         self._payload_path = os.path.join(self._storage_dir, 'payload')
         self._data_path = os.path.join(self._storage_dir, 'data')
+        if self._group_commit:
+            self._committer = _GroupCommitter(self._instances_dir)
         with open(self._data_path) as f:
             data = json.loads(f.read())
         self.plan = data['plan']
@@ -449,22 +610,20 @@ class FileStorage(_Storage):
                                             data['blueprint_filename'])
         nodes = [Node(node) for node in data['nodes']]
         self._init_locks_and_nodes(nodes)
+        self._index_node_instances(self._get_node_instance(instance_id)
+                                   for instance_id in self._instance_ids())
 
     @contextmanager
     def payload(self):
         with open(self._payload_path, 'r') as f:
             payload = json.load(f)
             yield payload
-        with open(self._payload_path, 'w') as f:
-            json.dump(payload, f, indent=2)
-            f.write(os.linesep)
+        _write_file(self._payload_path,
+                    json.dumps(payload, indent=2) + os.linesep)
 
     def get_blueprint_path(self):
         return self._blueprint_path
 
-    def get_node_instance(self, node_instance_id):
-        return self._get_node_instance(node_instance_id)
-
     def _load_instance(self, node_instance_id):
         with self._lock(node_instance_id):
             with open(self._instance_path(node_instance_id)) as f:
@@ -476,8 +635,11 @@ class FileStorage(_Storage):
             instance_lock = self._lock(node_instance.id)
             instance_lock.acquire()
         try:
-            with open(self._instance_path(node_instance.id), 'w') as f:
-                f.write(json.dumps(node_instance))
+            path = self._instance_path(node_instance.id)
+            if self._committer is not None:
+                self._committer.write(path, json.dumps(node_instance))
+            else:
+                _write_file(path, json.dumps(node_instance))
         finally:
             if lock and instance_lock:
                 instance_lock.release()
@@ -486,14 +648,233 @@ class FileStorage(_Storage):
         return os.path.join(self._instances_dir, node_instance_id)
 
     def get_node_instances(self, node_id=None):
-        instances = [self._get_node_instance(instance_id)
-                     for instance_id in self._instance_ids()]
         if node_id:
-            instances = [i for i in instances if i.node_id == node_id]
-        return instances
+            instance_ids = self._node_instance_ids.get(node_id, [])
+        else:
+            instance_ids = self._instance_ids()
+        return [self._get_node_instance(instance_id)
+                for instance_id in instance_ids]
 
     def _instance_ids(self):
-        return os.listdir(self._instances_dir)
+        # skip temporary files of writes in progress
+        return [instance_id for instance_id in os.listdir(self._instances_dir)
+                if not instance_id.startswith('.')]
+
+
+class SQLiteStorage(_Storage):
+    """Keeps the plan, nodes, node instances and payload of an environment
+    in a single SQLite database.
+
+    Each update of a node instance is a single transaction that only
+    succeeds if the stored version is still the one the update was based
+    on, so concurrent writers, even in different processes, never
+    overwrite each other.
+    """
+
+    _SCHEMA = (
+        'CREATE TABLE data (key TEXT PRIMARY KEY, value TEXT NOT NULL)',
+        'CREATE TABLE nodes (id TEXT PRIMARY KEY, node TEXT NOT NULL)',
+        'CREATE TABLE node_instances (id TEXT PRIMARY KEY, '
+        'node_id TEXT NOT NULL, version INTEGER NOT NULL, '
+        'node_instance TEXT NOT NULL)',
+        'CREATE INDEX node_instances_node_id ON node_instances (node_id)'
+    )
+
+    def __init__(self, storage_dir='/tmp/cloudify-workflows'):
+        super(SQLiteStorage, self).__init__()
+        self._root_storage_dir = storage_dir
+        self._storage_dir = None
+        self._db_path = None
+        self._blueprint_path = None
+        # sqlite connections may only be used by the thread that
+        # created them
+        self._connections = threading.local()
+
+    def init(self, name, plan, nodes, node_instances, blueprint_path):
+        storage_dir = os.path.join(self._root_storage_dir, name)
+        os.makedirs(storage_dir)
+        self._db_path = os.path.join(storage_dir, 'storage.db')
+        blueprint_filename = os.path.basename(os.path.abspath(blueprint_path))
+        with self._connection() as connection:
+            for statement in self._SCHEMA:
+                connection.execute(statement)
+            connection.executemany(
+                'INSERT INTO data (key, value) VALUES (?, ?)',
+                [('plan', json.dumps(plan)),
+                 ('blueprint_filename', json.dumps(blueprint_filename)),
+                 ('payload', json.dumps({}))])
+            connection.executemany(
+                'INSERT INTO nodes (id, node) VALUES (?, ?)',
+                ((node.id, json.dumps(node)) for node in nodes))
+            connection.executemany(
+                'INSERT INTO node_instances '
+                '(id, node_id, version, node_instance) VALUES (?, ?, ?, ?)',
+                ((instance.id, instance.node_id, instance.version,
+                  json.dumps(instance)) for instance in node_instances))
+        _copy_resources(blueprint_path,
+                        os.path.join(storage_dir, 'resources'))
+        self.load(name)
+
+    def load(self, name):
+        self.name = name
+        self._storage_dir = os.path.join(self._root_storage_dir, name)
+        self._db_path = os.path.join(self._storage_dir, 'storage.db')
+        if not os.path.isfile(self._db_path):
+            raise RuntimeError('Storage {0} does not exist'
+                               .format(self._db_path))
+        self.plan = self._get_data('plan')
+        self.resources_root = os.path.join(self._storage_dir, 'resources')
+        self._blueprint_path = os.path.join(
+            self.resources_root, self._get_data('blueprint_filename'))
+        nodes = [Node(json.loads(node)) for node, in self._connection()
+                 .execute('SELECT node FROM nodes')]
+        self._init_locks_and_nodes(nodes)
+
+    def _connection(self):
+        connection = getattr(self._connections, 'connection', None)
+        if connection is None or self._connections.path != self._db_path:
+            connection = sqlite3.connect(self._db_path, timeout=60)
+            self._connections.connection = connection
+            self._connections.path = self._db_path
+        return connection
+
+    def _get_data(self, key):
+        row = self._connection().execute(
+            'SELECT value FROM data WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0])
+
+    @contextmanager
+    def payload(self):
+        payload = self._get_data('payload')
+        yield payload
+        with self._connection() as connection:
+            connection.execute('UPDATE data SET value = ? WHERE key = ?',
+                               (json.dumps(payload), 'payload'))
+
+    def get_blueprint_path(self):
+        return self._blueprint_path
+
+    def _load_instance(self, node_instance_id):
+        row = self._connection().execute(
+            'SELECT node_instance FROM node_instances WHERE id = ?',
+            (node_instance_id,)).fetchone()
+        return NodeInstance(json.loads(row[0])) if row else None
+
+    def _store_instance(self, node_instance):
+        with self._connection() as connection:
+            updated = connection.execute(
+                'UPDATE node_instances SET version = ?, node_instance = ? '
+                'WHERE id = ? AND version = ?',
+                (node_instance.version, json.dumps(node_instance),
+                 node_instance.id, node_instance.version - 1)).rowcount
+        if not updated:
+            raise StorageConflictError('node instance {0} was modified by '
+                                       'another writer'
+                                       .format(node_instance.id))
+
+    def get_node_instances(self, node_id=None):
+        if node_id:
+            rows = self._connection().execute(
+                'SELECT node_instance FROM node_instances WHERE node_id = ?',
+                (node_id,))
+        else:
+            rows = self._connection().execute(
+                'SELECT node_instance FROM node_instances')
+        return [NodeInstance(json.loads(instance)) for instance, in rows]
+
+    def _instance_ids(self):
+        return [instance_id for instance_id, in self._connection().execute(
+            'SELECT id FROM node_instances')]
+
+
+def _write_files(files, directory):
+    """Atomically replaces the content of several files of ``directory``.
+
+    All temporary files of the batch are written before any of them is
+    fsynced, so their fsyncs are issued back to back and the filesystem
+    flushes the batch together. The renames share a single directory
+    fsync.
+
+    :param files: A dict from file path to its new content
+    """
+    temp_paths = {}
+    try:
+        for path, data in files.iteritems():
+            fd, temp_path = tempfile.mkstemp(
+                dir=directory, prefix='.{0}.'.format(os.path.basename(path)))
+            temp_paths[path] = temp_path
+            with os.fdopen(fd, 'w') as f:
+                f.write(data)
+        for temp_path in temp_paths.itervalues():
+            fd = os.open(temp_path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        for path in files:
+            os.rename(temp_paths.pop(path), path)
+    except Exception:
+        for temp_path in temp_paths.itervalues():
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        raise
+    _sync_directory(directory)
+
+
+class _GroupCommitter(object):
+    """Writes files of concurrent writers in batches.
+
+    The first writer to arrive while no batch is being written writes
+    the pending batch on behalf of everyone waiting (see ``_write_files``),
+    then wakes them up. Writes arriving meanwhile are collected into the
+    next batch, where repeated writes of the same file only keep the
+    latest content.
+    """
+
+    def __init__(self, directory):
+        self._directory = directory
+        self._condition = threading.Condition()
+        self._pending = {}
+        self._batch = 0
+        self._committed = 0
+        self._committing = False
+        self._errors = {}
+
+    def write(self, path, data):
+        with self._condition:
+            self._pending[path] = data
+            batch = self._batch
+            while self._committed <= batch and self._committing:
+                self._condition.wait()
+            if self._committed > batch:
+                error = self._errors.get(batch)
+                if error is not None:
+                    raise error
+                return
+            self._committing = True
+            pending, self._pending = self._pending, {}
+            self._batch += 1
+        error = None
+        try:
+            _write_files(pending, self._directory)
+        except Exception, e:
+            error = e
+        with self._condition:
+            if error is not None:
+                self._errors[batch] = error
+            self._committed = batch + 1
+            self._committing = False
+            self._condition.notify_all()
+        if error is not None:
+            raise error
+
+
+def _copy_resources(blueprint_path, resources_root):
+    blueprint_dir = os.path.dirname(os.path.abspath(blueprint_path))
+
+    def ignore(src, names):
+        return names if os.path.abspath(resources_root) == src else set()
+    shutil.copytree(blueprint_dir, resources_root, ignore=ignore)
 
 
 class StorageConflictError(Exception):
@@ -15,11 +15,14 @@
 
 
 import sys
+import json
 import time
 import uuid
 import Queue
+import threading
 
 from cloudify import exceptions
+from cloudify.utils import get_exception_message
 from cloudify.workflows import api
 
 INFINITE_TOTAL_RETRIES = -1
@@ -28,6 +31,15 @@ DEFAULT_RETRY_INTERVAL = 30
 
 DEFAULT_SEND_TASK_EVENTS = True
 
+DEFAULT_REGISTERED_TASKS_TTL = 300
+DEFAULT_REGISTERED_TASKS_BATCH_SIZE = 50
+
+DEFAULT_REVOKE_BATCH_SIZE = 100
+
+# waits on task termination are bounded so that the waiting thread can
+# still be interrupted (an untimed Condition.wait ignores KeyboardInterrupt)
+TASK_TERMINATED_POLL_INTERVAL = 1
+
 TASK_PENDING = 'pending'
 TASK_SENDING = 'sending'
 TASK_SENT = 'sent'
@@ -38,6 +50,17 @@ TASK_FAILED = 'failed'
 
 TERMINATED_STATES = [TASK_RESCHEDULED, TASK_SUCCEEDED, TASK_FAILED]
 
+# cloudify context key holding the name of the execution reply queue remote
+# operations publish their completion record to
+TASK_REPLY_QUEUE_KEY = 'task_reply_queue'
+
+# exception types that go through task completion records as is, anything
+# else is restored as a RecoverableError
+_TASK_REPLY_ERROR_TYPES = dict((error_type.__name__, error_type) for
+                               error_type in [exceptions.OperationRetry,
+                                              exceptions.RecoverableError,
+                                              exceptions.NonRecoverableError])
+
 
 def retry_failure_handler(task):
     """Basic on_success/on_failure handler that always returns retry"""
@@ -87,16 +110,24 @@ class WorkflowTask(object):
         self.error = None
         self.total_retries = total_retries
         self.retry_interval = retry_interval
-        self.terminated = Queue.Queue(maxsize=1)
+        self.terminated = threading.Condition()
         self.is_terminated = False
         self.workflow_context = workflow_context
         self.send_task_events = send_task_events
 
         self.current_retries = 0
+        self.created_at = time.time()
+        # lifecycle timestamps, recorded when task events are sent
+        self.sent_at = None
+        self.started_at = None
+        self.terminated_at = None
         # timestamp for which the task should not be executed
         # by the task graph before reached, overridden by the task
         # graph during retries
         self.execute_after = time.time()
+        # identifies the task across runs of a resumed execution, assigned
+        # by the task graph
+        self.checkpoint_key = None
 
     def dump(self):
         return {
@@ -105,6 +136,8 @@ class WorkflowTask(object):
             'info': self.info,
             'error': self.error,
             'current_retries': self.current_retries,
+            'execute_after': self.execute_after,
+            'checkpoint_key': self.checkpoint_key,
             'cloudify_context': self.cloudify_context
         }
 
@@ -148,13 +181,27 @@ class WorkflowTask(object):
                                '[task={1}]'.format(state, str(self)))
         self._state = state
         if state in TERMINATED_STATES:
-            self.is_terminated = True
-            self.terminated.put_nowait(True)
+            with self.terminated:
+                self.is_terminated = True
+                self.terminated.notify_all()
 
     def wait_for_terminated(self, timeout=None):
-        if self.is_terminated:
-            return
-        self.terminated.get(timeout=timeout)
+        """
+        Block until the task terminates. Returns early if the execution is
+        cancelled, in which case Queue.Empty is raised like on timeout.
+        """
+        def wake_up():
+            with self.terminated:
+                self.terminated.notify_all()
+        api.cancellation_token.add_callback(wake_up)
+        try:
+            with self.terminated:
+                if not self.is_terminated and not api.has_cancel_request():
+                    self.terminated.wait(timeout)
+        finally:
+            api.cancellation_token.remove_callback(wake_up)
+        if not self.is_terminated:
+            raise Queue.Empty()
 
     def handle_task_terminated(self):
         if self.get_state() in (TASK_FAILED, TASK_RESCHEDULED):
@@ -250,9 +297,6 @@ class WorkflowTask(object):
 class RemoteWorkflowTask(WorkflowTask):
     """A WorkflowTask wrapping a celery based task"""
 
-    # cache for registered tasks queries to celery workers
-    cache = {}
-
     def __init__(self,
                  task,
                  cloudify_context,
@@ -299,6 +343,9 @@ class RemoteWorkflowTask(WorkflowTask):
             send_task_events=send_task_events)
         self.task = task
         self._cloudify_context = cloudify_context
+        # the completion record of this task, when received through the
+        # execution reply queue
+        self.reply = None
 
     def apply_async(self):
         """
@@ -312,8 +359,13 @@ class RemoteWorkflowTask(WorkflowTask):
             self._verify_task_registered()
             self.workflow_context.internal.send_task_event(TASK_SENDING, self)
             self.set_state(TASK_SENT)
+            self.workflow_context.internal.track_remote_task(self)
             async_result = self.task.apply_async(task_id=self.id)
-            self.async_result = RemoteWorkflowTaskResult(self, async_result)
+            if self.cloudify_context.get(TASK_REPLY_QUEUE_KEY):
+                self.async_result = RemoteWorkflowTaskReplyResult(self)
+            else:
+                self.async_result = RemoteWorkflowTaskResult(self,
+                                                             async_result)
         except exceptions.NonRecoverableError as e:
             self.set_state(TASK_FAILED)
             self.workflow_context.internal\
@@ -323,6 +375,37 @@ class RemoteWorkflowTask(WorkflowTask):
 
         return self.async_result
 
+    def reattach(self, task_id):
+        """
+        Track a task that was already sent, by a previous run of a resumed
+        execution, instead of sending it again. Its result is read from the
+        celery result backend, as its completion may have been missed.
+
+        :param task_id: The id the task was sent with
+        """
+        # import here because this only applies in remote execution
+        # environments
+        from cloudify.celery import celery
+        self.id = task_id
+        self.cloudify_context['task_id'] = task_id
+        self.set_state(TASK_SENT)
+        self.workflow_context.internal.track_remote_task(self)
+        self.async_result = RemoteWorkflowTaskResult(
+            self, celery.AsyncResult(task_id))
+
+    def check_reattached_result(self):
+        """
+        Set the state of a reattached task if the celery result backend
+        holds its result
+        """
+        async_result = self.async_result.async_result
+        if self.is_terminated or not async_result.ready():
+            return
+        if async_result.successful():
+            self.set_state(TASK_SUCCEEDED)
+        else:
+            self.set_state(TASK_FAILED)
+
     def is_local(self):
         return False
 
@@ -355,18 +438,7 @@ class RemoteWorkflowTask(WorkflowTask):
         return self.cloudify_context['task_target']
 
     def _verify_task_registered(self):
-        verify_task_registered(self.name, self.target, self._get_registered)
-
-    def _get_registered(self):
-        # import here because this only applies in remote execution
-        # environments
-        from cloudify.celery import celery
-
-        worker_name = 'celery@{0}'.format(self.target)
-        inspect = celery.control.inspect(destination=[worker_name])
-        registered = inspect.registered() or {}
-        result = registered.get(worker_name, set())
-        return set(result)
+        registered_tasks.verify(self.name, self.target)
 
 
 class LocalWorkflowTask(WorkflowTask):
@@ -548,17 +620,17 @@ class WorkflowTaskResult(object):
         while True:
             self._check_execution_cancelled()
             try:
-                self.task.wait_for_terminated(timeout=1)
+                self.task.wait_for_terminated(
+                    timeout=TASK_TERMINATED_POLL_INTERVAL)
                 break
             except Queue.Empty:
                 continue
 
     def _sleep(self, seconds):
-        while seconds > 0:
+        self._check_execution_cancelled()
+        if seconds > 0:
+            api.cancellation_token.wait(seconds)
             self._check_execution_cancelled()
-            sleep_time = 1 if seconds > 1 else seconds
-            time.sleep(sleep_time)
-            seconds -= sleep_time
 
     def get(self, retry_on_failure=True):
         """
@@ -607,6 +679,29 @@ class RemoteWorkflowTaskResult(WorkflowTaskResult):
         return self.async_result.result
 
 
+class RemoteWorkflowTaskReplyResult(WorkflowTaskResult):
+    """
+    A wrapper for the completion record of a remote task received through
+    the execution reply queue
+    """
+
+    def _get(self):
+        error = task_reply_error(self.task.reply)
+        if error is not None:
+            raise error
+        return self.task.reply.get('result')
+
+    def _refresh_state(self):
+        pass
+
+    @property
+    def result(self):
+        error = task_reply_error(self.task.reply)
+        if error is not None:
+            return error
+        return self.task.reply.get('result')
+
+
 class LocalWorkflowTaskResult(WorkflowTaskResult):
     """A wrapper for local workflow task results"""
 
@@ -678,16 +773,248 @@ class HandlerResult(object):
         return HandlerResult(cls.HANDLER_IGNORE)
 
 
-def verify_task_registered(name, target, get_registered):
+def get_registered_tasks(targets):
+    """
+    Query celery workers for their registered tasks using a single
+    broadcast
+
+    :param targets: The workers targets (queue names)
+    :return: A dict from target to the set of tasks registered in its
+             worker. Targets of workers that did not reply are omitted.
+    """
+    # import here because this only applies in remote execution
+    # environments
+    from cloudify.celery import celery
+
+    worker_names = dict(('celery@{0}'.format(target), target)
+                        for target in targets)
+    inspect = celery.control.inspect(destination=worker_names.keys())
+    registered = inspect.registered() or {}
+    return dict((worker_names[worker_name], set(worker_tasks))
+                for worker_name, worker_tasks in registered.iteritems()
+                if worker_name in worker_names)
+
+
+def revoke_tasks(tasks, terminate=False,
+                 batch_size=DEFAULT_REVOKE_BATCH_SIZE):
+    """
+    Revoke remote tasks, sending a single revoke broadcast for up to
+    ``batch_size`` tasks of the same target
+
+    :param tasks: The RemoteWorkflowTask instances to revoke
+    :param terminate: Whether to also terminate tasks that already started
+                      (otherwise, only tasks not yet started are dropped)
+    :param batch_size: The maximum number of task ids per broadcast
+    """
+    # import here because this only applies in remote execution
+    # environments
+    from cloudify.celery import celery
+
+    task_ids_by_target = {}
+    for task in tasks:
+        task_ids_by_target.setdefault(task.target, []).append(task.id)
+    for target, task_ids in task_ids_by_target.iteritems():
+        for i in range(0, len(task_ids), batch_size):
+            celery.control.revoke(task_ids[i:i + batch_size],
+                                  destination=['celery@{0}'.format(target)],
+                                  terminate=terminate)
+
+
+class RegisteredTasksRegistry(object):
+    """
+    A cache of the tasks registered in each celery worker, keyed by the
+    worker target (queue name).
+
+    Entries are served for ``ttl`` seconds. Older entries are still served
+    while being refreshed in the background. A task missing from a cached
+    entry is always queried again before failing, since the worker may have
+    registered it since (e.g. after a plugin install or a restart). Workers
+    that did not reply are not cached, so these are queried again on the
+    next verification.
+
+    :param query: A function from a list of targets to a dict from target
+                  to its set of registered tasks
+                  (see ``get_registered_tasks``)
+    :param ttl: Seconds for which an entry is considered fresh
+    :param batch_size: Maximum number of workers queried by a single
+                       broadcast during warm up
+    """
 
-    cache = RemoteWorkflowTask.cache
-    registered = cache.get(target, set())
-    if name not in registered:
-        registered = get_registered()
-        cache[target] = registered
-
-    if name not in registered:
-        raise exceptions.NonRecoverableError(
-            'Missing task: {0} in worker celery.{1} \n'
-            'Registered tasks are: {2}'
-            .format(name, target, registered))
+    def __init__(self,
+                 query=get_registered_tasks,
+                 ttl=DEFAULT_REGISTERED_TASKS_TTL,
+                 batch_size=DEFAULT_REGISTERED_TASKS_BATCH_SIZE):
+        self.query = query
+        self.ttl = ttl
+        self.batch_size = batch_size
+        # target -> (registered tasks, fetch timestamp)
+        self._entries = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def get(self, target):
+        """
+        :param target: The worker target
+        :return: The set of tasks registered in the target worker
+        """
+        entry = self._entries.get(target)
+        if entry is None:
+            return self._fetch([target]).get(target, set())
+        registered, fetched_at = entry
+        if time.time() - fetched_at > self.ttl:
+            self._refresh_in_background(target)
+        return registered
+
+    def verify(self, name, target, query=None):
+        """
+        Verify a task is registered in the target worker
+
+        :param name: The task name
+        :param target: The worker target
+        :param query: Used instead of the registry query for this call
+        :raise NonRecoverableError: if the task is not registered
+        """
+        entry = self._entries.get(target)
+        if entry is not None:
+            registered, fetched_at = entry
+            if name in registered:
+                if time.time() - fetched_at > self.ttl:
+                    self._refresh_in_background(target)
+                return
+
+        registered = self._fetch([target], query).get(target, set())
+        if name not in registered:
+            raise exceptions.NonRecoverableError(
+                'Missing task: {0} in worker celery.{1} \n'
+                'Registered tasks are: {2}'
+                .format(name, target, registered))
+
+    def warm_up(self, targets):
+        """
+        Fetch the registered tasks of all targets that are not cached yet.
+        Targets are queried in batches, all batches in parallel.
+
+        :param targets: The workers targets
+        """
+        targets = sorted(set(target for target in targets
+                             if target not in self._entries))
+        batches = [targets[i:i + self.batch_size]
+                   for i in range(0, len(targets), self.batch_size)]
+        if len(batches) == 1:
+            self._fetch_quietly(batches[0])
+            return
+        threads = [threading.Thread(target=self._fetch_quietly,
+                                    args=(batch,))
+                   for batch in batches]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def invalidate(self, target=None):
+        """
+        Drop the cached entry of a target, or all entries if no target is
+        provided
+        """
+        with self._lock:
+            if target is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(target, None)
+
+    def _fetch(self, targets, query=None):
+        query = query or self.query
+        fetched_at = time.time()
+        result = query(targets)
+        with self._lock:
+            # workers that did not reply are not cached
+            for target, registered in result.iteritems():
+                self._entries[target] = (registered, fetched_at)
+        return result
+
+    def _fetch_quietly(self, targets):
+        # a failed query is not cached, the next verification of any of
+        # these targets queries again
+        try:
+            self._fetch(targets)
+        except Exception:
+            pass
+
+    def _refresh_in_background(self, target):
+        with self._lock:
+            if target in self._refreshing:
+                return
+            self._refreshing.add(target)
+
+        def refresh():
+            try:
+                self._fetch_quietly([target])
+            finally:
+                with self._lock:
+                    self._refreshing.discard(target)
+
+        thread = threading.Thread(target=refresh)
+        thread.daemon = True
+        thread.start()
+
+
+# registered tasks of celery workers, shared by all executions in this
+# process
+registered_tasks = RegisteredTasksRegistry()
+
+
+def verify_task_registered(name, target, get_registered):
+    registered_tasks.verify(name, target,
+                            lambda targets: {target: get_registered()})
+
+
+def build_task_reply(task_id, result=None, error=None):
+    """
+    Build the completion record a remote operation publishes to the
+    execution reply queue
+
+    :param task_id: The task id
+    :param result: The operation result (its repr is used if it is not
+                   JSON serializable)
+    :param error: The exception raised by the operation, if any
+    :return: The completion record dict
+    """
+    reply = {'task_id': task_id}
+    if error is None:
+        try:
+            json.dumps(result)
+        except (TypeError, ValueError):
+            result = repr(result)
+        reply['result'] = result
+    else:
+        reply['error'] = {
+            'type': type(error).__name__,
+            'message': get_exception_message(error),
+            'retry_after': getattr(error, 'retry_after', None)
+        }
+    return reply
+
+
+def task_reply_error(reply):
+    """
+    :param reply: A completion record built by ``build_task_reply``
+    :return: The exception described by the record, None if the task
+             succeeded
+    """
+    error = (reply or {}).get('error')
+    if error is None:
+        return None
+    error_type = _TASK_REPLY_ERROR_TYPES.get(error['type'])
+    if error_type is None:
+        if error['type'] == exceptions.HttpException.__name__:
+            error_type = exceptions.NonRecoverableError
+        else:
+            error_type = exceptions.RecoverableError
+    # the message already includes the retry_after suffix so the
+    # exception constructors are bypassed
+    exception = error_type.__new__(error_type)
+    Exception.__init__(exception, error['message'])
+    if issubclass(error_type, exceptions.RecoverableError):
+        exception.retry_after = error.get('retry_after')
+    return exception
@@ -17,23 +17,169 @@
 import os
 import json
 import time
+import socket
+import threading
 
 import networkx as nx
 
+from cloudify.utils import write_file_atomically
 from cloudify.workflows import api
 from cloudify.workflows import tasks
 
+# seconds between checkpoints of the graph state while executing
+DEFAULT_CHECKPOINT_INTERVAL = 10
+
+# seconds between checks of the celery result backend for the results of
+# reattached remote tasks
+REATTACHED_TASKS_CHECK_INTERVAL = 5
+
+# seconds an inspection client may block sending the graph state before
+# it is dropped
+INSPECTION_SEND_TIMEOUT = 5
+
+
+class _InspectionListener(object):
+    """
+    Accepts connections on a unix socket and queues them for the executing
+    graph, which snapshots its state for them
+    """
+
+    def __init__(self, path, connections):
+        """
+        :param path: The unix socket path
+        :param connections: A list accepted connections are appended to
+        """
+        self.path = path
+        self._connections = connections
+        self._closed = False
+        if os.path.exists(path):
+            os.remove(path)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.bind(path)
+        self._socket.listen(5)
+        # accept times out so that the listener notices it was closed
+        self._socket.settimeout(0.5)
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
+
+    def _accept(self):
+        while not self._closed:
+            try:
+                connection, _ = self._socket.accept()
+            except socket.timeout:
+                continue
+            except socket.error:
+                return
+            connection.settimeout(INSPECTION_SEND_TIMEOUT)
+            self._connections.append(connection)
+
+    def close(self):
+        self._closed = True
+        self._socket.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def _write_checkpoint(path, checkpoint):
+    write_file_atomically(path, json.dumps(checkpoint, default=repr))
+
+
+class _CheckpointWriter(object):
+    """
+    Writes the checkpoints of the executing graph from a thread of its own,
+    so that serializing and fsyncing them never blocks the execution. When
+    checkpoints are taken faster than they are written, only the latest one
+    is written.
+    """
+
+    def __init__(self, path, logger):
+        """
+        :param path: The checkpoint path
+        :param logger: A logger write failures are reported to
+        """
+        self.path = path
+        self._logger = logger
+        self._pending = None
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._write_pending)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, checkpoint):
+        with self._condition:
+            self._pending = checkpoint
+            self._condition.notify()
+
+    def _write_pending(self):
+        while True:
+            with self._condition:
+                while self._pending is None and not self._closed:
+                    self._condition.wait()
+                checkpoint, self._pending = self._pending, None
+            if checkpoint is None:
+                return
+            try:
+                _write_checkpoint(self.path, checkpoint)
+            except Exception as e:
+                self._logger.warning('Failed writing the graph checkpoint '
+                                     'to {0}: {1}'.format(self.path, e))
+
+    def close(self):
+        """
+        Write the pending checkpoint, if any, and wait for the writer thread
+        to stop
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        # joined with a timeout so that the wait can still be interrupted
+        while self._thread.is_alive():
+            self._thread.join(1)
+
 
 class TaskDependencyGraph(object):
     """
     A task graph builder
 
     :param workflow_context: A WorkflowContext instance (used for logging)
+    :param checkpoint_path: If set, the graph state is periodically written
+                            to this path while executing so that the
+                            execution can be resumed (see ``resume``)
+    :param checkpoint_interval: Seconds between checkpoints
+    :param inspect_socket_path: If set, the graph listens on a unix socket
+                                at this path while executing, and streams
+                                its state as JSON lines to each client that
+                                connects (e.g. ``nc -U <path>``)
     """
 
-    def __init__(self, workflow_context):
+    def __init__(self, workflow_context, checkpoint_path=None,
+                 checkpoint_interval=DEFAULT_CHECKPOINT_INTERVAL,
+                 inspect_socket_path=None):
         self.ctx = workflow_context
         self.graph = nx.DiGraph()
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_interval = checkpoint_interval
+        self._last_checkpoint = 0
+        # the last checkpoint taken, later ones are only written if they
+        # differ from it
+        self._checkpointed = None
+        self._checkpoint_writer = None
+        # checkpoint keys of the tasks that terminated and were handled
+        self._completed = set()
+        # number of tasks added so far by task signature
+        self._signatures = {}
+        # dumps of the tasks of the resumed run, by checkpoint key
+        self._resumed_tasks = {}
+        # dependencies between the tasks of the resumed run, as pairs of
+        # checkpoint keys
+        self._resumed_edges = None
+        self._reattached_tasks = []
+        self._last_reattached_tasks_check = 0
+        self.inspect_socket_path = inspect_socket_path
+        # connections of inspection clients, waiting for a state snapshot
+        self._inspection_connections = []
 
     def add_task(self, task):
         """Add a WorkflowTask to this graph
@@ -41,8 +187,27 @@ class TaskDependencyGraph(object):
         :param task: The task
         """
         self.ctx.logger.debug('adding task: {0}'.format(task))
+        if task.checkpoint_key is None:
+            task.checkpoint_key = self._checkpoint_key(task)
         self.graph.add_node(task.id, task=task)
 
+    def _checkpoint_key(self, task):
+        """
+        A key identifying the task across runs of the same workflow: its
+        name and operation context, and the number of tasks with the same
+        ones that were added before it
+        """
+        context = task.cloudify_context or {}
+        signature = '{0}:{1}:{2}:{3}:{4}'.format(
+            task.name,
+            task.info,
+            context.get('node_id'),
+            context.get('related', {}).get('node_id'),
+            context.get('operation', {}).get('name'))
+        count = self._signatures.get(signature, 0)
+        self._signatures[signature] = count + 1
+        return '{0}#{1}'.format(signature, count)
+
     def get_task(self, task_id):
         """Get a task instance that was inserted to this graph by its id
 
@@ -106,15 +271,37 @@ class TaskDependencyGraph(object):
 
         Also note that for the time being, if such a cancelling event
         occurs, the method might return even while there's some operations
-        still being executed.
+        still being executed. Remote workflow executions revoke these
+        in-flight operations once cancelled.
         """
+        listener = None
+        if self.inspect_socket_path:
+            listener = _InspectionListener(self.inspect_socket_path,
+                                           self._inspection_connections)
+        if self.checkpoint_path:
+            self._checkpoint_writer = _CheckpointWriter(self.checkpoint_path,
+                                                        self.ctx.logger)
+        try:
+            self._execute()
+        finally:
+            if listener is not None:
+                listener.close()
+            if self._checkpoint_writer is not None:
+                # the last checkpoint is durable by the time execute returns
+                self._checkpoint_writer.close()
+                self._checkpoint_writer = None
+
+    def _execute(self):
+        self._resume_tasks()
+        self._warm_up_registered_tasks()
 
         while True:
 
             if self._is_execution_cancelled():
                 raise api.ExecutionCancelled()
 
-            self._check_dump_request()
+            self._serve_inspection_connections()
+            self._check_reattached_tasks()
 
             # handle all terminated tasks
             # it is important this happens before handling
@@ -123,6 +310,7 @@ class TaskDependencyGraph(object):
             # be the next one)
             for task in self._terminated_tasks():
                 self._handle_terminated_task(task)
+            self._checkpoint()
 
             # handle all executable tasks
             for task in self._executable_tasks():
@@ -130,10 +318,23 @@ class TaskDependencyGraph(object):
 
             # no more tasks to process, time to move on
             if len(self.graph.node) == 0:
+                self._checkpoint(force=True)
                 return
-            # sleep some and do it all over again
+            # sleep some and do it all over again, waking up right away
+            # if the execution is cancelled
             else:
-                time.sleep(0.1)
+                api.cancellation_token.wait(0.1)
+
+    def _warm_up_registered_tasks(self):
+        """
+        Query the registered tasks of all workers targeted by remote tasks
+        in the graph up front, so the first task sent to each worker does
+        not stall the execution on its own query
+        """
+        targets = set(task.target for task in self.tasks_iter()
+                      if isinstance(task, tasks.RemoteWorkflowTask))
+        if targets:
+            tasks.registered_tasks.warm_up(targets)
 
     def _is_execution_cancelled(self):
         return api.has_cancel_request()
@@ -197,21 +398,229 @@ class TaskDependencyGraph(object):
         self.graph.remove_node(task.id)
         if handler_result.action == tasks.HandlerResult.HANDLER_RETRY:
             new_task = handler_result.retried_task
+            new_task.checkpoint_key = task.checkpoint_key
             self.add_task(new_task)
             added_edges = [(dependent, new_task.id)
                            for dependent in dependents]
             self.graph.add_edges_from(added_edges)
+        else:
+            self._completed.add(task.checkpoint_key)
+
+    def _dump(self):
+        return {
+            'tasks': [task.dump() for task in self.tasks_iter()],
+            'edges': [[s, t] for s, t in self.graph.edges_iter()]}
+
+    def _serve_inspection_connections(self):
+        """
+        Snapshot the graph state for the pending inspection clients and
+        stream it to each of them from a thread of its own, so that clients
+        that read slowly (or not at all) never block the execution
+        """
+        if not self._inspection_connections:
+            return
+        state = self._state()
+        while self._inspection_connections:
+            connection = self._inspection_connections.pop()
+            thread = threading.Thread(target=self._send_state,
+                                      args=(connection, state))
+            thread.daemon = True
+            thread.start()
+
+    def _send_state(self, connection, state):
+        """
+        Write the graph state as JSON lines: a graph summary line followed
+        by a line for each task, so that no single string holds the state of
+        the whole graph. Clients that do not read it within the send timeout
+        are dropped.
+        """
+        try:
+            stream = connection.makefile('w')
+            try:
+                for line in state:
+                    stream.write(json.dumps(line, default=repr))
+                    stream.write('\n')
+                stream.flush()
+            finally:
+                stream.close()
+        except (IOError, socket.error) as e:
+            self.ctx.logger.debug('Failed streaming the graph state: {0}'
+                                  .format(e))
+        finally:
+            connection.close()
+
+    def _state(self):
+        """
+        :return: the graph state, as a list of a graph summary followed by
+                 the state of each task
+        """
+        now = time.time()
+        state = [{
+            'type': 'graph',
+            'time': now,
+            'tasks': self.graph.number_of_nodes(),
+            'edges': self.graph.number_of_edges(),
+            'completed': len(self._completed)}]
+        for task_id, data in self.graph.nodes_iter(data=True):
+            task = data['task']
+            state.append({
+                'type': 'task',
+                'id': task_id,
+                'name': task.name,
+                'info': task.info,
+                'state': task.get_state(),
+                'age': now - task.created_at,
+                'sent_age': now - task.sent_at if task.sent_at else None,
+                'retries': task.current_retries,
+                'dependencies': len(self.graph.succ[task_id]),
+                'dependents': len(self.graph.pred[task_id])})
+        return state
+
+    def _checkpoint(self, force=False):
+        """
+        Write the graph state (the task dump with the keys of the tasks
+        completed so far) to the checkpoint path, atomically and durably,
+        unless it did not change since the last checkpoint. While executing,
+        it is written by the checkpoint writer thread.
+        """
+        if not self.checkpoint_path:
+            return
+        now = time.time()
+        if not force and now - self._last_checkpoint < \
+                self.checkpoint_interval:
+            return
+        self._last_checkpoint = now
+        checkpoint = self._dump()
+        checkpoint['completed'] = sorted(self._completed)
+        if checkpoint == self._checkpointed:
+            return
+        self._checkpointed = checkpoint
+        if self._checkpoint_writer is not None:
+            self._checkpoint_writer.write(checkpoint)
+        else:
+            _write_checkpoint(self.checkpoint_path, checkpoint)
 
-    def _check_dump_request(self):
-        task_dump = os.environ.get('WORKFLOW_TASK_DUMP')
-        if not (task_dump and os.path.exists(task_dump)):
+    def resume(self, checkpoint_path=None):
+        """
+        Resume from the checkpoint of a previous run of the workflow.
+        Tasks added to the graph are matched with the checkpointed ones by
+        their checkpoint key when executed: completed tasks are skipped,
+        pending retries keep their retry number and time, and remote tasks
+        that were sent are reattached to instead of being sent again.
+
+        Executing raises a RuntimeError, before any task is handled, if the
+        tasks and dependencies of the graph do not match the checkpoint's
+        (e.g. the workflow or its inputs changed since).
+
+        :param checkpoint_path: The checkpoint to resume from (defaults to
+                                the checkpoint path of this graph)
+        """
+        with open(checkpoint_path or self.checkpoint_path) as f:
+            checkpoint = json.load(f)
+        self._completed.update(checkpoint['completed'])
+        self._resumed_tasks = dict((task['checkpoint_key'], task)
+                                   for task in checkpoint['tasks'])
+        keys = dict((task['id'], task['checkpoint_key'])
+                    for task in checkpoint['tasks'])
+        self._resumed_edges = set((keys[s], keys[t])
+                                  for s, t in checkpoint['edges'])
+
+    def _validate_checkpoint(self):
+        """
+        Make sure the graph is the one the checkpoint was taken of: its
+        tasks are the completed and the checkpointed ones, and once the
+        completed ones are removed, its dependencies are the checkpointed
+        ones
+        """
+        keys = dict((task.id, task.checkpoint_key)
+                    for task in self.tasks_iter())
+        graph_keys = set(keys.itervalues())
+        checkpoint_keys = self._completed | set(self._resumed_tasks)
+        if graph_keys != checkpoint_keys:
+            raise RuntimeError(
+                'Cannot resume: the graph tasks do not match the checkpoint '
+                '(missing from the graph: [{0}], missing from the '
+                'checkpoint: [{1}])'.format(
+                    _describe(checkpoint_keys - graph_keys),
+                    _describe(graph_keys - checkpoint_keys)))
+        graph_edges = set((keys[s], keys[t])
+                          for s, t in self.graph.edges_iter()
+                          if keys[s] not in self._completed and
+                          keys[t] not in self._completed)
+        if graph_edges != self._resumed_edges:
+            raise RuntimeError(
+                'Cannot resume: the graph dependencies do not match the '
+                'checkpoint (missing from the graph: [{0}], missing from the '
+                'checkpoint: [{1}])'.format(
+                    _describe(self._resumed_edges - graph_edges),
+                    _describe(graph_edges - self._resumed_edges)))
+
+    def _resume_tasks(self):
+        if self._resumed_edges is not None:
+            self._validate_checkpoint()
+            self._resumed_edges = None
+        if not (self._completed or self._resumed_tasks):
+            return
+        for task in list(self.tasks_iter()):
+            if task.checkpoint_key in self._completed:
+                self.ctx.logger.debug('skipping completed task: {0}'
+                                      .format(task))
+                self.graph.remove_node(task.id)
+                continue
+            dumped_task = self._resumed_tasks.pop(task.checkpoint_key, None)
+            if dumped_task is None:
+                continue
+            task.current_retries = dumped_task['current_retries']
+            task.execute_after = dumped_task['execute_after']
+            if task.cloudify_context and \
+                    'operation' in task.cloudify_context:
+                task.cloudify_context['operation']['retry_number'] = \
+                    task.current_retries
+            if task.is_remote() and dumped_task['state'] in \
+                    [tasks.TASK_SENT, tasks.TASK_STARTED] + \
+                    tasks.TERMINATED_STATES:
+                self._reattach_task(task, dumped_task['id'])
+
+    def _reattach_task(self, task, task_id):
+        self.ctx.logger.debug('reattaching to task: {0} (task id: {1})'
+                              .format(task, task_id))
+        dependents = self.graph.predecessors(task.id)
+        dependencies = self.graph.successors(task.id)
+        self.graph.remove_node(task.id)
+        task.reattach(task_id)
+        self.graph.add_node(task.id, task=task)
+        self.graph.add_edges_from((dependent, task.id)
+                                  for dependent in dependents)
+        self.graph.add_edges_from((task.id, dependency)
+                                  for dependency in dependencies)
+        self._reattached_tasks.append(task)
+
+    def _check_reattached_tasks(self):
+        now = time.time()
+        if not self._reattached_tasks or now - \
+                self._last_reattached_tasks_check < \
+                REATTACHED_TASKS_CHECK_INTERVAL:
             return
-        os.remove(task_dump)
-        task_dump_path = '{0}.{1}'.format(task_dump, time.time())
-        with open(task_dump_path, 'w') as f:
-            f.write(json.dumps({
-                'tasks': [task.dump() for task in self.tasks_iter()],
-                'edges': [[s, t] for s, t in self.graph.edges_iter()]}))
+        self._last_reattached_tasks_check = now
+        for task in self._reattached_tasks:
+            try:
+                task.check_reattached_result()
+            except Exception as e:
+                self.ctx.logger.warning(
+                    'Failed checking the result of task {0}: {1}'
+                    .format(task, e))
+        self._reattached_tasks = [task for task in self._reattached_tasks
+                                  if not task.is_terminated]
+
+
+def _describe(items, limit=5):
+    # a few of the tasks (keys) or dependencies (pairs of keys) of a
+    # checkpoint mismatch
+    described = sorted(item if isinstance(item, basestring)
+                       else ' -> '.join(item) for item in items)
+    if len(described) > limit:
+        described = described[:limit] + ['...']
+    return ', '.join(described)
 
 
 class forkjoin(object):
@@ -14,12 +14,69 @@
 #    * limitations under the License.
 
 
-import Queue
+import threading
 
 EXECUTION_CANCELLED_RESULT = 'execution_cancelled'
 
 
-queue = None
+class CancellationToken(object):
+    """
+    A flag signaling that the workflow execution has been requested to be
+    cancelled. Checking it does not consume the request, and callbacks
+    may be registered to be woken up as soon as it is cancelled.
+    """
+
+    def __init__(self):
+        self._cancelled = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    def cancel(self):
+        """Cancel and call the registered callbacks"""
+        with self._lock:
+            if self._cancelled.is_set():
+                return
+            self._cancelled.set()
+            callbacks = list(self._callbacks)
+        for callback in callbacks:
+            callback()
+
+    def is_cancelled(self):
+        return self._cancelled.is_set()
+
+    def wait(self, timeout=None):
+        """
+        Block until cancelled or until ``timeout`` seconds have passed
+
+        :return: whether cancelled
+        """
+        self._cancelled.wait(timeout)
+        return self._cancelled.is_set()
+
+    def add_callback(self, callback):
+        """
+        Register a callable to be called (from the cancelling thread) when
+        cancelled. If already cancelled, it is called right away.
+        """
+        with self._lock:
+            if not self._cancelled.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def remove_callback(self, callback):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def reset(self):
+        """Clear the flag, e.g. when a new execution starts"""
+        with self._lock:
+            self._cancelled.clear()
+
+
+# the cancellation token of the workflow execution running in this process
+cancellation_token = CancellationToken()
 
 
 def has_cancel_request():
@@ -39,12 +96,7 @@ def has_cancel_request():
 
     :return: whether there was a request to cancel the workflow execution
     """
-    if not queue:
-        return False
-    try:
-        return queue.get_nowait()['action'] == 'cancel'
-    except Queue.Empty:
-        return False
+    return cancellation_token.is_cancelled()
 
 
 class ExecutionCancelled(Exception):
@@ -14,6 +14,7 @@
 #    * limitations under the License.
 
 
+import os
 import functools
 import copy
 import uuid
@@ -33,7 +34,9 @@ from cloudify.workflows.tasks import (RemoteWorkflowTask,
                                       NOPLocalWorkflowTask,
                                       DEFAULT_TOTAL_RETRIES,
                                       DEFAULT_RETRY_INTERVAL,
-                                      DEFAULT_SEND_TASK_EVENTS)
+                                      DEFAULT_SEND_TASK_EVENTS,
+                                      TASK_REPLY_QUEUE_KEY,
+                                      revoke_tasks)
 from cloudify.workflows import events
 from cloudify.workflows.tasks_graph import TaskDependencyGraph
 from cloudify import logs
@@ -46,6 +49,24 @@ from cloudify.logs import (CloudifyWorkflowLoggingHandler,
 
 DEFAULT_LOCAL_TASK_THREAD_POOL_SIZE = 1
 
+# above this number of planned node instances, a remote workflow context
+# loads node instances one node at a time, so that only a single node's
+# raw REST models are held in memory at once
+NODE_INSTANCES_PAGING_THRESHOLD = 1000
+
+CONTAINED_IN_RELATIONSHIP = 'cloudify.relationships.contained_in'
+
+# directory in which the task graph state of executions is checkpointed
+WORKFLOW_CHECKPOINT_DIR_ENV = 'WORKFLOW_CHECKPOINT_DIR'
+
+# directory in which executing task graphs listen on a unix socket named
+# after the execution id, for inspecting their state
+WORKFLOW_INSPECT_DIR_ENV = 'WORKFLOW_INSPECT_DIR'
+
+# seconds to wait for revoked in-flight remote tasks to drain when an
+# execution is cancelled
+DEFAULT_CANCEL_DRAIN_TIMEOUT = 30
+
 
 class CloudifyWorkflowRelationshipInstance(object):
     """
@@ -58,19 +79,22 @@ class CloudifyWorkflowRelationshipInstance(object):
            instance (of the rest client model)
     """
 
+    __slots__ = ('ctx', 'node_instance', '_nodes_and_instances',
+                 '_target_id', '_relationship')
+
     def __init__(self, ctx, node_instance, nodes_and_instances,
                  relationship_instance):
         self.ctx = ctx
         self.node_instance = node_instance
         self._nodes_and_instances = nodes_and_instances
-        self._relationship_instance = relationship_instance
+        self._target_id = relationship_instance.get('target_id')
         self._relationship = node_instance.node.get_relationship(
             relationship_instance['target_name'])
 
     @property
     def target_id(self):
         """The relationship target node id"""
-        return self._relationship_instance.get('target_id')
+        return self._target_id
 
     @property
     def target_node_instance(self):
@@ -136,11 +160,15 @@ class CloudifyWorkflowRelationship(object):
            rest client mode)
     """
 
+    __slots__ = ('ctx', 'node', '_nodes_and_instances', '_relationship',
+                 '_type_hierarchy')
+
     def __init__(self, ctx, node, nodes_and_instances, relationship):
         self.ctx = ctx
         self.node = node
         self._nodes_and_instances = nodes_and_instances
         self._relationship = relationship
+        self._type_hierarchy = frozenset(relationship['type_hierarchy'])
 
     @property
     def target_id(self):
@@ -167,7 +195,7 @@ class CloudifyWorkflowRelationship(object):
         :param other_relationship: a string like
                cloudify.relationships.contained_in
         """
-        return other_relationship in self._relationship["type_hierarchy"]
+        return other_relationship in self._type_hierarchy
 
 
 class CloudifyWorkflowNodeInstance(object):
@@ -180,18 +208,29 @@ class CloudifyWorkflowNodeInstance(object):
     :param nodes_and_instances: a WorkflowNodesAndInstancesContainer instance
     """
 
+    __slots__ = ('ctx', '_node', '_nodes_and_instances', '_id', '_host_id',
+                 '_modification', '_raw_relationships',
+                 '_relationship_instances', '_contained_instances',
+                 '_logger')
+
     def __init__(self, ctx, node, node_instance, nodes_and_instances):
         self.ctx = ctx
         self._node = node
-        self._node_instance = node_instance
+        self._nodes_and_instances = nodes_and_instances
+        # only the fields the workflow model needs are kept out of the
+        # rest client model, ids are shared through the container
+        intern_id = nodes_and_instances.intern_id
+        self._id = intern_id(node_instance.id)
+        self._host_id = intern_id(node_instance.get('host_id'))
+        self._modification = node_instance.get('modification')
+        self._raw_relationships = tuple(
+            (intern_id(relationship_instance['target_id']),
+             intern_id(relationship_instance['target_name']))
+            for relationship_instance in node_instance.relationships)
+        # relationship instances are created on first access
+        self._relationship_instances = None
         # Directly contained node instances. Filled in the context's __init__()
         self._contained_instances = []
-        self._relationship_instances = dict(
-            (relationship_instance['target_id'],
-                CloudifyWorkflowRelationshipInstance(
-                    self.ctx, self, nodes_and_instances,
-                    relationship_instance))
-            for relationship_instance in node_instance.relationships)
 
         # adding the node instance to the node instances map
         node._node_instances[self.id] = self
@@ -261,18 +300,34 @@ class CloudifyWorkflowNodeInstance(object):
     @property
     def id(self):
         """The node instance id"""
-        return self._node_instance.id
+        return self._id
 
     @property
     def node_id(self):
         """The node id (this instance is an instance of that node)"""
-        return self._node_instance.node_id
+        return self._node.id
+
+    @property
+    def host_id(self):
+        """The id of the host node instance this instance is hosted on"""
+        return self._host_id
 
     @property
     def relationships(self):
         """The node relationships"""
+        if self._relationship_instances is None:
+            self._relationship_instances = dict(
+                (target_id, CloudifyWorkflowRelationshipInstance(
+                    self.ctx, self, self._nodes_and_instances,
+                    {'target_id': target_id, 'target_name': target_name}))
+                for target_id, target_name in self._raw_relationships)
         return self._relationship_instances.itervalues()
 
+    def _contained_in_target_ids(self):
+        return [target_id for target_id, target_name
+                in self._raw_relationships
+                if self._node.is_contained_in(target_name)]
+
     @property
     def node(self):
         """The node object for this node instance"""
@@ -281,7 +336,7 @@ class CloudifyWorkflowNodeInstance(object):
     @property
     def modification(self):
         """Modification enum (None, added, removed)"""
-        return self._node_instance.get('modification')
+        return self._modification
 
     @property
     def logger(self):
@@ -294,7 +349,9 @@ class CloudifyWorkflowNodeInstance(object):
         logger_name = '{0}-{1}'.format(self.ctx.execution_id, self.id)
         logging_handler = self.ctx.internal.handler.get_node_logging_handler(
             self)
-        return init_cloudify_logger(logging_handler, logger_name)
+        return init_cloudify_logger(
+            logging_handler, logger_name,
+            logging_config=self.ctx.internal.get_logging_config())
 
     @property
     def contained_instances(self):
@@ -311,10 +368,7 @@ class CloudifyWorkflowNodeInstance(object):
         Returns a set containing this instance and all nodes that are
         contained directly and transitively within it
         """
-        result = set([self])
-        for child in self.contained_instances:
-            result.update(child.get_contained_subgraph())
-        return result
+        return self._nodes_and_instances.get_contained_subgraph(self.id)
 
 
 class CloudifyWorkflowNode(object):
@@ -326,6 +380,9 @@ class CloudifyWorkflowNode(object):
     :param nodes_and_instances: a WorkflowNodesAndInstancesContainer instance
     """
 
+    __slots__ = ('ctx', '_node', '_relationships', '_node_instances',
+                 '_contained_in_targets', '_type_hierarchy')
+
     def __init__(self, ctx, node, nodes_and_instances):
         self.ctx = ctx
         self._node = node
@@ -333,6 +390,11 @@ class CloudifyWorkflowNode(object):
             (relationship['target_id'], CloudifyWorkflowRelationship(
                 self.ctx, self, nodes_and_instances, relationship))
             for relationship in node.relationships)
+        self._contained_in_targets = frozenset(
+            target_id for target_id, relationship
+            in self._relationships.iteritems()
+            if relationship.is_derived_from(CONTAINED_IN_RELATIONSHIP))
+        self._type_hierarchy = frozenset(node.get('type_hierarchy') or [])
         self._node_instances = {}
 
     @property
@@ -393,30 +455,144 @@ class CloudifyWorkflowNode(object):
         """Get a node relationship by its target id"""
         return self._relationships.get(target_id)
 
+    def is_derived_from(self, type_name):
+        """
+        :param type_name: a node type name like cloudify.nodes.Compute
+        :return: whether the type_name is in this node's type hierarchy
+        """
+        return type_name in self._type_hierarchy
+
+    def is_contained_in(self, target_id):
+        """
+        :param target_id: a relationship target node id
+        :return: whether this node is contained in the target node
+        """
+        return target_id in self._contained_in_targets
+
 
 class WorkflowNodesAndInstancesContainer(object):
 
     def __init__(self, workflow_context, raw_nodes, raw_node_instances):
+        """
+        :param workflow_context: a CloudifyWorkflowContext instance
+        :param raw_nodes: Node instances (rest client model)
+        :param raw_node_instances: NodeInstance instances (rest client
+               model). May be any iterable, it is only iterated once and its
+               items are not referenced afterwards.
+        """
+        # shared instances of node and node instance ids
+        self._ids = {}
         self._nodes = dict(
-            (node.id, CloudifyWorkflowNode(workflow_context, node, self))
+            (self.intern_id(node.id),
+             CloudifyWorkflowNode(workflow_context, node, self))
             for node in raw_nodes)
 
-        self._node_instances = dict(
-            (instance.id, CloudifyWorkflowNodeInstance(
+        self._node_instances = {}
+        for instance in raw_node_instances:
+            node_instance = CloudifyWorkflowNodeInstance(
                 workflow_context, self._nodes[instance.node_id], instance,
-                self))
-            for instance in raw_node_instances)
+                self)
+            self._node_instances[node_instance.id] = node_instance
 
         for inst in self._node_instances.itervalues():
-            for rel in inst.relationships:
-                if rel.relationship.is_derived_from(
-                        "cloudify.relationships.contained_in"):
-                    rel.target_node_instance._add_contained_node_instance(inst)
+            for target_id in inst._contained_in_target_ids():
+                container = self._node_instances.get(target_id)
+                if container is not None:
+                    container._add_contained_node_instance(inst)
+
+        # query indexes, built on first use
+        self._contained_subgraphs = {}
+        self._hosted_instances = None
+        self._dependent_instances = None
+        self._nodes_by_type = None
+
+    def intern_id(self, value):
+        """
+        :return: the shared instance of an id string (returned as is if it
+                 is not a string)
+        """
+        if not isinstance(value, basestring):
+            return value
+        return self._ids.setdefault(value, value)
 
     @property
     def nodes(self):
         return self._nodes.itervalues()
 
+    @property
+    def node_instances(self):
+        return self._node_instances.itervalues()
+
+    def get_contained_subgraph(self, node_instance_id):
+        """
+        :param node_instance_id: The node instance id
+        :return: a set containing the node instance and all node instances
+                 that are contained directly and transitively within it
+        """
+        subgraph = self._contained_subgraphs.get(node_instance_id)
+        if subgraph is None:
+            instance = self._node_instances[node_instance_id]
+            subgraph = set([instance])
+            for child in instance.contained_instances:
+                subgraph.update(self.get_contained_subgraph(child.id))
+            subgraph = frozenset(subgraph)
+            self._contained_subgraphs[node_instance_id] = subgraph
+        return set(subgraph)
+
+    def get_host_node_instance(self, node_instance_id):
+        """
+        :param node_instance_id: The node instance id
+        :return: the CloudifyWorkflowNodeInstance the node instance is hosted
+                 on, None if it is not hosted on any
+        """
+        instance = self._node_instances[node_instance_id]
+        return self._node_instances.get(instance.host_id)
+
+    def get_hosted_node_instances(self, host_node_instance_id):
+        """
+        :param host_node_instance_id: A host node instance id
+        :return: a list of the node instances hosted on the host, including
+                 the host node instance itself
+        """
+        if self._hosted_instances is None:
+            hosted_instances = {}
+            for instance in self._node_instances.itervalues():
+                hosted_instances.setdefault(instance.host_id, []).append(
+                    instance)
+            self._hosted_instances = hosted_instances
+        return list(self._hosted_instances.get(host_node_instance_id, []))
+
+    def get_dependent_node_instances(self, node_instance_id):
+        """
+        :param node_instance_id: The node instance id
+        :return: a list of the node instances having a relationship whose
+                 target is the node instance
+        """
+        if self._dependent_instances is None:
+            dependent_instances = {}
+            for instance in self._node_instances.itervalues():
+                for target_id, _ in instance._raw_relationships:
+                    dependent_instances.setdefault(target_id, []).append(
+                        instance)
+            self._dependent_instances = dependent_instances
+        return list(self._dependent_instances.get(node_instance_id, []))
+
+    def get_nodes_by_type(self, type_names):
+        """
+        :param type_names: node type names
+        :return: a set of the nodes derived from any of the provided types
+        """
+        if self._nodes_by_type is None:
+            nodes_by_type = {}
+            for node in self._nodes.itervalues():
+                for type_name in node._type_hierarchy:
+                    nodes_by_type.setdefault(type_name, set()).add(node)
+            self._nodes_by_type = nodes_by_type
+        result = set()
+        for type_name in type_names:
+            result.update(self._nodes_by_type.get(type_name, ()))
+        return result
+
     def get_node(self, node_id):
         """
         Get a node by its id
@@ -456,19 +632,32 @@ class CloudifyWorkflowContext(WorkflowNodesAndInstancesContainer):
         self._task_retries = ctx.get('task_retries',
                                      DEFAULT_TOTAL_RETRIES)
         self._logger = None
+        # execution wide dispatch data, see _execute_operation and
+        # _build_cloudify_context
+        self._operation_templates = {}
+        self._cloudify_context_template = None
 
         self.blueprint = context.BlueprintContext(self._context)
         self.deployment = WorkflowDeploymentContext(self._context, self)
 
+        # local task callables by their dotted path, shared with the local
+        # environment (when executed locally) so that they are resolved once
+        self._local_task_callables = ctx.pop('task_callables', None)
+        if self._local_task_callables is None:
+            self._local_task_callables = {}
+
         if self.local:
             storage = ctx.pop('storage')
+            event_sink = ctx.pop('event_sink', None)
             raw_nodes = storage.get_nodes()
             raw_node_instances = storage.get_node_instances()
-            handler = LocalCloudifyWorkflowContextHandler(self, storage)
+            handler = LocalCloudifyWorkflowContextHandler(self, storage,
+                                                          event_sink)
         else:
             rest = get_rest_client()
             raw_nodes = rest.nodes.list(self.deployment.id)
-            raw_node_instances = rest.node_instances.list(self.deployment.id)
+            raw_node_instances = _list_node_instances(
+                rest, self.deployment.id, raw_nodes)
             handler = RemoteCloudifyWorkflowContextHandler(self)
 
         super(CloudifyWorkflowContext, self).__init__(
@@ -508,6 +697,23 @@ class CloudifyWorkflowContext(WorkflowNodesAndInstancesContainer):
         """Is the workflow running in a local or remote context"""
         return self._context.get('local', False)
 
+    @property
+    def execution_control(self):
+        """
+        Does the manager publish the control messages of this execution
+        (see ``cloudify.amqp_client.publish_execution_control``), so that
+        'cancel' requests are noticed without polling the execution status
+        """
+        return self._context.get('execution_control', False)
+
+    @property
+    def resume(self):
+        """
+        Is this execution resuming a previous run of the workflow that did
+        not finish, from its checkpoint
+        """
+        return self._context.get('resume', False)
+
     @property
     def logger(self):
         """A logger for this workflow"""
@@ -518,7 +724,9 @@ class CloudifyWorkflowContext(WorkflowNodesAndInstancesContainer):
     def _init_cloudify_logger(self):
         logger_name = self.execution_id
         logging_handler = self.internal.handler.get_context_logging_handler()
-        return init_cloudify_logger(logging_handler, logger_name)
+        return init_cloudify_logger(
+            logging_handler, logger_name,
+            logging_config=self.internal.get_logging_config())
 
     def send_event(self, event, event_type='workflow_stage',
                    args=None,
@@ -547,61 +755,88 @@ class CloudifyWorkflowContext(WorkflowNodesAndInstancesContainer):
                            kwargs=None,
                            allow_kwargs_override=False,
                            send_task_events=DEFAULT_SEND_TASK_EVENTS):
-        kwargs = kwargs or {}
-        op_struct = operations.get(operation)
-        if op_struct is None:
-            raise RuntimeError('{0} operation of node instance {1} does '
-                               'not exist'.format(operation,
-                                                  node_instance.id))
-        if not op_struct['operation']:
+        template = self._get_operation_template(node_instance, operations,
+                                                operation)
+        if template is None:
             return NOPLocalWorkflowTask(self)
-        plugin_name = op_struct['plugin']
-        operation_mapping = op_struct['operation']
-        has_intrinsic_functions = op_struct['has_intrinsic_functions']
-        operation_properties = op_struct.get('inputs', {})
-        operation_executor = op_struct['executor']
-        operation_total_retries = op_struct['max_retries']
-        operation_retry_interval = op_struct['retry_interval']
         task_queue = self.internal.handler.get_operation_task_queue(
-            node_instance, operation_executor)
-        task_name = operation_mapping
-        if operation_total_retries is None:
-            total_retries = self.internal.get_task_configuration()[
-                'total_retries']
-        else:
-            total_retries = operation_total_retries
+            node_instance, template['executor'])
+        total_retries = template['total_retries']
 
         node_context = {
             'node_id': node_instance.id,
             'node_name': node_instance.node_id,
-            'plugin': plugin_name,
+            'plugin': template['plugin'],
             'operation': {
                 'name': operation,
                 'retry_number': 0,
                 'max_retries': total_retries
             },
-            'has_intrinsic_functions': has_intrinsic_functions,
+            'has_intrinsic_functions': template['has_intrinsic_functions'],
         }
         if related_node_instance is not None:
-            relationships = [rel.target_id
-                             for rel in node_instance.relationships]
+            related_id = related_node_instance.id
             node_context['related'] = {
-                'node_id': related_node_instance.id,
+                'node_id': related_id,
                 'node_name': related_node_instance.node_id,
-                'is_target': related_node_instance.id in relationships
+                'is_target': any(target_id == related_id for target_id, _
+                                 in node_instance._raw_relationships)
             }
 
-        final_kwargs = self._merge_dicts(merged_from=kwargs,
-                                         merged_into=operation_properties,
-                                         allow_override=allow_kwargs_override)
+        if kwargs:
+            final_kwargs = self._merge_dicts(
+                merged_from=kwargs,
+                merged_into=template['inputs'],
+                allow_override=allow_kwargs_override)
+        else:
+            final_kwargs = dict(template['inputs'])
 
-        return self.execute_task(task_name,
+        return self.execute_task(template['task_name'],
                                  task_queue=task_queue,
                                  kwargs=final_kwargs,
                                  node_context=node_context,
                                  send_task_events=send_task_events,
                                  total_retries=total_retries,
-                                 retry_interval=operation_retry_interval)
+                                 retry_interval=template['retry_interval'])
+
+    def _get_operation_template(self, node_instance, operations, operation):
+        """
+        The parts of an operation's dispatch that are the same for all
+        tasks of a node (or relationship) operation, built once per
+        execution. None is returned for operations that are not mapped to
+        any implementation.
+        """
+        key = (node_instance.node_id, id(operations), operation)
+        cached = self._operation_templates.get(key)
+        # the operations dict is kept in the cache so that a recycled id
+        # of a short lived dict is never mistaken for it
+        if cached is not None and cached[0] is operations:
+            return cached[1]
+
+        op_struct = operations.get(operation)
+        if op_struct is None:
+            raise RuntimeError('{0} operation of node instance {1} does '
+                               'not exist'.format(operation,
+                                                  node_instance.id))
+        if not op_struct['operation']:
+            template = None
+        else:
+            total_retries = op_struct['max_retries']
+            if total_retries is None:
+                total_retries = self.internal.get_task_configuration()[
+                    'total_retries']
+            template = {
+                'task_name': op_struct['operation'],
+                'plugin': op_struct['plugin'],
+                'has_intrinsic_functions': op_struct[
+                    'has_intrinsic_functions'],
+                'inputs': op_struct.get('inputs', {}),
+                'executor': op_struct['executor'],
+                'total_retries': total_retries,
+                'retry_interval': op_struct['retry_interval']
+            }
+        self._operation_templates[key] = (operations, template)
+        return template
 
     @staticmethod
     def _merge_dicts(merged_from, merged_into, allow_override=False):
@@ -634,19 +869,28 @@ class CloudifyWorkflowContext(WorkflowNodesAndInstancesContainer):
                                 task_queue,
                                 task_name,
                                 node_context):
-        node_context = node_context or {}
-        context = {
-            '__cloudify_context': '0.3',
-            'task_id': task_id,
-            'task_name': task_name,
-            'task_target': task_queue,
-            'blueprint_id': self.blueprint.id,
-            'deployment_id': self.deployment.id,
-            'execution_id': self.execution_id,
-            'workflow_id': self.workflow_id,
-        }
-        context.update(node_context)
-        context.update(self.internal.handler.operation_cloudify_context)
+        if self._cloudify_context_template is None:
+            template = {
+                '__cloudify_context': '0.3',
+                'blueprint_id': self.blueprint.id,
+                'deployment_id': self.deployment.id,
+                'execution_id': self.execution_id,
+                'workflow_id': self.workflow_id,
+            }
+            logging_config = self.internal.get_logging_config()
+            if logging_config:
+                template[logs.LOGGING_CONFIG_KEY] = logging_config
+            template.update(self.internal.handler.operation_cloudify_context)
+            self._cloudify_context_template = template
+
+        context = dict(self._cloudify_context_template)
+        context['task_id'] = task_id
+        context['task_name'] = task_name
+        context['task_target'] = task_queue
+        if task_queue is not None and self.internal.task_reply_queue:
+            context[TASK_REPLY_QUEUE_KEY] = self.internal.task_reply_queue
+        if node_context:
+            context.update(node_context)
         return context
 
     def execute_task(self,
@@ -676,11 +920,14 @@ class CloudifyWorkflowContext(WorkflowNodesAndInstancesContainer):
 
         if task_queue is None:
             # Local task
-            values = task_name.split('.')
-            module_name = '.'.join(values[:-1])
-            method_name = values[-1]
-            module = importlib.import_module(module_name)
-            task = getattr(module, method_name)
+            task = self._local_task_callables.get(task_name)
+            if task is None:
+                values = task_name.split('.')
+                module_name = '.'.join(values[:-1])
+                method_name = values[-1]
+                module = importlib.import_module(module_name)
+                task = getattr(module, method_name)
+                self._local_task_callables[task_name] = task
             return self.local_task(local_task=task,
                                    info=task_name,
                                    name=task_name,
@@ -800,14 +1047,57 @@ class CloudifyWorkflowContextInternal(object):
         self.workflow_context = workflow_context
         self.handler = handler
         self._bootstrap_context = None
+        self._task_configuration = None
+        self._logging_config = None
         self._graph_mode = False
         # the graph is always created internally for events to work properly
         # when graph mode is turned on this instance is returned to the user.
-        self._task_graph = TaskDependencyGraph(workflow_context)
+        # its state is checkpointed when a checkpoint directory is
+        # configured, so that the execution can be resumed if the workflow
+        # worker dies
+        checkpoint_dir = os.environ.get(WORKFLOW_CHECKPOINT_DIR_ENV)
+        checkpoint_path = None
+        if checkpoint_dir:
+            checkpoint_path = os.path.join(checkpoint_dir, '{0}.json'.format(
+                workflow_context.execution_id))
+        inspect_dir = os.environ.get(WORKFLOW_INSPECT_DIR_ENV)
+        inspect_socket_path = None
+        if inspect_dir:
+            inspect_socket_path = os.path.join(
+                inspect_dir, '{0}.sock'.format(workflow_context.execution_id))
+        self._task_graph = TaskDependencyGraph(
+            workflow_context,
+            checkpoint_path=checkpoint_path,
+            inspect_socket_path=inspect_socket_path)
+        if checkpoint_path and workflow_context.resume and \
+                os.path.exists(checkpoint_path):
+            self._task_graph.resume()
 
         # events related
         self._event_monitor = None
         self._event_monitor_thread = None
+        self.task_events_verbosity = workflow_context._context.get(
+            'task_events_verbosity', events.DEFAULT_TASK_EVENTS_VERBOSITY)
+        if self.task_events_verbosity not in \
+                events.TASK_EVENTS_VERBOSITY_MODES:
+            raise ValueError('Illegal task events verbosity: {0} (valid '
+                             'values: {1})'.format(
+                                 self.task_events_verbosity,
+                                 events.TASK_EVENTS_VERBOSITY_MODES))
+        task_completion = workflow_context._context.get(
+            'task_completion', events.DEFAULT_TASK_COMPLETION)
+        if task_completion not in events.TASK_COMPLETION_MODES:
+            raise ValueError('Illegal task completion mode: {0} (valid '
+                             'values: {1})'.format(
+                                 task_completion,
+                                 events.TASK_COMPLETION_MODES))
+        # local workflows execute all their tasks locally
+        if task_completion == events.TASK_COMPLETION_REPLY_QUEUE and \
+                not workflow_context.local:
+            self.task_reply_queue = 'cloudify-task-replies-{0}'.format(
+                workflow_context.execution_id)
+        else:
+            self.task_reply_queue = None
 
         # local task processing
         thread_pool_size = self.workflow_context._local_task_thread_pool_size
@@ -815,6 +1105,11 @@ class CloudifyWorkflowContextInternal(object):
             thread_pool_size=thread_pool_size)
 
     def get_task_configuration(self):
+        if self._task_configuration is None:
+            self._task_configuration = self._build_task_configuration()
+        return self._task_configuration
+
+    def _build_task_configuration(self):
         bootstrap_context = self._get_bootstrap_context()
         workflows = bootstrap_context.get('workflows', {})
         total_retries = workflows.get(
@@ -826,6 +1121,20 @@ class CloudifyWorkflowContextInternal(object):
         return dict(total_retries=total_retries,
                     retry_interval=retry_interval)
 
+    def get_logging_config(self):
+        """
+        The logging configuration of this execution. Built from the
+        bootstrap context ``logging`` section, overridden by the execution
+        context ``logging`` entry. It is also passed on to operations
+        executed by this workflow.
+        """
+        if self._logging_config is None:
+            bootstrap_context = self._get_bootstrap_context()
+            self._logging_config = logs.merge_logging_configs(
+                bootstrap_context.get(logs.LOGGING_CONFIG_KEY),
+                self.workflow_context._context.get(logs.LOGGING_CONFIG_KEY))
+        return self._logging_config
+
     def _get_bootstrap_context(self):
         if self._bootstrap_context is None:
             self._bootstrap_context = self.handler.bootstrap_context
@@ -849,7 +1158,17 @@ class CloudifyWorkflowContextInternal(object):
         defined in the task dependency graph
 
         """
-        monitor = events.Monitor(self.task_graph)
+        if self.task_reply_queue:
+            monitor = events.ReplyQueueMonitor(
+                self.task_graph,
+                self.task_reply_queue,
+                self.task_events_verbosity,
+                reply_timeout=self.workflow_context._context.get(
+                    'task_reply_timeout'))
+            monitor.connect()
+        else:
+            monitor = events.Monitor(self.task_graph,
+                                     self.task_events_verbosity)
         thread = threading.Thread(target=monitor.capture)
         thread.daemon = True
         thread.start()
@@ -859,9 +1178,52 @@ class CloudifyWorkflowContextInternal(object):
     def stop_event_monitor(self):
         self._event_monitor.stop()
 
+    def track_remote_task(self, task):
+        """
+        Make the event monitor (if started) handle the celery events of a
+        remote task that is about to be sent
+        """
+        if self._event_monitor is not None:
+            self._event_monitor.add_task(task)
+
+    def revoke_remote_tasks(self, terminate=False,
+                            timeout=DEFAULT_CANCEL_DRAIN_TIMEOUT):
+        """
+        Revoke the in-flight remote tasks of the execution, e.g. when it is
+        cancelled, so that they stop consuming agent capacity, and wait for
+        them to drain.
+
+        :param terminate: Whether to also terminate tasks that already
+                          started
+        :param timeout: The maximum number of seconds to wait for the
+                        revoked tasks to drain, 0 not to wait
+        :return: The ids of the tasks still in-flight after the timeout
+        """
+        if self._event_monitor is None:
+            return []
+        in_flight = self._event_monitor.in_flight_tasks()
+        if not in_flight:
+            return []
+        logger = self.workflow_context.logger
+        try:
+            revoke_tasks(in_flight, terminate=terminate)
+        except Exception as e:
+            logger.warning('Failed revoking {0} in-flight tasks: {1}'
+                           .format(len(in_flight), e))
+            return [task.id for task in in_flight]
+        if not timeout:
+            return [task.id for task in in_flight]
+        remaining = self._event_monitor.wait_for_drained(
+            [task.id for task in in_flight], timeout)
+        if remaining:
+            logger.warning('{0} revoked tasks did not drain within {1} '
+                           'seconds'.format(len(remaining), timeout))
+        return remaining
+
     def send_task_event(self, state, task, event=None):
         send_task_event_func = self.handler.get_send_task_event_func(task)
-        events.send_task_event(state, task, send_task_event_func, event)
+        events.send_task_event(state, task, send_task_event_func, event,
+                               self.task_events_verbosity)
 
     def send_workflow_event(self, event_type, message=None, args=None):
         self.handler.send_workflow_event(event_type=event_type,
@@ -1027,9 +1389,8 @@ class RemoteCloudifyWorkflowContextHandler(CloudifyWorkflowContextHandler):
 
     def get_operation_task_queue(self, workflow_node_instance,
                                  operation_executor):
-        rest_node_instance = workflow_node_instance._node_instance
         if operation_executor == 'host_agent':
-            return rest_node_instance.host_id
+            return workflow_node_instance.host_id
         if operation_executor == 'central_deployment_agent':
             return self.workflow_ctx.deployment.id
 
@@ -1096,26 +1457,30 @@ class RemoteCloudifyWorkflowContextHandler(CloudifyWorkflowContextHandler):
 
 class LocalCloudifyWorkflowContextHandler(CloudifyWorkflowContextHandler):
 
-    def __init__(self, workflow_ctx, storage):
+    def __init__(self, workflow_ctx, storage, event_sink=None):
         super(LocalCloudifyWorkflowContextHandler, self).__init__(
             workflow_ctx)
         self.storage = storage
-        self._send_task_event_func = None
+        self.event_sink = event_sink or logs.StdoutEventSink()
+        self._send_task_event_func = functools.partial(
+            events.send_task_event_func_local,
+            out_func=self.event_sink.event_out)
 
     def get_context_logging_handler(self):
         return CloudifyWorkflowLoggingHandler(self.workflow_ctx,
-                                              out_func=logs.stdout_log_out)
+                                              out_func=self.event_sink.log_out)
 
     def get_node_logging_handler(self, workflow_node_instance):
-        return CloudifyWorkflowNodeLoggingHandler(workflow_node_instance,
-                                                  out_func=logs.stdout_log_out)
+        return CloudifyWorkflowNodeLoggingHandler(
+            workflow_node_instance,
+            out_func=self.event_sink.log_out)
 
     @property
     def bootstrap_context(self):
         return {}
 
     def get_send_task_event_func(self, task):
-        return events.send_task_event_func_local
+        return self._send_task_event_func
 
     def get_update_execution_status_task(self, new_status):
         raise NotImplementedError(
@@ -1130,7 +1495,7 @@ class LocalCloudifyWorkflowContextHandler(CloudifyWorkflowContextHandler):
                                      event_type='workflow_node_event',
                                      message=event,
                                      additional_context=additional_context,
-                                     out_func=logs.stdout_event_out)
+                                     out_func=self.event_sink.event_out)
         return send_event_task
 
     def get_send_workflow_event_task(self, event, event_type, args,
@@ -1142,7 +1507,7 @@ class LocalCloudifyWorkflowContextHandler(CloudifyWorkflowContextHandler):
                                 message=event,
                                 args=args,
                                 additional_context=additional_context,
-                                out_func=logs.stdout_event_out)
+                                out_func=self.event_sink.event_out)
         return send_event_task
 
     def get_operation_task_queue(self, workflow_node_instance,
@@ -1152,7 +1517,8 @@ class LocalCloudifyWorkflowContextHandler(CloudifyWorkflowContextHandler):
     @property
     def operation_cloudify_context(self):
         return {'local': True,
-                'storage': self.storage}
+                'storage': self.storage,
+                'event_sink': self.event_sink}
 
     def get_set_state_task(self,
                            workflow_node_instance,
@@ -1178,7 +1544,7 @@ class LocalCloudifyWorkflowContextHandler(CloudifyWorkflowContextHandler):
                             event_type=event_type,
                             message=message,
                             args=args,
-                            out_func=logs.stdout_event_out)
+                            out_func=self.event_sink.event_out)
 
     def download_blueprint_resource(self,
                                     resource_path,
@@ -1266,6 +1632,22 @@ class WorkflowDeploymentContext(context.DeploymentContext):
         return handler.start_deployment_modification(nodes)
 
 
+def _list_node_instances(rest, deployment_id, raw_nodes):
+    """
+    List the node instances of a deployment. Large deployments are listed
+    one node at a time (lazily), so that the raw REST models of a single node
+    are held in memory at once.
+    """
+    planned_instances = sum(node.get('number_of_instances') or 0
+                            for node in raw_nodes)
+    if planned_instances <= NODE_INSTANCES_PAGING_THRESHOLD:
+        return rest.node_instances.list(deployment_id)
+    return (instance
+            for node in raw_nodes
+            for instance in rest.node_instances.list(deployment_id,
+                                                     node_name=node.id))
+
+
 def task_config(fn=None, **arguments):
     if fn is not None:
         @functools.wraps(fn)